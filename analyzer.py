@@ -0,0 +1,248 @@
+import argparse
+import csv
+import socket
+import statistics
+import time
+
+import capture
+from protocol import (EXT_BUNDLE, EXT_DELTA_REQUEST, EXT_FILE_DIGEST, EXT_MSG_TYPE, EXT_PARALLEL_DONE,
+                      EXT_PARALLEL_OFFER, EXT_PARALLEL_PORTS, HEADER_SIZE, TEXT_PREFIX_SIZE, packet_key, parse_header,
+                      split_bundle)
+
+# Offline analýza záznamu z --capture: časová os sekvencií, RTT, retransmisie, nečinnosť, replay
+
+DATA_TYPES = (6, 8, 11)  # Pakety, ktoré druhá strana potvrdzuje
+DATA_EXT = (EXT_FILE_DIGEST, EXT_DELTA_REQUEST, EXT_PARALLEL_OFFER, EXT_PARALLEL_DONE)  # ... a tieto podtypy typu 9
+ACK_TYPES = (13, 15)  # NACK, ACK
+TYPE_NAMES = {1: "SYN", 2: "SYN-ACK", 3: "ACK", 4: "SEALED", 5: "HEARTBEAT", 6: "FILE", 7: "END", 8: "FILE-NAME",
+              9: "EXT", 10: "ERROR", 11: "TEXT", 12: "FIN", 13: "NACK", 14: "FIN-ACK", 15: "ACK2"}
+
+
+def parse_address(text):
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+
+# Function to decode a capture into a list of packets with direction relative to the local endpoint
+def load_packets(path, local=None):
+    packets = []
+    for timestamp, src, dst, payload in capture.read_capture(path):
+        if len(payload) < HEADER_SIZE:
+            continue
+        if local is None:
+            local = src  # The first datagram of a session is our own SYN
+        header_info = parse_header(payload[:HEADER_SIZE])
+        if header_info["msg_type"] == EXT_MSG_TYPE and header_info["flags"] == EXT_BUNDLE:
+            inner = [packet for packet in split_bundle(payload[HEADER_SIZE:]) if len(packet) >= HEADER_SIZE]
+        else:
+            inner = [payload]
+        for packet in inner:
+            header_info = parse_header(packet[:HEADER_SIZE])
+            header_info.update(time=timestamp, direction="out" if src == local else "in", src=src, dst=dst,
+                               payload=packet)
+            packets.append(header_info)
+    if packets:
+        start = packets[0]["time"]
+        for packet in packets:
+            packet["time"] -= start
+    return packets
+
+
+def is_data(packet):
+    if packet["msg_type"] == EXT_MSG_TYPE:
+        return packet["flags"] in DATA_EXT
+    return packet["msg_type"] in DATA_TYPES
+
+
+# Function to name a data packet, so fragments of different messages and transfers with equal headers do not collide
+def packet_identity(packet):
+    body = packet["payload"][HEADER_SIZE:]
+    msg_type, current_fragment = packet["msg_type"], packet["current_fragment"]
+    if msg_type == 11:  # 2-byte text message ID in front of the text
+        return msg_type, body[:TEXT_PREFIX_SIZE], current_fragment
+    if msg_type == EXT_MSG_TYPE:
+        if packet["flags"] in (EXT_PARALLEL_OFFER, EXT_PARALLEL_PORTS, EXT_PARALLEL_DONE):
+            return msg_type, packet["flags"], body[:4], current_fragment  # transfer_id
+        return msg_type, packet["flags"], body, current_fragment  # Digest, delta request: the body is the identity
+    if msg_type == 8:
+        return msg_type, packet["flags"], body, current_fragment  # File name
+    return msg_type, packet["flags"], packet["total_fragments"], current_fragment
+
+
+# Function to note an outgoing data packet, so a later ACK can be traced back to it
+def note_sent(packet, identity, last_sent):
+    last_sent[packet_key(packet["payload"][0], packet["current_fragment"])] = identity
+    last_sent[b""] = identity  # ACKs without a key answer the latest packet
+
+
+# Function to find the data packet an incoming ACK/NACK answers: text ACKs name (message ID, fragment),
+# the others (first byte, fragment) after the "!H" window
+def ack_target(packet, last_sent):
+    key = packet["payload"][HEADER_SIZE + 2:] if packet["msg_type"] == 15 else b""
+    if len(key) == TEXT_PREFIX_SIZE + 2:
+        return 11, key[:TEXT_PREFIX_SIZE], int.from_bytes(key[TEXT_PREFIX_SIZE:], "big")
+    return last_sent.get(key)
+
+
+# Function to pair each data packet with its ACK (Karn: retransmitted packets give no sample)
+def rtt_samples(packets):
+    samples = []
+    sent = {}  # identity -> [first transmission time, transmissions]
+    last_sent = {}
+    for packet in packets:
+        if packet["direction"] == "out" and is_data(packet):
+            identity = packet_identity(packet)
+            if packet["msg_type"] == 8 and identity not in sent:  # A new file: its fragments reuse the numbers
+                sent = {other: entry for other, entry in sent.items() if other[0] != 6}
+            sent.setdefault(identity, [packet["time"], 0])[1] += 1
+            note_sent(packet, identity, last_sent)
+        elif packet["direction"] == "in" and packet["msg_type"] == 15:
+            entry = sent.pop(ack_target(packet, last_sent), None)
+            if entry is not None and entry[1] == 1:
+                samples.append(packet["time"] - entry[0])
+    return samples
+
+
+# Function to group retransmissions of the same packet that happen close to each other
+def retransmission_bursts(packets, window=1.0):
+    seen = set()
+    last_sent = {}
+    bursts = []
+    for packet in packets:
+        if packet["direction"] == "in" and packet["msg_type"] == 15:
+            seen.discard(ack_target(packet, last_sent))  # Sending it again later is a new packet
+            continue
+        if packet["direction"] != "out" or not is_data(packet):
+            continue
+        identity = packet_identity(packet)
+        note_sent(packet, identity, last_sent)
+        if identity not in seen:
+            if packet["msg_type"] == 8:  # A new file: its fragments reuse the numbers
+                seen = {other for other in seen if other[0] != 6}
+            seen.add(identity)
+            continue
+        if bursts and packet["time"] - bursts[-1]["end"] <= window:
+            bursts[-1]["end"] = packet["time"]
+            bursts[-1]["count"] += 1
+            bursts[-1]["fragments"].add(packet["current_fragment"])
+        else:
+            bursts.append({"start": packet["time"], "end": packet["time"], "count": 1,
+                           "fragments": {packet["current_fragment"]}})
+    return bursts
+
+
+def idle_gaps(packets, threshold):
+    return [(previous["time"], packet["time"] - previous["time"])
+            for previous, packet in zip(packets, packets[1:]) if packet["time"] - previous["time"] >= threshold]
+
+
+def summary(args):
+    packets = load_packets(args.capture, args.local and parse_address(args.local))
+    if not packets:
+        print("Empty capture")
+        return
+
+    print(f"{len(packets)} packets (bundles unpacked) over {packets[-1]['time']:.3f} s")
+    counts = {}
+    for packet in packets:
+        name = TYPE_NAMES.get(packet["msg_type"], str(packet["msg_type"]))
+        counts[(packet["direction"], name)] = counts.get((packet["direction"], name), 0) + 1
+    for (direction, name), count in sorted(counts.items()):
+        print(f"  {direction:<4}{name:<12}{count}")
+
+    samples = rtt_samples(packets)
+    if samples:
+        samples.sort()
+        print(f"RTT samples: {len(samples)}, min {samples[0] * 1000:.3f} ms, "
+              f"median {statistics.median(samples) * 1000:.3f} ms, "
+              f"p99 {samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000:.3f} ms, "
+              f"max {samples[-1] * 1000:.3f} ms")
+
+    bursts = retransmission_bursts(packets)
+    print(f"Retransmission bursts: {len(bursts)}")
+    for burst in bursts[:args.limit]:
+        print(f"  {burst['start']:.3f}-{burst['end']:.3f} s: {burst['count']} resends of "
+              f"{len(burst['fragments'])} fragments")
+
+    gaps = idle_gaps(packets, args.idle)
+    print(f"Idle gaps >= {args.idle} s: {len(gaps)}")
+    for start, length in gaps[:args.limit]:
+        print(f"  at {start:.3f} s for {length:.3f} s")
+
+
+# Function to write the time-sequence graph (CSV, or PNG when matplotlib is installed)
+def graph(args):
+    packets = load_packets(args.capture, args.local and parse_address(args.local))
+    if args.output.endswith(".png"):
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+        except ImportError:
+            print("matplotlib is not installed, write a .csv instead")
+            return
+        for direction, marker in (("out", "."), ("in", "x")):
+            selected = [p for p in packets if p["direction"] == direction]
+            plt.scatter([p["time"] for p in selected], [p["current_fragment"] for p in selected], s=4,
+                        marker=marker, label=direction)
+        plt.xlabel("time [s]")
+        plt.ylabel("fragment")
+        plt.legend()
+        plt.savefig(args.output, dpi=150)
+    else:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "direction", "type", "flags", "fragment", "total", "length"])
+            for p in packets:
+                writer.writerow([f"{p['time']:.9f}", p["direction"], TYPE_NAMES.get(p["msg_type"], p["msg_type"]),
+                                 p["flags"], p["current_fragment"], p["total_fragments"], p["length"]])
+    print(f"Time-sequence graph written to {args.output}")
+
+
+# Function to resend the outgoing side of a capture to a listener with the original timing
+def replay(args):
+    packets = [p for p in load_packets(args.capture, args.local and parse_address(args.local))
+               if p["direction"] == "out"]
+    target = parse_address(args.target)
+    replay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if args.source:
+        replay_socket.bind(parse_address(args.source))
+
+    starting_point = time.perf_counter()
+    for packet in packets:
+        delay = packet["time"] / args.speed - (time.perf_counter() - starting_point)
+        if delay > 0:
+            time.sleep(delay)
+        replay_socket.sendto(packet["payload"], target)
+    print(f"Replayed {len(packets)} datagrams in {time.perf_counter() - starting_point:.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze or replay captures made with main.py --capture")
+    parser.add_argument("--local", help="ip:port of the capturing side (default: source of the first datagram)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = commands.add_parser("summary", help="Packet counts, RTT, retransmission bursts, idle gaps")
+    summary_parser.add_argument("capture")
+    summary_parser.add_argument("--idle", type=float, default=0.5, help="Minimum idle gap in seconds")
+    summary_parser.add_argument("--limit", type=int, default=20, help="How many bursts/gaps to list")
+    summary_parser.set_defaults(handler=summary)
+
+    graph_parser = commands.add_parser("graph", help="Time-sequence graph as .csv or .png")
+    graph_parser.add_argument("capture")
+    graph_parser.add_argument("-o", "--output", default="sequence.csv")
+    graph_parser.set_defaults(handler=graph)
+
+    replay_parser = commands.add_parser("replay", help="Send the captured outgoing datagrams to a listener")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("--target", required=True, help="ip:port of the listener")
+    replay_parser.add_argument("--source", help="ip:port to send from (the listener expects its peer's port)")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier")
+    replay_parser.set_defaults(handler=replay)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import runtime
+
+# Blast režim: odosielateľ posiela fragmenty obmedzenou rýchlosťou bez čakania na ACK,
+# príjemca si značí medzery a občas pošle zoznam chýbajúcich rozsahov, ktoré sa dopošlú.
+
+MAX_BURST_TIME = 0.01  # Najviac 10 ms nevyužitej rýchlosti sa dá dobehnúť naraz
+MIN_SLEEP = 0.001  # Kratšie čakanie sa nahromadí, time.sleep nie je presnejší
+RATE_DECREASE = 0.75  # Príjemcovo jadro zahadzuje datagramy: rýchlosť klesne o štvrtinu
+RATE_INCREASE = 1.25  # ... a po RECOVERY_INTERVAL bez preťaženia zase rastie
+RECOVERY_INTERVAL = 0.5
+MIN_RATE = 64 * 1024  # B/s, pod túto rýchlosť blast neklesne
+
+
+class Pacer:
+    # Spaces out sends so that on average no more than rate bytes per second leave, 0 = unlimited.
+    # Time and sleep come from runtime, virtual when netsim.py drives main.py
+    def __init__(self, rate):
+        self.rate = rate
+        self.ceiling = rate  # Limit set by the user, 0 = none
+        self.next_send = runtime.perf_counter()
+        self.last_change = 0.0
+
+    def wait(self, size):
+        delay = self.reserve(size)
+        if delay:
+            runtime.sleep(delay)
+
+    # Function to account for size bytes, returns how long to wait before sending them
+    def reserve(self, size):
+        if not self.rate:
+            return 0.0
+        now = runtime.perf_counter()
+        if self.rate != self.ceiling and now - self.last_change >= RECOVERY_INTERVAL:
+            self.rate = min(self.rate * RATE_INCREASE, self.ceiling or float("inf"))
+            self.last_change = now
+        delay = self.next_send - now
+        self.next_send = max(self.next_send, now - MAX_BURST_TIME) + size / self.rate
+        return delay if delay >= MIN_SLEEP else 0.0
+
+    # Function to slow down on receiver overload, an unlimited pacer starts from the measured rate
+    def decrease(self, measured_rate):
+        self.rate = max(MIN_RATE, (self.rate or measured_rate) * RATE_DECREASE)
+        self.last_change = runtime.perf_counter()
+
+
+class GapTracker:
+    # Received fragments 1..total, reports the missing ones as compact (first, last) ranges
+    def __init__(self, total_fragments):
+        self.total_fragments = total_fragments
+        self.received = bytearray(total_fragments + 1)
+        self.received[0] = 1  # Fragments are numbered from 1
+        self.count = 0
+        self.highest = 0
+
+    def add(self, fragment):
+        if not 1 <= fragment <= self.total_fragments or self.received[fragment]:
+            return False
+        self.received[fragment] = 1
+        self.count += 1
+        self.highest = max(self.highest, fragment)
+        return True
+
+    @property
+    def complete(self):
+        return self.count == self.total_fragments
+
+    # Function to list missing ranges among fragments 1..up_to, at most limit of them
+    def missing_ranges(self, up_to=None, limit=None):
+        up_to = self.total_fragments if up_to is None else min(up_to, self.total_fragments)
+        ranges = []
+        first = self.received.find(0, 1, up_to + 1)
+        while first != -1 and (limit is None or len(ranges) < limit):
+            last = self.received.find(1, first, up_to + 1)
+            last = up_to if last == -1 else last - 1
+            ranges.append((first, last))
+            first = self.received.find(0, last + 1, up_to + 1)
+        return ranges
@@ -0,0 +1,120 @@
+import socket
+import struct
+import threading
+import time
+
+# Záznam všetkých datagramov do pcap súboru (LINKTYPE_RAW - IPv4 pakety), takže sa dá otvoriť aj vo Wiresharku.
+# IP/UDP hlavičky sa dopĺňajú zo známych adries, smer paketu je daný zdrojovou adresou.
+
+PCAP_MAGIC = 0xA1B23C4D  # Nanosekundové časové značky
+PCAP_GLOBAL_HEADER = struct.pack("<I H H i I I I", PCAP_MAGIC, 2, 4, 0, 0, 65535, 101)
+PCAP_RECORD_FORMAT = "<I I I I"  # sekundy, nanosekundy, uložená dĺžka, pôvodná dĺžka
+PCAP_RECORD_SIZE = struct.calcsize(PCAP_RECORD_FORMAT)
+
+IPV4_HEADER_FORMAT = "!B B H H H B B H 4s 4s"
+UDP_HEADER_FORMAT = "!H H H H"
+IP_UDP_HEADER_SIZE = struct.calcsize(IPV4_HEADER_FORMAT) + struct.calcsize(UDP_HEADER_FORMAT)
+
+WRITE_BUFFER_SIZE = 1 << 20
+FLUSH_INTERVAL = 1.0  # Pri páde programu sa stratí najviac posledná sekunda záznamu
+
+
+def _ip_checksum(header: bytes) -> int:
+    total = sum(struct.unpack("!10H", header))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _ipv4(host) -> bytes:
+    try:
+        return socket.inet_aton(host)
+    except OSError:
+        return socket.inet_aton(socket.gethostbyname(host))  # sendto also takes a hostname
+
+
+def _ip_udp_headers(src, dst, payload_length) -> bytes:
+    total_length = IP_UDP_HEADER_SIZE + payload_length
+    ip_header = struct.pack(IPV4_HEADER_FORMAT, 0x45, 0, total_length, 0, 0, 64, socket.IPPROTO_UDP, 0,
+                            _ipv4(src[0]), _ipv4(dst[0]))
+    ip_header = ip_header[:10] + struct.pack("!H", _ip_checksum(ip_header)) + ip_header[12:]
+    return ip_header + struct.pack(UDP_HEADER_FORMAT, src[1], dst[1], 8 + payload_length, 0)
+
+
+class CaptureWriter:
+    # Buffered pcap writer, safe to call from several threads
+    def __init__(self, path):
+        self.file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self.file.write(PCAP_GLOBAL_HEADER)
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def record(self, src, dst, payload):
+        timestamp = time.time_ns()
+        headers = _ip_udp_headers(src, dst, len(payload))
+        length = len(headers) + len(payload)
+        record = struct.pack(PCAP_RECORD_FORMAT, timestamp // 1_000_000_000, timestamp % 1_000_000_000,
+                             length, length)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(record)
+            self.file.write(headers)
+            self.file.write(payload)
+            if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class CapturingSocket:
+    # Wraps a UDP socket and records every datagram it sends or receives
+    def __init__(self, sock, writer):
+        self.sock = sock
+        self.writer = writer
+        self.local = sock.getsockname()
+
+    def sendto(self, data, address):
+        sent = self.sock.sendto(data, address)
+        self.writer.record(self.local, address, data)
+        return sent
+
+    def recvfrom(self, size):
+        data, address = self.sock.recvfrom(size)
+        self.writer.record(address, self.local, data)
+        return data, address
+
+    def recvmsg(self, size, ancsize=0):
+        data, ancdata, flags, address = self.sock.recvmsg(size, ancsize)
+        self.writer.record(address, self.local, data)
+        return data, ancdata, flags, address
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+# Function to read a capture, yields (timestamp, (src_ip, src_port), (dst_ip, dst_port), payload)
+def read_capture(path):
+    with open(path, "rb") as f:
+        global_header = f.read(len(PCAP_GLOBAL_HEADER))
+        magic = struct.unpack("<I", global_header[:4])[0]
+        if magic not in (PCAP_MAGIC, 0xA1B2C3D4):
+            raise ValueError(f"{path} is not a little-endian pcap file")
+        fraction = 1e-9 if magic == PCAP_MAGIC else 1e-6
+
+        while True:
+            record = f.read(PCAP_RECORD_SIZE)
+            if len(record) < PCAP_RECORD_SIZE:
+                return
+            seconds, fractional, length, _ = struct.unpack(PCAP_RECORD_FORMAT, record)
+            packet = f.read(length)
+            ip_header_length = (packet[0] & 0x0F) * 4
+            src_ip = socket.inet_ntoa(packet[12:16])
+            dst_ip = socket.inet_ntoa(packet[16:20])
+            src_port, dst_port = struct.unpack("!H H", packet[ip_header_length:ip_header_length + 4])
+            yield (seconds + fractional * fraction, (src_ip, src_port), (dst_ip, dst_port),
+                   packet[ip_header_length + 8:])
@@ -0,0 +1,195 @@
+import hashlib
+import itertools
+import os
+import struct
+import mmap
+
+# rsync-style delta: príjemca pošle podpisy blokov svojej starej kópie (slabý rolling checksum + silný hash),
+# odosielateľ pošle len literálne dáta a odkazy na bloky, ktoré už príjemca má.
+
+SIGNATURE_FORMAT = "!I 8s"  # weak rolling checksum, strong hash (skrátený BLAKE2b)
+SIGNATURE_SIZE = struct.calcsize(SIGNATURE_FORMAT)
+STRONG_HASH_SIZE = 8
+
+# Operácie v delta streame
+OP_BLOCKS = b"B"  # "!I I" - prvý blok a počet po sebe idúcich blokov zo starej kópie
+OP_LITERAL = b"L"  # "!I" dĺžka + literálne dáta
+OP_END = b"E"  # BLAKE2b odtlačok výsledného súboru
+
+MAX_LITERAL_CHUNK = 1024 * 1024
+RESULT_DIGEST_SIZE = 32
+
+
+def block_size_for(file_size: int) -> int:
+    # Ako rsync: ~sqrt(veľkosť), zaokrúhlené na 512 B v rozsahu 1 KiB .. 64 KiB
+    size = int(file_size ** 0.5) // 512 * 512
+    return min(max(size, 1024), 65536)
+
+
+def rolling_checksum(block) -> tuple:
+    a = sum(block) & 0xFFFF
+    b = sum(itertools.accumulate(block)) & 0xFFFF
+    return a, b
+
+
+def strong_hash(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=STRONG_HASH_SIZE).digest()
+
+
+# Function to compute signatures of all full blocks of an existing file
+def file_signatures(path: str, block_size: int) -> bytes:
+    signatures = bytearray()
+    try:
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if len(block) < block_size:
+                    break
+                a, b = rolling_checksum(block)
+                signatures += struct.pack(SIGNATURE_FORMAT, a | (b << 16), strong_hash(block))
+    except FileNotFoundError:
+        pass
+    return bytes(signatures)
+
+
+def parse_signatures(signatures: bytes) -> dict:
+    table = {}
+    for index, (weak, strong) in enumerate(struct.iter_unpack(SIGNATURE_FORMAT, signatures)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+# Function to write the delta of file f against the signatures into out, returns (literal_bytes, matched_blocks)
+def compute_delta(f, signatures: bytes, block_size: int, out):
+    table = parse_signatures(signatures)
+    result_digest = hashlib.blake2b(digest_size=RESULT_DIGEST_SIZE)
+    literal_bytes = 0
+    matched_blocks = 0
+    run_start = run_count = 0
+
+    def flush_blocks():
+        nonlocal run_count
+        if run_count:
+            out.write(OP_BLOCKS + struct.pack("!I I", run_start, run_count))
+            run_count = 0
+
+    def emit_literal(data):
+        nonlocal literal_bytes
+        if not data:
+            return
+        flush_blocks()
+        for i in range(0, len(data), MAX_LITERAL_CHUNK):
+            chunk = data[i:i + MAX_LITERAL_CHUNK]
+            out.write(OP_LITERAL + struct.pack("!I", len(chunk)))
+            out.write(chunk)
+        result_digest.update(data)
+        literal_bytes += len(data)
+
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        out.write(OP_END + result_digest.digest())
+        return 0, 0
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = literal_start = 0
+        if table and size >= block_size:
+            a, b = rolling_checksum(data[0:block_size])
+        while table and pos + block_size <= size:
+            candidates = table.get(a | (b << 16))
+            if candidates:
+                block = data[pos:pos + block_size]
+                index = candidates.get(strong_hash(block))
+                if index is not None:
+                    emit_literal(data[literal_start:pos])
+                    if run_count and run_start + run_count == index:
+                        run_count += 1
+                    else:
+                        flush_blocks()
+                        run_start, run_count = index, 1
+                    result_digest.update(block)
+                    matched_blocks += 1
+                    pos += block_size
+                    literal_start = pos
+                    if pos + block_size <= size:
+                        a, b = rolling_checksum(data[pos:pos + block_size])
+                    continue
+
+            # Roll the window by one byte
+            if pos + block_size < size:
+                old_byte = data[pos]
+                a = (a - old_byte + data[pos + block_size]) & 0xFFFF
+                b = (b - block_size * old_byte + a) & 0xFFFF
+            pos += 1
+
+        emit_literal(data[literal_start:size])
+
+    flush_blocks()
+    out.write(OP_END + result_digest.digest())
+    return literal_bytes, matched_blocks
+
+
+def _copy_range(src_fd, dst_fd, count, src_offset, dst_offset):
+    # copy_file_range nechá kopírovanie na kerneli, inak pread/pwrite
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+                if copied == 0:
+                    break
+                count -= copied
+                src_offset += copied
+                dst_offset += copied
+            if count == 0:
+                return
+        except OSError:
+            pass
+    while count > 0:
+        chunk = os.pread(src_fd, min(count, MAX_LITERAL_CHUNK), src_offset)
+        if not chunk:
+            raise ValueError("Delta references data beyond the end of the basis file")
+        os.pwrite(dst_fd, chunk, dst_offset)
+        count -= len(chunk)
+        src_offset += len(chunk)
+        dst_offset += len(chunk)
+
+
+# Function to rebuild a file from the basis and the delta stream, returns True when the result digest matches
+def apply_delta(basis_path: str, delta: bytes, block_size: int, output_path: str) -> bool:
+    result_digest = hashlib.blake2b(digest_size=RESULT_DIGEST_SIZE)
+    view = memoryview(delta)
+    pos = 0
+    out_offset = 0
+
+    with open(basis_path, "rb") as basis, open(output_path, "wb") as out:
+        basis_size = os.fstat(basis.fileno()).st_size
+        basis_map = mmap.mmap(basis.fileno(), 0, access=mmap.ACCESS_READ) if basis_size else b""
+        try:
+            while pos < len(view):
+                op = bytes(view[pos:pos + 1])
+                pos += 1
+                if op == OP_BLOCKS:
+                    first, count = struct.unpack_from("!I I", view, pos)
+                    pos += 8
+                    src_offset = first * block_size
+                    length = count * block_size
+                    if src_offset + length > basis_size:
+                        raise ValueError("Delta references data beyond the end of the basis file")
+                    result_digest.update(basis_map[src_offset:src_offset + length])
+                    _copy_range(basis.fileno(), out.fileno(), length, src_offset, out_offset)
+                    out_offset += length
+                elif op == OP_LITERAL:
+                    (length,) = struct.unpack_from("!I", view, pos)
+                    pos += 4
+                    chunk = view[pos:pos + length]
+                    pos += length
+                    result_digest.update(chunk)
+                    os.pwrite(out.fileno(), chunk, out_offset)
+                    out_offset += length
+                elif op == OP_END:
+                    return bytes(view[pos:pos + RESULT_DIGEST_SIZE]) == result_digest.digest()
+                else:
+                    raise ValueError(f"Unknown delta operation: {op!r}")
+        finally:
+            if basis_size:
+                basis_map.close()
+    return False
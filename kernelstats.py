@@ -0,0 +1,72 @@
+import os
+import socket
+import struct
+
+# Veľkosti socket bufferov podľa okna relácie a počet datagramov, ktoré zahodilo jadro pri plnom
+# prijímacom bufferi. Také straty znamenajú preťaženého príjemcu, nie stratu na ceste.
+
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)  # Linux, Python konštantu neexportuje
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33)  # Obíde net.core.rmem_max, len s CAP_NET_ADMIN
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32)
+SKB_OVERHEAD = 768  # Jadro účtuje každý datagram aj so sk_buff, nie len payload
+BUFFERED_WINDOWS = 4  # Koľko plných okien sa zmestí do bufferu (bundle, blast, oneskorený listener)
+OVERFLOW_CMSG_SPACE = socket.CMSG_SPACE(4) if hasattr(socket, "CMSG_SPACE") else 0
+PROC_UDP_FILES = ("/proc/net/udp", "/proc/net/udp6")
+
+
+# Function to compute the buffer size for a window of fragments
+def buffer_size(window, fragment_size):
+    return BUFFERED_WINDOWS * max(1, window) * (fragment_size + SKB_OVERHEAD)
+
+
+# Function to grow both socket buffers to at least size bytes, returns (rcvbuf, sndbuf) as the kernel reports them
+def size_buffers(sock, size):
+    actual = []
+    for option, force in ((socket.SO_RCVBUF, SO_RCVBUFFORCE), (socket.SO_SNDBUF, SO_SNDBUFFORCE)):
+        if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, size)
+                if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                    sock.setsockopt(socket.SOL_SOCKET, force, size)  # Capped by the sysctl maximum
+            except OSError:
+                pass  # Keep whatever the kernel allowed
+        actual.append(sock.getsockopt(socket.SOL_SOCKET, option))
+    return tuple(actual)
+
+
+# Function to ask for the drop counter as ancillary data of every received datagram, False when unsupported
+def enable_overflow_counter(sock):
+    if not OVERFLOW_CMSG_SPACE or not hasattr(sock, "recvmsg"):
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+    except OSError:
+        return False
+    return True
+
+
+# Function to read the cumulative SO_RXQ_OVFL count from recvmsg ancillary data, None if it is not there
+def overflow_count(ancdata):
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+            return struct.unpack("=I", data[:4])[0]
+    return None
+
+
+# Function to read the drops column of /proc/net/udp for this socket, None when not available
+def proc_drops(sock):
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, ValueError):
+        return None
+    for proc_file in PROC_UDP_FILES:
+        try:
+            with open(proc_file) as f:
+                next(f)  # Column names
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return int(fields[12])
+        except (OSError, StopIteration, ValueError):
+            continue
+    return None
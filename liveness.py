@@ -0,0 +1,39 @@
+import collections
+
+import runtime
+
+# Stav spojenia s konštantnou pamäťou: len čas posledného heartbeatu od každej strany
+# a kruhový zoznam posledných riadiacich správ. Zapisuje iba listener, čítať môže ktokoľvek bez zámku.
+
+MAX_PEERS = 16
+MAX_EVENTS = 256
+
+
+class LivenessTracker:
+    def __init__(self, max_peers=MAX_PEERS, max_events=MAX_EVENTS):
+        self.max_peers = max_peers
+        self.last_seen = {}  # address -> runtime.monotonic() of the latest heartbeat
+        self.events = collections.deque(maxlen=max_events)  # (time, msg_type, address), oldest fall out
+
+    def heartbeat(self, address, now=None):
+        now = runtime.monotonic() if now is None else now
+        if address not in self.last_seen and len(self.last_seen) >= self.max_peers:
+            del self.last_seen[min(self.last_seen, key=self.last_seen.get)]  # Forget the stalest peer
+        self.last_seen[address] = now
+
+    def event(self, msg_type, address, now=None):
+        self.events.append((runtime.monotonic() if now is None else now, msg_type, address))
+
+    def seen_since(self, address, since):
+        last = self.last_seen.get(address)
+        return last is not None and last > since
+
+    # Function to get seconds since the last heartbeat of a peer, None if it never sent one
+    def age(self, address, now=None):
+        last = self.last_seen.get(address)
+        if last is None:
+            return None
+        return (runtime.monotonic() if now is None else now) - last
+
+    def recent_events(self, count):
+        return list(self.events)[-count:]
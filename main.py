@@ -2,13 +2,65 @@ import socket
 import threading
 import argparse
 import struct
-import time
 import queue
 import os
+import codecs
+import sys
+import random
+import collections
+import contextlib
+import hashlib
+import tempfile
+import json
+import atexit
+import traceback
+import delta
+import capture
+import writebehind
+import scheduler
+import secure
+import profiling
+import blast
+import liveness
+import multipath
+import kernelstats
+import spool
+import teardown
+import textwindow
+import pack
+import runtime
+from protocol import (ACK_TIMEOUT, BLAST_MAX_TRAILERS, BLAST_REORDER_SLACK, BLAST_REPORT_INTERVAL,
+                      BLAST_TRAILER_TIMEOUT, DEFAULT_FRAGMENT_SIZE, HEADER_SIZE, HEARTBEAT_CHECKS, HEARTBEAT_INTERVAL,
+                      HEARTBEAT_MISSES, PACKET_KEY_SIZE, RESPONDER_WINDOW, TEXT_ACK_TIMEOUT, TEXT_PREFIX_FORMAT,
+                      TEXT_PREFIX_SIZE, TEXT_WINDOW, build_headers, crc16, packet_key, parse_header, set_msg_id,
+                      split_bundle, EXT_MSG_TYPE, EXT_FILE_DIGEST, EXT_DELTA_REQUEST, EXT_DELTA_SIGNATURE,
+                      EXT_PARALLEL_OFFER, EXT_PARALLEL_PORTS, EXT_PARALLEL_DONE, EXT_BLAST_NACK, EXT_BLAST_DONE,
+                      EXT_BUNDLE, EXT_RECEIVER_DROPS)
 # import crc16
 
-# Global message queue for communication between threads
-msg_queue = queue.Queue()
+# Last heartbeat per peer and a bounded ring of recent control messages, written only by the listener
+peer_liveness = liveness.LivenessTracker()
+# ACK/NACK prijaté listenerom pre odosielateľa čakajúceho v send_with_ack, zvlášť pre každý kanál
+CHANNEL_BULK = 0  # Súbory a ich riadiace rámce
+CHANNEL_TEXT = 1  # Textové správy
+ack_queues = {CHANNEL_BULK: runtime.Queue(), CHANNEL_TEXT: runtime.Queue()}
+TEXT_WAKEUP = (None, 0, b"")  # Nie je ACK, len zobudí text_sender pri novej správe
+# Prenosy súborov čakajúce na transfer_worker, aby sender() ostal voľný pre text
+transfer_jobs = runtime.Queue()
+# Latencie posledných textových správ (od odoslania po ACK posledného fragmentu)
+text_latencies = collections.deque(maxlen=1000)
+# Textové správy čakajúce na text_sender: (message_id, počet fragmentov, fragmenty, čas zadania)
+text_outbox = runtime.Queue()
+# Podpisy blokov od príjemcu pre prebiehajúci delta prenos
+delta_signature_queue = runtime.Queue()
+# Porty pridelené príjemcom pre paralelný prenos
+parallel_ports_queue = runtime.Queue()
+# Paralelné prenosy prijímané od druhej strany: transfer_id -> stav
+parallel_transfers = {}
+# Hlásenia príjemcu počas blast prenosu: ("nack", rozsahy) alebo ("done", odtlačok sedí)
+blast_report_queue = runtime.Queue()
+# (odtlačok, výsledok) posledného prijatého blast súboru, ak sa stratilo naše "done"
+last_blast_result = None
 
 # Default address to save files
 default_directory = os.getcwd()
@@ -19,44 +71,146 @@ parser.add_argument("--source", type=str)
 parser.add_argument("--destination", type=str)
 parser.add_argument("--src_port", type=int)
 parser.add_argument("--dest_port", type=int)
-args = parser.parse_args()
-
-# Local and remote address/port configuration
-LOCAL_IP = args.source
-LOCAL_PORT = args.src_port
-REMOTE_IP = args.destination
-REMOTE_PORT = args.dest_port
-
-# UDP socket creation (IPv4, Datagram)
-udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-udp_socket.settimeout(3)  # Set timeout for handshake
-udp_socket.bind((LOCAL_IP, LOCAL_PORT))
-
-
-def crc16(data: bytes, poly: int = 0x1021, init_value: int = 0xFFFF) -> int:
-    crc = init_value
-    for byte in data:
-        crc ^= (byte << 8)  # Align the byte with the high byte of CRC
-        for _ in range(8):  # Process each bit
-            if crc & 0x8000:  # If the highest bit is set
-                crc = (crc << 1) ^ poly  # XOR with the polynomial
-            else:
-                crc = crc << 1  # Just shift left
-            crc &= 0xFFFF  # Ensure CRC remains a 16-bit value
-    return crc
+parser.add_argument("--no-resume", action="store_true", help="Ignore the cached session and do a full handshake")
+parser.add_argument("--capture", type=str, help="Record every datagram to this pcap file (see analyzer.py)")
+parser.add_argument("--flush-bytes", type=int, default=writebehind.DEFAULT_FLUSH_BYTES,
+                    help="Write received data to disk once this many bytes are pending")
+parser.add_argument("--flush-ms", type=float, default=writebehind.DEFAULT_FLUSH_INTERVAL * 1000,
+                    help="Write received data to disk at the latest after this many ms")
+parser.add_argument("--no-fsync", action="store_true", help="Do not fsync received files when they complete")
+parser.add_argument("--encrypt", nargs="?", const="chacha20-poly1305", metavar="CIPHER",
+                    help="Require an encrypted session (chacha20-poly1305 or aes-256-gcm, needs cryptography)")
+parser.add_argument("--path", nargs=2, action="append", default=[], metavar=("LOCAL_IP", "REMOTE_IP[:PORT]"),
+                    help="Additional path for the session (repeatable), fragments are spread over all paths")
+parser.add_argument("--daemon", type=str, metavar="SPOOL_DIR",
+                    help="Run without a prompt, send every file put into SPOOL_DIR or queued over the job socket")
+parser.add_argument("--jobs", type=str, metavar="SOCKET",
+                    help=f"Unix socket for spool.py submit (default SPOOL_DIR/{spool.JOBS_SOCKET_NAME})")
+args = None
+
+# Our ephemeral key pair and the cipher agreed with the peer during the handshake
+key_exchange = None
+session_cipher = None
+peer_key_offer = None
+
+# Local and remote address/port configuration, set by configure()
+LOCAL_IP = LOCAL_PORT = REMOTE_IP = REMOTE_PORT = PEER_ADDRESS = None
+udp_socket = None
+capture_writer = None
+paths = None
+# Source addresses under which the peer's datagrams arrive, all of them are the same peer
+PEER_ADDRESSES = set()
+
+
+# Function to set up addresses and sockets from the parsed options. transport replaces the UDP socket
+# (netsim.py passes a simulated one with the same sendto/recvfrom/settimeout)
+def configure(options, transport=None):
+    global args, key_exchange, LOCAL_IP, LOCAL_PORT, REMOTE_IP, REMOTE_PORT, PEER_ADDRESS, udp_socket, \
+        capture_writer, paths, PEER_ADDRESSES, SUPPORTED_FEATURES
+    args = options
+    if args.encrypt and not secure.AVAILABLE:
+        print("[Secure] --encrypt needs the cryptography package (pip install cryptography)")
+        sys.exit(1)
+    key_exchange = secure.KeyExchange(args.encrypt) if args.encrypt else None
+    if args.encrypt:
+        SUPPORTED_FEATURES |= FEATURE_ENCRYPT
+
+    LOCAL_IP = args.source
+    LOCAL_PORT = args.src_port
+    REMOTE_IP = args.destination
+    REMOTE_PORT = args.dest_port
+    PEER_ADDRESS = (socket.gethostbyname(REMOTE_IP), REMOTE_PORT)  # As recvfrom reports it
+
+    # UDP socket creation (IPv4, Datagram)
+    if transport is None:
+        transport = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transport.settimeout(3)  # Set timeout for listener
+        transport.bind((LOCAL_IP, LOCAL_PORT))
+    udp_socket = transport
+
+    # Optional capture of all datagrams for offline analysis
+    if args.capture:
+        capture_writer = capture.CaptureWriter(args.capture)
+        atexit.register(capture_writer.close)
+        udp_socket = capture.CapturingSocket(udp_socket, capture_writer)
+
+    # Primary path plus the extra --path pairs, each with its own socket on LOCAL_PORT
+    paths = multipath.PathSet(multipath.Path(udp_socket, PEER_ADDRESS, f"{LOCAL_IP}->{REMOTE_IP}:{REMOTE_PORT}"))
+    for path_local, path_remote in args.path:
+        path_local, path_remote = multipath.parse_path(path_local, path_remote, REMOTE_PORT)
+        path_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        path_socket.setblocking(False)
+        path_socket.bind((path_local, LOCAL_PORT))
+        if args.capture:
+            path_socket = capture.CapturingSocket(path_socket, capture_writer)
+        paths.add(multipath.Path(path_socket, path_remote, f"{path_local}->{path_remote[0]}:{path_remote[1]}"))
+    PEER_ADDRESSES = {path.remote for path in paths.paths}
+    for path in paths.paths:
+        path.counts_overflow = kernelstats.enable_overflow_counter(path.socket)
+
+
+# Packets that travel in the clear (the key exchange itself), all others are sealed once a cipher is agreed.
+# The ACK of the handshake (and of the close) is sealed, it proves the peer derived the same keys.
+PLAINTEXT_TYPES = (1, 2)
+
+
+def seal_datagram(packet, cipher=None):
+    cipher = cipher or session_cipher
+    if cipher is None or packet[0] >> 4 in PLAINTEXT_TYPES:
+        return packet
+    return cipher.seal(packet)
+
+
+# Function to turn a received datagram into a plain packet, None when it must be dropped
+def open_datagram(data, cipher=None):
+    cipher = cipher or session_cipher
+    if not data:
+        return None
+    if secure.is_sealed(data):
+        packet = cipher.open(data) if cipher is not None else None
+        if packet is None:
+            print("[Secure] Dropped datagram that failed authentication")
+        return packet
+    if cipher is not None and data[0] >> 4 not in PLAINTEXT_TYPES:
+        return None  # Plaintext data in an encrypted session
+    return data
+
+
+def packet_intact(msg_type, body, crc, cipher=None):
+    if (cipher or session_cipher) is not None and msg_type not in PLAINTEXT_TYPES:
+        return True  # The AEAD tag replaces the CRC and was checked in open_datagram
+    return crc16(body) == crc
+
+
+# All datagrams after the handshake leave through one scheduler thread: control > text > bulk
+# Small packets (ACK, NACK, heartbeat, text) may share one bundle datagram, the limit is set after the handshake
+outbound = scheduler.OutboundScheduler(lambda packet, route: paths.sendto(seal_datagram(packet), route),
+                                       bundle=lambda packets: create_bundle(packets))
+
+
+# address None lets the path set pick a path, an address or a multipath.Path pins it.
+# flush=False tells the scheduler more small packets follow right away, so it may hold this one briefly.
+def send_datagram(packet, priority=scheduler.PRIORITY_CONTROL, address=None, flush=True):
+    coalesce = packet[0] >> 4 in (11, 13, 15) or packet[0] == 5 << 4  # Text, NACK, ACK, plain heartbeat
+    outbound.submit(packet, address, priority, coalesce, flush)
+
+# Default (and max) size of fragment, lowered to what the peer supports during handshake
+max_fragment_size = DEFAULT_FRAGMENT_SIZE
 
 
 # Globálne premenné pre správu ID
 last_send_id = 0
 last_recv_id = 0
+send_id_lock = threading.Lock()  # ID berú sender, transfer_worker, text_sender aj listener
 
 
 # Funkcia pre generovanie ID pre odosielané správy
 def generate_send_id():
     global last_send_id
-    last_send_id = (last_send_id + 1) % 256
-    # print(f"[ID Generation] last_send_id: {last_send_id}")  # Debug print
-    return last_send_id
+    with send_id_lock:
+        last_send_id = (last_send_id + 1) % 256
+        # print(f"[ID Generation] last_send_id: {last_send_id}")  # Debug print
+        return last_send_id
 
 
 def validate_recv_id(received_id):
@@ -77,6 +231,112 @@ def validate_recv_id(received_id):
     return True
 
 
+# Náhodný začiatok, aby sa ID po reštarte odosielateľa nezrazili s už doručenými
+last_text_message_id = random.randrange(65536)
+
+# Rozpracované prichádzajúce správy: message_id -> stav skladania
+incoming_text_messages = {}
+# Doručené správy podľa ID (1 = doručená), aby sa znovu poslaný fragment nevypísal dvakrát, nech príde akokoľvek
+# neskoro. ID idú dokola, preto doručenie správy zmaže značku o pol kruhu vpred: odosielateľ k tomu ID príde až
+# po 32768 ďalších správach, a tie už musia byť potvrdené (okno je menšie)
+completed_text_messages = bytearray(65536)
+
+
+# Funkcia pre generovanie ID textovej správy (spoločné pre všetky jej fragmenty)
+def generate_text_message_id():
+    global last_text_message_id
+    last_text_message_id = (last_text_message_id + 1) % 65536
+    return last_text_message_id
+
+
+# Default callback - prijatý text vypisuje priebežne, po kúskoch
+def print_text_chunk(message_id, text, is_first, is_last):
+    if is_first:
+        sys.stdout.write("[Listener] Received message: ")
+    sys.stdout.write(text)
+    if is_last:
+        sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
+# Callback, ktorému sa doručuje dekódovaný text správy ako stream
+text_message_callback = print_text_chunk
+
+
+# Function to place one text fragment and stream out everything that is now in order
+def receive_text_fragment(body, current_fragment, total_fragments):
+    if len(body) < TEXT_PREFIX_SIZE:
+        print("[Listener] Text fragment without message ID, ignored")
+        return
+
+    message_id = struct.unpack(TEXT_PREFIX_FORMAT, body[:TEXT_PREFIX_SIZE])[0]
+    state = incoming_text_messages.get(message_id)
+    if state is None:
+        if completed_text_messages[message_id]:
+            return  # Late duplicate of an already delivered message
+        state = {
+            "decoder": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+            "next_fragment": 1,
+            "pending": {},
+        }
+        incoming_text_messages[message_id] = state
+
+    # Duplicates (resent after a lost ACK) are dropped
+    if current_fragment < state["next_fragment"] or current_fragment in state["pending"]:
+        return
+    state["pending"][current_fragment] = body[TEXT_PREFIX_SIZE:]
+
+    # Decode the contiguous prefix; multi-byte characters split between fragments are kept by the decoder
+    while state["next_fragment"] in state["pending"]:
+        fragment_number = state["next_fragment"]
+        is_last = fragment_number == total_fragments
+        text = state["decoder"].decode(state["pending"].pop(fragment_number), final=is_last)
+        state["next_fragment"] += 1
+        text_message_callback(message_id, text, fragment_number == 1, is_last)
+        if is_last:
+            del incoming_text_messages[message_id]
+            completed_text_messages[message_id] = 1
+            completed_text_messages[(message_id + 32768) % 65536] = 0
+            break
+
+
+# Function to forget received text state when the peer restarts, its new message IDs start at a random point
+def reset_text_messages():
+    incoming_text_messages.clear()
+    completed_text_messages[:] = bytes(65536)
+
+
+PARALLEL_OFFER_FORMAT = "!I B H Q"  # transfer_id, workers, fragment size, file size
+PARALLEL_IDLE_LIMIT = 30  # Sekundy bez paketov, po ktorých worker prenos vzdá
+PARALLEL_LINGER = 1  # Ako dlho worker po dokončení ešte potvrdzuje duplikáty
+
+
+# Flags v správe s názvom súboru (typ 8) určujú, čo nesú nasledujúce fragmenty
+FILE_FLAG_DELTA = 0x1  # Fragmenty nesú delta stream, nie celý súbor
+FILE_FLAG_BLAST = 0x2  # Fragmenty sa nepotvrdzujú, chýbajúce sa hlásia cez EXT_BLAST_NACK
+FILE_FLAG_PACK = 0x4  # Fragmenty nesú balík malých súborov (pack.py), meno je cieľový adresár
+
+# Odtlačok súboru je dvojúrovňový Merkle strom: list = hash fragmentu, koreň = hash listov v poradí.
+# Fragmenty tak môžu prísť v ľubovoľnom poradí a súbor netreba po prenose čítať znova.
+FRAGMENT_LEAF_SIZE = 16
+FILE_DIGEST_SIZE = 32
+
+
+def fragment_leaf(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=FRAGMENT_LEAF_SIZE).digest()
+
+
+def new_file_digest():
+    return hashlib.blake2b(digest_size=FILE_DIGEST_SIZE)
+
+
+def file_root_digest(leaves) -> bytes:
+    digest = new_file_digest()
+    for leaf in leaves:
+        digest.update(leaf)
+    return digest.digest()
+
+
 # Function to create a message header
 def create_header(msg_type: int, flags: int, length: int, total_fragments: int, current_fragment: int, data: bytes) -> bytes:
     # Validate input parameters
@@ -105,72 +365,203 @@ def create_header(msg_type: int, flags: int, length: int, total_fragments: int,
     if errored:  # Add erroneous data if the error flag is set
         data = data + bytes("random text".encode("utf-8"))
 
-    crc = crc16(data)  # Calculate CRC for the data
+    if session_cipher is not None and msg_type not in PLAINTEXT_TYPES:
+        crc = 0  # Sealed packet, the AEAD tag protects it
+    else:
+        crc = crc16(data)  # Calculate CRC for the data
 
     # Pack all fields into a header structure
     return struct.pack(header_format, first_byte, length, msg_id, total_fragments, current_fragment, crc)
 
 
-# Function to parse a message header
-def parse_header(header: bytes):
-    # Define the format of the header
-    header_format = "!B H B H H H"
-    unpacked = struct.unpack(header_format, header)
-
-    # Extract message type and flags from the first byte
-    first_byte = unpacked[0]
-    msg_type = (first_byte >> 4) & 0xF
-    flags = first_byte & 0xF
-
-    # Return header fields as a dictionary
-    return {
-        "msg_type": msg_type,
-        "flags": flags,
-        "length": unpacked[1],
-        "msg_id": unpacked[2],
-        "total_fragments": unpacked[3],
-        "current_fragment": unpacked[4],
-        "crc": unpacked[5]
-    }
+# Function to pack several complete packets into one bundle datagram
+def create_bundle(packets):
+    body = b"".join(struct.pack("!H", len(packet)) + packet for packet in packets)
+    return create_header(EXT_MSG_TYPE, EXT_BUNDLE, len(body), len(packets), 1, body) + body
+
+
+# Parametre relácie, ktoré si strany vymenia v SYN / SYN-ACK
+SESSION_PARAMS_FORMAT = "!H H B 8s 8s"  # fragment size, window, features, nonce, session token
+SESSION_PARAMS_SIZE = struct.calcsize(SESSION_PARAMS_FORMAT)
+FLAG_RESUME = 0x1  # SYN / SYN-ACK obnovujúci reláciu z cache (0-RTT)
+
+RECEIVE_WINDOW = 64
+DROP_SAMPLE_INTERVAL = 0.1  # Ako často listener pozrie počítadlá zahodených datagramov
+OVERLOAD_HOLD = 0.5  # Po zahodení v jadre ostane okno zatvorené takto dlho
+# Posledný stav počítadla zahodených datagramov a do kedy je príjemca považovaný za preťaženého
+overload_state = {"drops": 0, "sampled_at": 0.0, "until": 0.0}
+FEATURE_DIGEST = 0x1
+FEATURE_DELTA = 0x2
+FEATURE_PARALLEL = 0x4
+FEATURE_ENCRYPT = 0x8  # SYN / SYN-ACK nesie aj X25519 kľúč, ďalej idú všetky pakety zašifrované
+FEATURE_BLAST = 0x10
+SUPPORTED_FEATURES = FEATURE_DIGEST | FEATURE_DELTA | FEATURE_PARALLEL | FEATURE_BLAST  # + FEATURE_ENCRYPT
+
+SEALED_FRAGMENT_SIZE = 1490 - secure.SEAL_OVERHEAD  # Sealed datagram still fits 1500 B
+HANDSHAKE_INITIAL_TIMEOUT = 0.1
+HANDSHAKE_MAX_TIMEOUT = 3
+
+SESSION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pks_sessions")
+
+# Náhodné číslo tohto behu programu; token relácie sa odvodí z oboch strán
+local_nonce = os.urandom(8)
+session = {"fragment_size": max_fragment_size, "window": 1, "features": 0, "token": b""}
+
+
+def session_cache_path():
+    return os.path.join(SESSION_CACHE_DIR, f"{LOCAL_IP}_{LOCAL_PORT}-{REMOTE_IP}_{REMOTE_PORT}.json")
+
+
+def load_cached_session():
+    try:
+        with open(session_cache_path()) as f:
+            cached = json.load(f)
+        cached["token"] = bytes.fromhex(cached["token"])
+        return cached
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached_session():
+    try:
+        os.makedirs(SESSION_CACHE_DIR, exist_ok=True)
+        with open(session_cache_path(), "w") as f:
+            json.dump(dict(session, token=session["token"].hex()), f)
+    except OSError as e:
+        print(f"[Handshake] Could not cache session: {e}")
+
+
+# Function to build a SYN / SYN-ACK carrying our session parameters
+def create_handshake_packet(msg_type, flags=0, token=b"\0" * 8):
+    body = struct.pack(SESSION_PARAMS_FORMAT, max_fragment_size, RECEIVE_WINDOW, SUPPORTED_FEATURES,
+                       local_nonce, token)
+    if key_exchange is not None:
+        body += key_exchange.offer()
+    return create_header(msg_type, flags, len(body), 1, 1, body) + body
+
+
+# Function to agree on session parameters from the peer's SYN / SYN-ACK body, False if we must refuse the peer
+def apply_session_params(body, token=None):
+    global max_fragment_size
+    if len(body) < SESSION_PARAMS_SIZE:
+        return key_exchange is None  # Peer without session parameters, keep defaults
+    fragment_size, window, features, peer_nonce, _ = struct.unpack(SESSION_PARAMS_FORMAT, body[:SESSION_PARAMS_SIZE])
+    if key_exchange is not None and not setup_session_cipher(features, peer_nonce, body[SESSION_PARAMS_SIZE:]):
+        return False
+    max_fragment_size = min(max_fragment_size, fragment_size)
+    session["fragment_size"] = max_fragment_size
+    session["window"] = min(RECEIVE_WINDOW, window)
+    session["features"] = SUPPORTED_FEATURES & features
+    # Both sides derive the same token from the two nonces, whichever SYN came first
+    session["token"] = token or hashlib.blake2b(b"".join(sorted((local_nonce, peer_nonce))), digest_size=8).digest()
+    store_cached_session()
+    return True
+
+
+# Function to derive the session keys from the peer's key exchange offer (only once per peer key)
+def setup_session_cipher(features, peer_nonce, offer):
+    global session_cipher, peer_key_offer, max_fragment_size
+    if not features & FEATURE_ENCRYPT or len(offer) < secure.KEY_EXCHANGE_SIZE:
+        print("[Secure] Peer does not support encryption, refusing a plaintext session")
+        return False
+    offer = offer[:secure.KEY_EXCHANGE_SIZE]
+    if offer != peer_key_offer and session_cipher is not None:
+        # Anyone can send a plaintext SYN, so keys agreed once are never replaced by one
+        print("[Secure] Ignored a plaintext key exchange with a different key in an established session")
+        return False
+    if offer != peer_key_offer:
+        try:
+            session_cipher = key_exchange.session_cipher(offer, b"".join(sorted((local_nonce, peer_nonce))))
+        except ValueError as e:
+            print(f"[Secure] {e}")
+            return False
+        peer_key_offer = offer
+        print(f"[Secure] Session encrypted with {session_cipher.name}")
+    max_fragment_size = min(max_fragment_size, SEALED_FRAGMENT_SIZE)
+    return True
+
+
+# Function to check whether a resume SYN carries the token we cached for this peer
+def valid_resume(body):
+    if len(body) < SESSION_PARAMS_SIZE or key_exchange is not None:
+        return False  # Encrypted sessions always exchange fresh keys
+    token = struct.unpack(SESSION_PARAMS_FORMAT, body[:SESSION_PARAMS_SIZE])[4]
+    cached = load_cached_session()
+    return cached is not None and cached["token"] == token
+
 
 # Function to perform a handshake
 def handshake():
+    global max_fragment_size
     print("[handshake] Connecting ...")
+    starting_point = runtime.time_now()
+
+    # 0-RTT: a known peer is resumed with the cached parameters, data can follow right away
+    cached = None if args.no_resume or args.encrypt else load_cached_session()
+    if cached is not None:
+        max_fragment_size = min(max_fragment_size, cached["fragment_size"])
+        session.update(cached, fragment_size=max_fragment_size)
+        udp_socket.sendto(create_handshake_packet(1, FLAG_RESUME, cached["token"]), PEER_ADDRESS)
+        print(f"[Handshake] Resumed cached session in {(runtime.time_now() - starting_point) * 1000:.1f} ms")
+        return True
+
+    # SYN goes out immediately and is retransmitted unchanged with exponential backoff
+    syn = create_handshake_packet(1)
+    udp_socket.sendto(syn, PEER_ADDRESS)
+    print(f"[Handshake] SYN sent")
+    timeout = HANDSHAKE_INITIAL_TIMEOUT
     syn_received = False
 
     while True:
+        udp_socket.settimeout(timeout)
         try:  # Attempt to receive SYN/SYN-ACK/ACK
             data, address = udp_socket.recvfrom(1500)  # Default size of socket
+            data = open_datagram(data)  # The final ACK is sealed in an encrypted session
+            if data is None or len(data) < 10:
+                continue
             header = data[:10]
             header_info = parse_header(header)
             msg_type = header_info["msg_type"]
+            body = data[10:]
+
+            # Peer resumes a session we also know, accept it without a full exchange
+            if msg_type == 1 and header_info["flags"] & FLAG_RESUME and valid_resume(body):
+                print("[Handshake] Resume SYN received")
+                session.update(load_cached_session())
+                max_fragment_size = min(max_fragment_size, session["fragment_size"])
+                udp_socket.sendto(create_handshake_packet(2, FLAG_RESUME, session["token"]), PEER_ADDRESS)
+                break
 
             # Handle SYN message
             if msg_type == 1 and not syn_received:
                 print("[Handshake] SYN received")
                 syn_received = True
-                header = create_header(2, 0, 0, 1, 1, b"")
-                udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+                if not apply_session_params(body):
+                    return False
+                udp_socket.sendto(create_handshake_packet(2), PEER_ADDRESS)
                 print(f"[Handshake] SYN-ACK sent")
                 continue
 
-            # Handle SYN-ACK message
-            elif msg_type == 2 and not syn_received:
+            # Handle SYN-ACK message (also when both sides sent SYN at the same time)
+            elif msg_type == 2:
                 print("[Handshake] SYN-ACK received")
+                if not apply_session_params(body):
+                    return False
                 header = create_header(3, 0, 0, 1, 1, b"")
-                udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+                udp_socket.sendto(seal_datagram(header), PEER_ADDRESS)
                 print(f"[Handshake] ACK sent")
-                return True
+                break
 
             # Handle ACK message
             elif msg_type == 3 and syn_received:
                 print("[Handshake] ACK received")
-                return True  # Handshake successful
+                break  # Handshake successful
 
         except socket.timeout:
-            # If timeout occurs, retry by sending SYN
-            header = create_header(1, 0, 0, 1, 1, b"")
-            udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+            # If timeout occurs, retry by sending the same SYN with a longer wait. A fresh ID each time: a peer
+            # already past its handshake drops a repeated ID as a duplicate and would never answer
+            timeout = min(timeout * 2, HANDSHAKE_MAX_TIMEOUT)
+            udp_socket.sendto(set_msg_id(syn, generate_send_id()), PEER_ADDRESS)
             print(f"[Handshake] SYN sent")
             syn_received = False
             continue
@@ -178,41 +569,141 @@ def handshake():
         except ConnectionResetError:
             continue
 
-        # Handshake failed
-        return False
+    udp_socket.settimeout(3)
+    print(f"[Handshake] Handshake took {(runtime.time_now() - starting_point) * 1000:.1f} ms, "
+          f"fragment size {max_fragment_size}B")
+    return True
 
-# Function to close the connection using a 3-way handshake
-def closing_handshake():
+
+# Function to answer handshake packets that arrive after we consider the session established
+def handle_late_handshake(msg_type, flags, body):
+    if msg_type == 1 and flags & FLAG_RESUME and valid_resume(body):
+        reset_text_messages()  # Peer restarted and resumed from its cache
+        send_datagram(create_handshake_packet(2, FLAG_RESUME, session["token"]))
+    elif msg_type == 1:  # Peer restarted or refused our resume, redo the exchange (same keys only, see above)
+        if apply_session_params(body):
+            print("[Handshake] Peer started a new session")
+            reset_text_messages()
+            send_datagram(create_handshake_packet(2))
+    elif msg_type == 2 and not flags & FLAG_RESUME:
+        if not apply_session_params(body):
+            return
+        header = create_header(3, 0, 0, 1, 1, b"")
+        send_datagram(header)
+
+
+DRAIN_TIMEOUT = 10.0  # Najdlhšie čakanie na dokončenie rozposlaných správ a súborov pred FIN
+
+# Stav ukončenia spojenia, udalosti mu odovzdáva listener, close() volá sender
+close_state = teardown.Teardown()
+close_lock = threading.Lock()
+connection_settled = runtime.Event()
+
+
+# Function to feed one event (a Teardown method) into the close state machine and send what it asks for
+def teardown_step(event, address=None):
     global end_connection
+    if address is None:
+        address = PEER_ADDRESS
+    with close_lock:
+        actions = event(runtime.monotonic())
+        settled = close_state.settled
+        closed = close_state.closed
+    for msg_type in actions or ():
+        send_datagram(create_header(msg_type, 0, 0, 1, 1, b""), address=address)
+    if settled:
+        connection_settled.set()
+    if closed:
+        end_connection = True
+
+
+# Function to wait until queued transfers, text messages and outgoing packets are gone, bounded by timeout
+def drain_outbound(timeout):
+    deadline = runtime.monotonic() + timeout
+    while runtime.monotonic() < deadline:
+        if not transfer_jobs.unfinished_tasks and not text_outbox.unfinished_tasks and not outbound.pending():
+            return True
+        runtime.sleep(0.01)
+    return False
+
+
+# Function to close the connection: drain, then FIN / FIN-ACK / ACK with resends and a hard deadline
+def closing_handshake():
     print("[Close] Initiating 3-way close handshake...")
-
-    # Step 1: Send FIN message
-    msg_type = 12  # FIN message type
-    header = create_header(msg_type, 0, 0, 1, 1, b"")
-    udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+    if not drain_outbound(DRAIN_TIMEOUT):
+        print(f"[Close] Data still in flight after {DRAIN_TIMEOUT:.0f} s, closing anyway")
+    teardown_step(close_state.close)
     print("[Close] FIN sent")
 
-    # Wait for FIN-ACK
-    while True:
-        try:
-            data, _ = udp_socket.recvfrom(1500)
-            header_info = parse_header(data[:10])
-            if header_info["msg_type"] == 14:  # FIN-ACK
-                print("[Close] FIN-ACK received")
-                break
-        except socket.timeout:
-            print("[Close] Resending FIN...")
-            udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+    # The listener may sit in a long recv, so this thread runs the resend timers of FIN-WAIT as well
+    while not connection_settled.is_set():
+        with close_lock:
+            wait = close_state.next_timer(runtime.monotonic())
+        if wait is None:
+            break
+        connection_settled.wait(wait)
+        teardown_step(close_state.poll)
+    elapsed = (close_state.closed_at or runtime.monotonic()) - close_state.started_at
+    if close_state.clean:
+        print(f"[Close] Connection closed successfully in {elapsed * 1000:.1f} ms")
+    else:
+        print(f"[Close] Peer did not confirm, connection closed after {elapsed:.1f} s")
+
+
+HEARTBEAT_PROBE = 0x1  # Heartbeat s flagom je sonda cesty, druhá strana ju vráti ako echo
+HEARTBEAT_ECHO = 0x2
 
-    # Step 2: Send ACK to complete handshake
-    msg_type = 3  # ACK message type
-    header = create_header(msg_type, 0, 0, 1, 1, b"")
-    udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
-    print("[Close] ACK sent")
 
-    # Connection closed
-    end_connection = True
-    print("[Close] Connection closed successfully")
+# Thread probing every path: RTT and loss set the path weights, a path without echoes is skipped
+def path_monitor():
+    alive = {path: True for path in paths.paths}
+    while not end_connection:
+        profiling.checkpoint()
+        now = runtime.monotonic()
+        for path in paths.paths:
+            body = path.next_probe(now)
+            header = create_header(5, HEARTBEAT_PROBE, len(body), 1, 1, body)
+            send_datagram(header + body, address=path)
+            if path.alive != alive[path]:
+                alive[path] = path.alive
+                print(f"[Path] {path.name} is {'up' if path.alive else 'down'}")
+        runtime.sleep(multipath.PROBE_INTERVAL)
+
+
+# Function to size the buffers of every path socket for the negotiated window, called after the handshake
+def size_socket_buffers():
+    size = kernelstats.buffer_size(session["window"], max_fragment_size)
+    for path in paths.paths:
+        path.buffers = kernelstats.size_buffers(path.socket, size)
+
+
+# Function to count datagrams the kernel dropped on our sockets because the listener did not drain them in time
+def kernel_drops():
+    total = 0
+    for path in paths.paths:
+        if not path.counts_overflow:
+            path.kernel_drops = kernelstats.proc_drops(path.socket) or 0
+        total += path.kernel_drops
+    return total
+
+
+# Function to tell receiver overload from path loss: True while our kernel has recently dropped datagrams
+def receiver_overloaded():
+    now = runtime.monotonic()
+    if now - overload_state["sampled_at"] >= DROP_SAMPLE_INTERVAL:
+        drops = kernel_drops()
+        if drops > overload_state["drops"]:
+            overload_state["until"] = now + OVERLOAD_HOLD
+        overload_state["drops"] = drops
+        overload_state["sampled_at"] = now
+    return now < overload_state["until"]
+
+
+def print_paths():
+    for path in paths.paths:
+        print(f"[Path] {path.name}: {'up' if path.alive else 'down'}, RTT {path.srtt * 1000:.2f} ms, "
+              f"loss {path.loss * 100:.0f} %, {path.sent} datagrams sent")
+
 
 # Function to maintain a keep-alive heartbeat between peers
 def keep_alive():
@@ -221,47 +712,52 @@ def keep_alive():
 
     if role == 1:  # Initiator of the heartbeat
         while not end_connection:
+            profiling.checkpoint()
             # Send a heartbeat message
+            sent_at = runtime.monotonic()
             header = create_header(5, 0, 0, 1, 1, b"")
-            udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+            send_datagram(header)
             # print("[Keep-alive] Sent heartbeat")
-            time.sleep(2)
+            runtime.sleep(HEARTBEAT_INTERVAL)
 
-            # Check for acknowledgment
+            # Check for acknowledgment (a heartbeat from the peer newer than ours)
             response_received = False
-            for _ in range(3):
-                time.sleep(1)
-                if not msg_queue.empty():
-                    msg_queue.get()
+            for _ in range(HEARTBEAT_CHECKS):
+                if peer_liveness.seen_since(PEER_ADDRESS, sent_at):
                     response_received = True
                     # print("[Keep-alive] Heartbeat received")
                     missed_heartbeats = 0
                     break
+                runtime.sleep(1)
 
             if not response_received:
                 missed_heartbeats += 1
                 # print(f"[Keep-alive] Missed heartbeat {missed_heartbeats}")
 
-            if missed_heartbeats >= 3:
+            if missed_heartbeats >= HEARTBEAT_MISSES:
                 print("[Keep-alive] Connection lost")
                 end_connection = True
                 break
 
-    else:  # Listener for heartbeat
+    else:  # Listener for heartbeat, answers each new heartbeat within a second
+        last_reply = window_start = runtime.monotonic()
         while not end_connection:
-            time.sleep(5)
-            if not msg_queue.empty():
-                msg_queue.get()
+            profiling.checkpoint()
+            runtime.sleep(1)
+            now = runtime.monotonic()
+            if peer_liveness.seen_since(PEER_ADDRESS, last_reply):
                 # print("[Keep-alive] Heartbeat received")
                 missed_heartbeats = 0
                 header = create_header(5, 0, 0, 1, 1, b"")
-                udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+                send_datagram(header)
+                last_reply = window_start = now
                 # print("[Keep-alive] Sent heartbeat")
-            else:
+            elif now - window_start >= RESPONDER_WINDOW:
                 missed_heartbeats += 1
+                window_start = now
                 # print(f"[Keep-alive] Missed heartbeat {missed_heartbeats}")
 
-            if missed_heartbeats >= 3:
+            if missed_heartbeats >= HEARTBEAT_MISSES:
                 print("[Keep-alive] Connection lost")
                 end_connection = True
                 break
@@ -271,118 +767,243 @@ def keep_alive():
 # Function to receive messages
 def listener():
     global end_connection, errored
-    file_name = "received file"
-    received_file = False
-
-    received_fragments = {}
-    received_text_fragments = {}
-    current_message_id = -1
+    incoming_file = None
+    last_file_result = None  # (digest, verified) of the last finished file, answers a resent trailer the same way
+    bundled_packets = collections.deque()  # Packets unpacked from a bundle, processed before the next recv
 
     while not end_connection:
+        profiling.checkpoint()
         try:
-            # Attempt to receive a message
-            data, address = udp_socket.recvfrom(1500)
-            header = data[:10]
-            body = data[10:]
+            span = profiling.span_begin()
+            if bundled_packets:
+                data = bundled_packets.popleft()  # Same address and path as the bundle itself
+            else:
+                # Attempt to receive a message
+                with close_lock:
+                    wait = close_state.next_timer(runtime.monotonic())
+                data, address, path = paths.recvfrom(1500, 3 if wait is None else min(3, wait))
+                profiling.span_end("recv", span)
+                span = profiling.span_begin()
+                data = open_datagram(data)
+            try:
+                if data is None or len(data) < 10:
+                    continue
+                header = data[:10]
+                body = data[10:]
 
-            # Parse the received header
-            header_info = parse_header(header)
+                # Parse the received header
+                header_info = parse_header(header)
+            finally:
+                profiling.span_end("parse", span)  # Dropped datagrams are counted too
             msg_type = header_info["msg_type"]
             current_fragment = header_info["current_fragment"]
             total_fragments = header_info["total_fragments"]
             received_crc = header_info["crc"]
             msg_id = header_info["msg_id"]
-
-            computed_crc = crc16(body)
+            channel = CHANNEL_TEXT if msg_type == 11 else CHANNEL_BULK  # Which of our ACK queues the peer waits on
 
             # print(f"message id: {msg_id}")
 
             # Handle various message types
+            if msg_type == 5 and header_info["flags"] == HEARTBEAT_PROBE:  # Path probe, echo it on the same path
+                if packet_intact(msg_type, body, received_crc):
+                    header = create_header(5, HEARTBEAT_ECHO, len(body), 1, 1, body)
+                    send_datagram(header + body, address=path)
+                continue
+
+            if msg_type == 5 and header_info["flags"] == HEARTBEAT_ECHO:  # Answer to our probe: RTT and loss
+                if packet_intact(msg_type, body, received_crc):
+                    path.echo_received(body, runtime.monotonic())
+                continue
+
             if msg_type == 5:  # Heartbeat message
-                msg_queue.put(data)
+                peer_liveness.heartbeat(PEER_ADDRESS if address in PEER_ADDRESSES else address)
+                continue
+
+            if msg_type == 15 or msg_type == 13:  # ACK / NACK for our sender, flags say which channel
+                window = struct.unpack("!H", body[:2])[0] if len(body) >= 2 else RECEIVE_WINDOW
+                ack_queues.get(header_info["flags"], ack_queues[CHANNEL_BULK]).put((msg_type, window, body[2:]))
+                continue
+
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_BUNDLE:  # Several small packets at once
+                if len(body) == header_info["length"] and packet_intact(msg_type, body, received_crc):
+                    bundled_packets.extend(split_bundle(body))
                 continue
 
             if not validate_recv_id(msg_id):
                 # Ak ID nie je validné, pošleme NACK
-                send_nack()
+                send_nack(channel)
                 continue
 
             # Validate data size
             expected_length = header_info["length"]
             if len(body) != expected_length:
                 print(f"[Listener] Data length mismatch: expected {expected_length}, received {len(body)}")
-                send_nack()
+                send_nack(channel)
                 continue
 
-            # print(f"RECEIVED: {received_crc}, COMPUTED: {computed_crc}")
-
-            if received_crc != computed_crc:
+            span = profiling.span_begin()
+            intact = packet_intact(msg_type, body, received_crc)
+            profiling.span_end("crc", span)
+            if not intact:
                 print(f"[Listener] CRC mismatch for fragment {current_fragment}, sending NACK")
                 errored = False
-                send_nack()
+                send_nack(channel)
+                continue
+
+            if msg_type in (1, 2, 3) and close_state.state == teardown.OPEN:  # Handshake packets after the session is up
+                peer_liveness.event(msg_type, address)
+                handle_late_handshake(msg_type, header_info["flags"], body)
                 continue
 
             if msg_type == 12:  # FIN message
-                print("[Listener] FIN received, sending FIN-ACK...")
-                # Send FIN-ACK
-                msg_type = 14  # FIN-ACK message type
-                header = create_header(msg_type, 0, 0, 1, 1, b"")
-                udp_socket.sendto(header, address)
-
-                # Waiting for syn
-                while True:
-                    try:
-                        ack_data, _ = udp_socket.recvfrom(1500)
-                        ack_header_info = parse_header(ack_data[:10])
-                        if ack_header_info["msg_type"] == 3:  # ACK received
-                            print("[Listener] ACK received, connection closed")
-                            end_connection = True
-                            break
-                    except socket.timeout:
-                        print("[Listener] Resending FIN-ACK...")
-                        udp_socket.sendto(header, address)
+                peer_liveness.event(msg_type, address)
+                if close_state.state == teardown.OPEN:
+                    print("[Listener] FIN received, sending FIN-ACK...")
+                teardown_step(close_state.on_fin, address)
+                continue
+
+            if msg_type == 14:  # FIN-ACK to our FIN
+                teardown_step(close_state.on_fin_ack, address)
+                continue
+
+            if msg_type == 3 and close_state.state == teardown.CLOSE_WAIT:  # Last ACK of the close
+                teardown_step(close_state.on_ack, address)
+                if close_state.clean:
+                    print(f"[Listener] ACK received, connection closed "
+                          f"in {(close_state.closed_at - close_state.started_at) * 1000:.1f} ms")
+                continue
 
             if msg_type == 8:  # File name received
-                file_name = body.decode('utf-8')
-                print(f"[Listener] Received file name: {file_name}")
+                if incoming_file is not None:
+                    abort_incoming_file(incoming_file)  # Previous transfer never finished
+                incoming_file = open_incoming_file(header_info["flags"], body)
+                if incoming_file is None:
+                    send_refusal(data[0], current_fragment, channel)  # Sender gives up instead of sending into nothing
+                else:
+                    send_ack(channel=channel, key=packet_key(data[0], current_fragment))
                 continue
 
-            if msg_type == 6:  # Receiving file in fragments
-                # print(f"[Listener] Received and ACK sent for fragment {current_fragment}/{total_fragments}")
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_DELTA_REQUEST:  # Peer wants our signatures
+                send_ack(channel=channel, key=packet_key(data[0], current_fragment))
+                block_size = struct.unpack("!I", body[:4])[0]
+                requested_name = os.path.basename(body[4:].decode('utf-8'))
+                runtime.Thread(target=send_delta_signatures, args=(requested_name, block_size), daemon=True).start()
+                continue
 
-                received_fragments[current_fragment] = body
-                print(f"[Listener] Received fragment {current_fragment}/{total_fragments}")
-                send_ack()
-                if current_fragment == total_fragments and not received_file:
-                    current_file_data = b''.join(received_fragments[i] for i in range(1, total_fragments + 1))
-                    save_received_file(file_name, current_file_data)
-                    received_fragments = {}
-                    print("[Listener] Received complete file and saved.")
-                    received_file = True
-                    # Handle complete file
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_DELTA_SIGNATURE:  # Signatures for our delta send
+                delta_signature_queue.put((current_fragment, total_fragments, body))
                 continue
 
-            received_file = False
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_PARALLEL_OFFER:  # Peer starts a sharded send
+                send_ack(channel=channel, key=packet_key(data[0], current_fragment))
+                offer_size = struct.calcsize(PARALLEL_OFFER_FORMAT)
+                transfer_id, workers, fragment_size, file_size = struct.unpack(PARALLEL_OFFER_FORMAT, body[:offer_size])
+                transfer = parallel_transfers.get(transfer_id)
+                if transfer is None:
+                    transfer = {"ports": None, "root": None, "done": runtime.Event()}
+                    parallel_transfers[transfer_id] = transfer
+                    parallel_file_name = os.path.basename(body[offer_size:].decode('utf-8'))
+                    runtime.Thread(target=receive_file_parallel, daemon=True,
+                                     args=(transfer_id, parallel_file_name, file_size, fragment_size, workers)).start()
+                elif transfer["ports"] is not None:
+                    send_parallel_ports(transfer_id, transfer["ports"])
+                continue
 
-            if msg_type == 11:  # Receiving text message
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_PARALLEL_PORTS:  # Ports for our sharded send
+                parallel_ports_queue.put(body)
+                continue
 
-                # if msg_id != current_message_id:
-                #     received_text_fragments = {}
-                #     current_message_id = msg_id
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_BLAST_NACK:  # Gaps in our blast send
+                blast_report_queue.put(("nack", list(struct.iter_unpack("!H H", body[:len(body) // 4 * 4]))))
+                continue
 
-                send_ack()
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_RECEIVER_DROPS:  # Receiver's kernel overflows
+                if len(body) >= 4:
+                    blast_report_queue.put(("drops", struct.unpack("!I", body[:4])[0]))
+                continue
+
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_BLAST_DONE:  # Our blast send is complete
+                blast_report_queue.put(("done", body[:1] == b"\x01"))
+                continue
+
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_PARALLEL_DONE:  # Sharded send finished
+                send_ack(channel=channel, key=packet_key(data[0], current_fragment))
+                transfer = parallel_transfers.get(struct.unpack("!I", body[:4])[0])
+                if transfer is not None:
+                    transfer["root"] = body[4:]
+                    transfer["done"].set()
+                continue
+
+            if msg_type == 6:  # Receiving file in fragments
                 # print(f"[Listener] Received and ACK sent for fragment {current_fragment}/{total_fragments}")
 
-                received_text_fragments[current_fragment] = body.decode("utf-8")
-                # print(received_text_fragments)
-                if current_fragment == total_fragments:
-                    complete_message = ""
-                    for i in range(1, total_fragments + 1):
-                        if i in received_text_fragments:
-                            complete_message += received_text_fragments[i]
+                span = profiling.span_begin()
+                if incoming_file is not None and current_fragment not in incoming_file["leaves"]:
+                    # Data goes to the write-behind thread, the ACK does not wait for the disk
+                    offset = (current_fragment - 1) * incoming_file["fragment_size"]
+                    try:
+                        incoming_file["writer"].submit(offset, body)
+                    except OSError as e:  # Earlier write failed (disk full, I/O error)
+                        print(f"[Error] Could not save file {incoming_file['name']}: {e}, transfer refused")
+                        abort_incoming_file(incoming_file)
+                        incoming_file = None
+                    else:
+                        incoming_file["leaves"][current_fragment] = fragment_leaf(body)
+                        incoming_file["last_fragment_time"] = runtime.time_now()
+                        print(f"[Listener] Received fragment {current_fragment}/{total_fragments}")
+                profiling.span_end("reassembly", span)
+                if incoming_file is None:
+                    send_refusal(data[0], current_fragment, channel)  # No file to write into
+                    continue
+                if incoming_file["flags"] & FILE_FLAG_BLAST:
+                    report_blast_gaps(incoming_file, total_fragments, current_fragment)  # No per-fragment ACK
+                    continue
+                send_ack(receive_window(incoming_file), channel, packet_key(data[0], current_fragment))
+                continue
+
+            if (msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_FILE_DIGEST
+                    and is_blast_trailer(incoming_file, body)):  # End of a blast send: repair or confirm
+                incoming_file = finish_blast_file(incoming_file, body, total_fragments)
+                continue
 
-                    print(f"[Listener] Received message: {complete_message}")
-                    received_text_fragments = {}
+            # Whole-file digest trailer, the ACK confirms the file, a refusal tells the sender it was discarded
+            if msg_type == EXT_MSG_TYPE and header_info["flags"] == EXT_FILE_DIGEST:
+                if incoming_file is not None:
+                    leaves = incoming_file["leaves"]
+                    missing = [i for i in range(1, total_fragments + 1) if i not in leaves]
+                    verified = False
+                    if missing:
+                        print(f"[Listener] File {incoming_file['name']} incomplete, {len(missing)} fragments missing, "
+                              f"file discarded")
+                        abort_incoming_file(incoming_file)
+                    elif file_root_digest(leaves[i] for i in range(1, total_fragments + 1)) != body:
+                        print(f"[Listener] File digest mismatch for {incoming_file['name']}, file discarded")
+                        abort_incoming_file(incoming_file)
+                    else:
+                        verified = True
+                        runtime.Thread(target=finalize_incoming_file, args=(incoming_file,), daemon=True).start()
+                    last_file_result = (bytes(body), verified)
+                    incoming_file = None
+                # A trailer resent after the file was finished gets the same answer as the first one
+                if last_file_result is not None and last_file_result[0] == body and not last_file_result[1]:
+                    send_refusal(data[0], current_fragment, channel)
+                else:
+                    send_ack(channel=channel, key=packet_key(data[0], current_fragment))
+                continue
+
+            if msg_type == 10:  # Error reported by the peer
+                peer_liveness.event(msg_type, address)
+                if len(body) >= PACKET_KEY_SIZE:  # Peer refused the packet our sender waits for
+                    ack_queues.get(header_info["flags"], ack_queues[CHANNEL_BULK]).put((msg_type, 0, body))
+                    continue
+                print("[Listener] Peer reported an error with the last transfer")
+                continue
+
+            if msg_type == 11:  # Receiving text message, the ACK names the fragment (text is pipelined)
+                send_ack(channel=channel, key=body[:TEXT_PREFIX_SIZE] + struct.pack("!H", current_fragment),
+                         flush=not bundled_packets)
+                receive_text_fragment(body, current_fragment, total_fragments)
                 continue
 
             if msg_type == 7:  # End connection
@@ -390,41 +1011,32 @@ def listener():
                 end_connection = True
                 break
 
-            # if msg_type == 11:  # Receiving text message
-            #     send_ack()
-            #
-            #     received_text_fragments[current_fragment] = body.decode("utf-8")
-            #     print(f"[Listener] Received fragment {current_fragment}/{total_fragments}")
-            #
-            #     if len(received_text_fragments) >= (total_fragments + 1) // 2:
-            #         complete_message = ""
-            #         missing_fragments = []
-            #
-            #         for i in range(1, total_fragments + 1):
-            #             if i in received_text_fragments:
-            #                 complete_message += received_text_fragments[i]
-            #
-            #         print(f"[Listener] Received message: {complete_message}")
-            #         received_text_fragments = {}
-            #     continue
-
         except ConnectionResetError:
             # print("[Listener] Connection on the other side lost")
             continue
 
         except socket.timeout:
-            continue
+            pass
+        finally:
+            state_before = close_state.state
+            if state_before != teardown.OPEN:
+                teardown_step(close_state.poll)  # Resends and deadlines of the close, even while packets flow
+                if state_before == teardown.CLOSE_WAIT and close_state.closed and not close_state.clean:
+                    print("[Listener] Peer did not send the last ACK, connection closed at the deadline")
 
 
 end_connection = False
 
+# Zdroj príkazov pre sender(), netsim.py ho nahradí frontom príkazov od simulovaného používateľa
+read_command = input
+
 errored = False
 def sender():
-    max_fragment_size = 1490  # Default (and max) size of fragment
-    global end_connection, errored, default_directory
+    global end_connection, errored, default_directory, max_fragment_size
     while not end_connection:
+        profiling.checkpoint()
         try:
-            message = input(f"[Sender] Type message (/help):\n")
+            message = read_command(f"[Sender] Type message (/help):\n")
 
             # HELP MENU
             if message == "/help":
@@ -435,6 +1047,15 @@ def sender():
                     ("/help", "Zobrazí toto menu."),
                     ("/end", "Ukončie programu."),
                     ("/file <path>", "Odošle súbor na zadanú cestu."),
+                    ("/pfile n <path>", "Odošle súbor paralelne cez n procesov/socketov."),
+                    ("/blast <Mbit/s> <path>", "Odošle súbor bez ACK po fragmentoch danou rýchlosťou (0 = bez limitu)."),
+                    ("/paths", "Vypíše cesty relácie s RTT, stratou a počtom paketov."),
+                    ("/status", "Vypíše stav spojenia a posledné riadiace správy."),
+                    ("/latency", "Vypíše p50/p99 latenciu textových správ."),
+                    ("/profile start", "Zapne profilovanie všetkých vlákien a meranie spanov."),
+                    ("/profile stop <file>", "Vypne profilovanie, uloží pstats a <file>.speedscope.json."),
+                    ("/delta <path>", "Odošle len zmenené bloky súboru, ktorý už druhá strana má."),
+                    ("/pack <dir>", "Odošle všetky súbory adresára zabalené do jedného prenosu."),
                     ("/error", "Vynúti chybu pre nasledujúci packet."),
                     ("/max <size>", "Nastaví maximálnu veľkosť fragmentu."),
                     ("/end fr", "Ukončí spojenia cez 3-w hs."),
@@ -442,7 +1063,7 @@ def sender():
                 ]
 
                 for command, description in commands:
-                    print(f"{command: <15} - {description}")
+                    print(f"{command: <24} - {description}")
 
                 print("=" * 60)
                 continue
@@ -477,14 +1098,66 @@ def sender():
 
             # Handle changing fragment size
             if message[:4] == "/max":
-                max_fragment_size = int(message[4:])
+                # Not above what the handshake agreed (peer's limit, room for the seal of an encrypted session)
+                max_fragment_size = max(1, min(int(message[4:]), session["fragment_size"]))
                 print(f"[Sender] Max size of fragment set to: {max_fragment_size} B")
                 continue
 
             # Check if it's a command to send a file
             if message[:5] == "/file":
                 command, file_path = message.split(" ", 1)
-                send_file(file_path, max_fragment_size)
+                transfer_jobs.put((send_file, (file_path, max_fragment_size)))
+                continue
+
+            # Send a file in shards over several sockets/processes
+            if message[:6] == "/pfile":
+                command, workers, file_path = message.split(" ", 2)
+                transfer_jobs.put((send_file_parallel, (file_path, int(workers), max_fragment_size)))
+                continue
+
+            # Send a file without per-fragment ACKs at a fixed rate, lost fragments are repaired at the end
+            if message[:6] == "/blast":
+                command, rate, file_path = message.split(" ", 2)
+                transfer_jobs.put((send_file_blast, (file_path, float(rate), max_fragment_size)))
+                continue
+
+            # Send only the changed blocks of a file the receiver already has
+            if message[:6] == "/delta":
+                command, file_path = message.split(" ", 1)
+                transfer_jobs.put((send_delta_file, (file_path, max_fragment_size)))
+                continue
+
+            # Send a directory of small files as one packed stream
+            if message[:5] == "/pack":
+                command, directory = message.split(" ", 1)
+                transfer_jobs.put((send_pack, (directory, max_fragment_size)))
+                continue
+
+            if message == "/paths":
+                print_paths()
+                continue
+
+            if message == "/status":
+                print_connection_status()
+                continue
+
+            if message == "/latency":
+                print_text_latency()
+                continue
+
+            # Runtime profiling of all threads (pstats for snakeviz, span timeline for speedscope)
+            if message.startswith("/profile"):
+                command_parts = message.split(" ", 2)
+                if command_parts[1:2] == ["start"]:
+                    profiling.start()
+                    print("[Profile] Profiling started")
+                elif command_parts[1:2] == ["stop"] and profiling.active:
+                    path = command_parts[2] if len(command_parts) > 2 else "profile.pstats"
+                    for line in profiling.stop(path):
+                        print(f"[Profile] {line}")
+                    print(f"[Profile] Saved {path} and {path}.speedscope.json")
+                else:
+                    print("[Profile] Usage: /profile start | /profile stop <file>")
                 continue
 
             # Handle normal text messages (not a file)
@@ -497,160 +1170,931 @@ def sender():
 def send_end_message():
     msg_type = 7  # msg type is 0111 (End Connection)
     header = create_header(msg_type, 0, 0, 1, 1, b"")
-    udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+    send_datagram(header)
 
 
-def send_ack():
+def send_ack(window=RECEIVE_WINDOW, channel=CHANNEL_BULK, key=b"", flush=True):
     msg_type = 15
-    header = create_header(msg_type, 0, 0, 1, 1, b"")
-    udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+    body = struct.pack("!H", window) + key  # Advertised receive window in fragments, then what is acknowledged
+    header = create_header(msg_type, channel, len(body), 1, 1, body)
+    send_datagram(header + body, flush=flush)
 
 
-def send_nack():
+def send_nack(channel=CHANNEL_BULK):
     msg_type = 13
-    header = create_header(msg_type, 0, 0, 1, 1, b"")
-    udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+    header = create_header(msg_type, channel, 0, 1, 1, b"")
+    send_datagram(header)
 
 
 def send_error_message():
     msg_type = 10
     header = create_header(msg_type, 0, 0, 1, 1, b"")
-    udp_socket.sendto(header, (REMOTE_IP, REMOTE_PORT))
+    send_datagram(header)
+
+
+# Function to refuse a packet we cannot take (no file open, disk error), the sender stops instead of retrying.
+# The body names the refused packet, so a late refusal is not taken for a later one.
+def send_refusal(first_byte, current_fragment, channel=CHANNEL_BULK):
+    msg_type = 10
+    body = packet_key(first_byte, current_fragment)
+    header = create_header(msg_type, channel, len(body), 1, 1, body)
+    send_datagram(header + body)
+
+# Function to send one packet and wait until the peer ACKs it (stop-and-wait), returns the advertised window
+def send_with_ack(msg_type, flags, data, total_fragments, current_fragment, timeout,
+                  priority=scheduler.PRIORITY_BULK, channel=CHANNEL_BULK, header=None):
+    global errored
+    ack_queue = ack_queues[channel]
+    # Zahodíme oneskorené potvrdenia predchádzajúcich paketov
+    while not ack_queue.empty():
+        ack_queue.get_nowait()
+
+    prebuilt_header = header
+    key_wanted = packet_key((msg_type << 4) | flags, current_fragment)
+    while True:
+        profiling.checkpoint()
+        if prebuilt_header is not None and not errored:
+            header = set_msg_id(prebuilt_header, generate_send_id())  # Every (re)transmission gets a new msg_id
+        else:
+            header = create_header(msg_type, flags, len(data), total_fragments, current_fragment, data)
+        send_datagram(header + data, priority)
+
+        # Wait for ACK or NACK (listener forwards them, only it reads the socket). An ACK naming another packet
+        # is a late one for a resent earlier packet, it is skipped; ACKs without a key come from older peers.
+        deadline = runtime.monotonic() + timeout
+        while True:
+            try:
+                ack_type, window, key = ack_queue.get(timeout=max(0.0, deadline - runtime.monotonic()))
+            except queue.Empty:
+                break  # Resend on timeout
+            if ack_type == 10 and key[:PACKET_KEY_SIZE] == key_wanted:
+                raise IOError("Receiver refused the transfer")
+            if ack_type == 15 and (not key or key[:PACKET_KEY_SIZE] == key_wanted):  # ACK2
+                return window
+            if ack_type == 13:  # NACK
+                errored = False
+                break  # Resend
+
+
+WINDOW_PROBE_DELAY = 0.02  # Pauza pred ďalším fragmentom, keď príjemca ohlási nulové okno
+
+PREFETCH_BLOCK_SIZE = 1024 * 1024  # Veľkosť jedného čítania z disku (zarovnaná na celé fragmenty)
+PREFETCH_DEPTH = 8  # Počet blokov pripravených dopredu, obmedzuje pamäť na DEPTH * BLOCK_SIZE
+
+
+def fadvise(fd, offset, length, advice_name):
+    # posix_fadvise is only a hint and exists only on some platforms
+    if fd is not None and hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+        except OSError:
+            pass
+
+
+# Function to hand an item to the consumer, gives up once the consumer has stopped taking them
+def put_until_stopped(ready, item, stop):
+    while not stop.is_set():
+        try:
+            ready.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+
+# Producer thread: reads large blocks ahead, splits them into fragments and hashes them
+def prefetch_producer(f, fragment_size, total_fragments, ready, stop):
+    try:
+        block_size = max(1, PREFETCH_BLOCK_SIZE // fragment_size) * fragment_size
+        fd = f.fileno() if hasattr(f, "fileno") else None  # pack.PackReader has no single fd
+        offset = f.tell()
+        fadvise(fd, offset, 0, "POSIX_FADV_SEQUENTIAL")
+        current_fragment = 1
+        while current_fragment <= total_fragments and not stop.is_set():
+            profiling.checkpoint()
+            fadvise(fd, offset + block_size, block_size, "POSIX_FADV_WILLNEED")
+            block = memoryview(f.read(block_size))
+            offset += len(block)
+            # Headers (and CRCs) of the whole block are built in one batch
+            headers = build_headers(6, 0, block, fragment_size, total_fragments, current_fragment,
+                                    with_crc=session_cipher is None)
+            fragments = []
+            for i, start in enumerate(range(0, len(block), fragment_size)):
+                fragment_data = bytes(block[start:start + fragment_size])
+                fragments.append((current_fragment, fragment_data, fragment_leaf(fragment_data),
+                                  headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]))
+                current_fragment += 1
+            if not fragments:
+                raise IOError("File ended before all fragments were read")
+            put_until_stopped(ready, fragments, stop)
+        put_until_stopped(ready, None, stop)
+    except Exception as e:
+        put_until_stopped(ready, e, stop)
+
+
+# Function to iterate (fragment number, data, leaf, header) of a file, read ahead by a producer thread.
+# Use it with contextlib.closing: the producer is joined on close, before the caller closes f
+def prefetch_fragments(f, fragment_size, total_fragments):
+    ready = runtime.Queue(maxsize=PREFETCH_DEPTH)
+    stop = runtime.Event()
+    producer = runtime.Thread(target=prefetch_producer, args=(f, fragment_size, total_fragments, ready, stop),
+                                daemon=True)
+    producer.start()
+    try:
+        while True:
+            fragments = ready.get()
+            if fragments is None:
+                return
+            if isinstance(fragments, Exception):
+                raise fragments
+            yield from fragments
+    finally:
+        stop.set()
+        producer.join()
+
 
 # Function to send data
 def send_file(file_path, max_fragment_size):
+    with open(file_path, "rb") as f:
+        send_stream(os.path.basename(file_path), f, os.path.getsize(file_path), max_fragment_size)
+
+
+# Function to send size bytes from f as a file transfer (name, fragments, digest trailer)
+def send_stream(file_name, f, size, max_fragment_size, flags=0, name_prefix=b""):
     time_spend = 0
-    # Send file name first
-    file_name = os.path.basename(file_path)
-    header = create_header(8, 0, len(file_name), 1, 1, file_name.encode('utf-8'))
-    udp_socket.sendto(header + file_name.encode('utf-8'), (REMOTE_IP, REMOTE_PORT))
+    total_fragments = (size + max_fragment_size - 1) // max_fragment_size
+    if total_fragments > 65535:
+        raise IOError(f"File too large for fragment size {max_fragment_size}B ({total_fragments} fragments)")
+
+    # Send file name first (with the fragment size, the receiver writes fragments by offset)
+    send_with_ack(8, flags, struct.pack("!H", max_fragment_size) + name_prefix + file_name.encode('utf-8'), 1, 1, ACK_TIMEOUT)
     print(f"[Sender] Sent file name: {file_name}")
 
-    # Read the file contents
-    with open(file_path, "rb") as f:
-        file_data = f.read()
+    # File is read ahead and hashed by a producer thread, the transmit loop never waits on the disk
+    file_digest = new_file_digest()
+    starting_point = runtime.time_now()
+    with contextlib.closing(prefetch_fragments(f, max_fragment_size, total_fragments)) as fragments:
+        for current_fragment, fragment_data, leaf, header in fragments:
+            file_digest.update(leaf)
+            print(f"[Sender] Sent fragment {current_fragment}\tsize: {len(fragment_data)}B")
+            window = send_with_ack(6, 0, fragment_data, total_fragments, current_fragment, ACK_TIMEOUT,
+                                   header=header)
+            if window == 0:
+                runtime.sleep(WINDOW_PROBE_DELAY)  # Receiver's disk is behind, give it time to catch up
+
+    # Trailer with the digest of the whole file
+    send_with_ack(EXT_MSG_TYPE, EXT_FILE_DIGEST, file_digest.digest(), total_fragments, total_fragments, ACK_TIMEOUT)
+    time_spend = runtime.time_now() - starting_point
+    print(f"[Sender] Time spend on sending file {time_spend}")
 
-    fragments = [file_data[i:i + max_fragment_size] for i in range(0, len(file_data), max_fragment_size)]
-    total_fragments = len(fragments)
 
-    starting_point = time.time()
-    for current_fragment, fragment_data in enumerate(fragments, start=1):
-        while True:
-            udp_socket.settimeout(0.00001)
-            msg_type = 6  # Message type for file fragment
-            header = create_header(msg_type, 0, len(fragment_data), total_fragments, current_fragment,
-                                   fragment_data)
-            udp_socket.sendto(header + fragment_data, (REMOTE_IP, REMOTE_PORT))
-            print(f"[Sender] Sent fragment {current_fragment}\tsize: {len(fragment_data)}B")
+# Function to send every file below directory packed into as few transfers as the fragment limit allows
+def send_pack(directory, max_fragment_size):
+    directory = os.path.abspath(directory)
+    entries = pack.collect(directory)
+    if not entries:
+        print(f"[Sender] No files to pack in {directory}")
+        return
+    # A file that does not fit into one transfer on its own is reported now, not dropped halfway through the packs
+    max_bytes = 65535 * max_fragment_size
+    packable = []
+    for entry in entries:
+        if pack.index_size([entry]) + entry[2] > max_bytes:
+            print(f"[Sender] {entry[0]} ({entry[2]}B) is too large to pack at fragment size {max_fragment_size}B, "
+                  f"skipped")
+        else:
+            packable.append(entry)
+
+    starting_point = runtime.time_now()
+    confirmed = 0
+    for batch in pack.batches(packable, max_bytes):
+        with pack.PackReader(batch) as reader:
+            print(f"[Sender] Packing {len(batch)} files, {reader.size}B")
+            try:
+                send_stream(os.path.basename(directory), reader, reader.size, max_fragment_size, FILE_FLAG_PACK)
+            except IOError as e:
+                print(f"[Sender] Pack of {len(batch)} files failed: {e}")
+                continue
+        confirmed += len(batch)  # The receiver verified the pack's digest
+    time_spend = runtime.time_now() - starting_point
+    print(f"[Sender] Sent {confirmed} of {len(entries)} files in {time_spend:.2f} s "
+          f"({confirmed / max(time_spend, 1e-6):.0f} files/s)")
+
 
-            # Wait for ACK or NACK
+# Function to collect the receiver's block signatures, returns None if they did not arrive
+def request_delta_signatures(file_name, block_size):
+    while not delta_signature_queue.empty():
+        delta_signature_queue.get_nowait()
+
+    request = struct.pack("!I", block_size) + file_name.encode('utf-8')
+    for _ in range(3):
+        send_with_ack(EXT_MSG_TYPE, EXT_DELTA_REQUEST, request, 1, 1, ACK_TIMEOUT)
+        parts = {}
+        while True:
             try:
+                current_fragment, total_fragments, body = delta_signature_queue.get(timeout=2)
+            except queue.Empty:
+                print(f"[Sender] Signatures incomplete ({len(parts)} parts), asking again")
+                break
+            parts[current_fragment] = body
+            if len(parts) == total_fragments:
+                return b''.join(parts[i] for i in range(1, total_fragments + 1))
+    return None
+
+
+# Function to send only the blocks of a file that the receiver does not already have
+def send_delta_file(file_path, max_fragment_size):
+    file_name = os.path.basename(file_path)
+    block_size = delta.block_size_for(os.path.getsize(file_path))
+    signatures = request_delta_signatures(file_name, block_size)
+    if not signatures:
+        print("[Sender] Receiver has no usable copy, sending whole file")
+        send_file(file_path, max_fragment_size)
+        return
+
+    # Delta stream goes to a temporary file so large files are not built in memory
+    with open(file_path, "rb") as f, tempfile.TemporaryFile() as delta_stream:
+        literal_bytes, matched_blocks = delta.compute_delta(f, signatures, block_size, delta_stream)
+        delta_size = delta_stream.tell()
+        delta_stream.seek(0)
+        print(f"[Sender] Delta: {matched_blocks} blocks reused, {literal_bytes}B literal, {delta_size}B to send")
+        send_stream(file_name, delta_stream, delta_size, max_fragment_size,
+                    FILE_FLAG_DELTA, struct.pack("!I", block_size))
+
+
+# Function to send signatures of our copy of file_name back to the peer (unacknowledged, peer asks again on loss)
+def send_delta_signatures(file_name, block_size):
+    signatures = delta.file_signatures(os.path.join(default_directory, file_name), block_size)
+    per_fragment = 1490 // delta.SIGNATURE_SIZE * delta.SIGNATURE_SIZE
+    parts = [signatures[i:i + per_fragment] for i in range(0, len(signatures), per_fragment)] or [b""]
+    if len(parts) > 65535:
+        parts = [b""]  # Too many blocks to describe, peer falls back to a full send
+    for current_fragment, part in enumerate(parts, start=1):
+        header = create_header(EXT_MSG_TYPE, EXT_DELTA_SIGNATURE, len(part), len(parts), current_fragment, part)
+        send_datagram(header + part, scheduler.PRIORITY_BULK)
+    print(f"[Listener] Sent {len(signatures) // delta.SIGNATURE_SIZE} block signatures of {file_name}")
+
+
+# Function to split fragments 1..total_fragments into contiguous shards
+def shard_ranges(total_fragments, workers):
+    shard = (total_fragments + workers - 1) // workers
+    return [(first, min(first + shard - 1, total_fragments)) for first in range(1, total_fragments + 1, shard)]
+
+
+# Function to run target(*args) in a forked worker process, its bytes result comes back through a pipe.
+# multiprocessing is not used: its child bootstrap closes sys.stdin, which blocks on the lock held by input().
+def fork_worker(target, *args):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            result = target(*args)
+            with os.fdopen(write_fd, "wb") as pipe:
+                pipe.write(b"\x01" + result if result is not None else b"\x00")
+            status = 0
+        except BaseException:
+            # Straight to fd 2: a parent thread may have held the sys.stderr lock at fork time
+            os.write(2, traceback.format_exc().encode("utf-8", "replace"))
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    return pid, read_fd
+
+
+# Function to wait for a worker started by fork_worker, returns its result or None
+def collect_worker(pid, read_fd):
+    with os.fdopen(read_fd, "rb") as pipe:
+        result = pipe.read()
+    os.waitpid(pid, 0)
+    return result[1:] if result[:1] == b"\x01" else None
+
+
+# Function to send a file split into shards, each driven by its own process and socket
+def send_file_parallel(file_path, workers, max_fragment_size):
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    total_fragments = (file_size + max_fragment_size - 1) // max_fragment_size
+    workers = min(workers, total_fragments, 255)
+    if workers < 2 or total_fragments > 65535:
+        send_file(file_path, max_fragment_size)
+        return
+
+    while not parallel_ports_queue.empty():
+        parallel_ports_queue.get_nowait()
+
+    transfer_id = random.getrandbits(32)
+    offer = struct.pack(PARALLEL_OFFER_FORMAT, transfer_id, workers, max_fragment_size, file_size)
+    ports = None
+    for _ in range(3):
+        send_with_ack(EXT_MSG_TYPE, EXT_PARALLEL_OFFER, offer + file_name.encode('utf-8'), 1, 1, ACK_TIMEOUT)
+        try:
+            reply = parallel_ports_queue.get(timeout=2)
+        except queue.Empty:
+            continue
+        if struct.unpack("!I", reply[:4])[0] == transfer_id:
+            ports = [port for (port,) in struct.iter_unpack("!H", reply[4:])]
+            break
+    if not ports:
+        print("[Sender] Receiver did not open shard ports, sending over one socket")
+        send_file(file_path, max_fragment_size)
+        return
+
+    print(f"[Sender] Sending {file_name} in {len(ports)} shards to ports {ports}")
+    starting_point = runtime.time_now()
+    shards = shard_ranges(total_fragments, len(ports))
+    # Every worker seals under its own nonce stream
+    workers = [fork_worker(parallel_send_worker, file_path, first, last, max_fragment_size, total_fragments,
+                           (PEER_ADDRESS[0], port), session_cipher and session_cipher.new_stream())
+               for (first, last), port in zip(shards, ports)]
+    shard_leaves = [collect_worker(pid, read_fd) for pid, read_fd in workers]
+    if None in shard_leaves:
+        print("[Sender] A shard worker failed, transfer aborted")
+        return
+
+    root = file_root_digest(shard_leaves)
+    send_with_ack(EXT_MSG_TYPE, EXT_PARALLEL_DONE, struct.pack("!I", transfer_id) + root, 1, 1, ACK_TIMEOUT)
+    time_spend = runtime.time_now() - starting_point
+    print(f"[Sender] Time spend on sending file {time_spend} ({file_size / max(time_spend, 1e-9) / 1e6:.1f} MB/s)")
+
 
-                ack_data, _ = udp_socket.recvfrom(1500)
-                ack_header = parse_header(ack_data[:10])
+# Function to build a header inside a forked worker. create_header takes send_id_lock, which another parent thread
+# may have held at fork time, so the worker numbers its own packets instead
+def worker_header(msg_type, msg_id, total_fragments, current_fragment, data, cipher):
+    crc = 0 if cipher is not None else crc16(data)  # Sealed packet, the AEAD tag protects it
+    return struct.pack("!B H B H H H", msg_type << 4, len(data), msg_id % 256, total_fragments, current_fragment, crc)
 
-                if ack_header["msg_type"] == 15:  # ACK2
-                    # print(f"[Sender] ACK received for fragment {current_fragment}")
-                    break  # Next fragment
-                if ack_header["msg_type"] == 13:  # NACK
-                    # print(f"[Sender] NACK received for fragment {current_fragment}, resending...")
+
+# Worker process: stop-and-wait send of fragments first..last over its own socket, returns the shard's leaves
+def parallel_send_worker(file_path, first, last, max_fragment_size, total_fragments, address, cipher=None):
+    shard_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    shard_socket.bind((LOCAL_IP, 0))
+    shard_socket.settimeout(0.2)
+    leaves = bytearray()
+
+    with open(file_path, "rb") as f:
+        for current_fragment in range(first, last + 1):
+            fragment_data = os.pread(f.fileno(), max_fragment_size, (current_fragment - 1) * max_fragment_size)
+            leaves += fragment_leaf(fragment_data)
+            header = worker_header(6, current_fragment, total_fragments, current_fragment, fragment_data, cipher)
+
+            acked = False
+            while not acked:
+                shard_socket.sendto(seal_datagram(header + fragment_data, cipher), address)
+                try:
+                    # Skip ACKs of earlier fragments that arrive late
+                    while True:
+                        ack = open_datagram(shard_socket.recvfrom(1500)[0], cipher)
+                        if ack is None:
+                            continue
+                        ack_header = parse_header(ack[:10])
+                        if ack_header["current_fragment"] != current_fragment:
+                            continue
+                        acked = ack_header["msg_type"] == 15
+                        break
+                except socket.timeout:
                     continue
-            except socket.timeout:
-                # print(f"[Sender] Timeout waiting for ACK, resending fragment {current_fragment}...")
+                except ConnectionResetError:
+                    continue
+
+    shard_socket.close()
+    return bytes(leaves)
+
+
+# Function to send a file in blast mode: paced fragments without ACKs, then resend what the receiver reports missing
+def send_file_blast(file_path, rate, max_fragment_size):
+    file_name = os.path.basename(file_path)
+    size = os.path.getsize(file_path)
+    total_fragments = (size + max_fragment_size - 1) // max_fragment_size
+    if not session["features"] & FEATURE_BLAST or not 0 < total_fragments <= 65535:
+        print("[Sender] Blast mode not possible for this file/peer, sending with per-fragment ACKs")
+        send_file(file_path, max_fragment_size)
+        return
+
+    while not blast_report_queue.empty():
+        blast_report_queue.get_nowait()
+    pacer = blast.Pacer(rate * 1e6 / 8)
+    send_with_ack(8, FILE_FLAG_BLAST, struct.pack("!H", max_fragment_size) + file_name.encode('utf-8'), 1, 1, ACK_TIMEOUT)
+    print(f"[Sender] Sent file name: {file_name}, blasting {total_fragments} fragments at "
+          f"{f'{rate} Mbit/s' if rate else 'full speed'}")
+
+    starting_point = runtime.time_now()
+    file_digest = new_file_digest()
+    resent = 0
+    sent_bytes = 0
+    receiver_drops = 0
+    with open(file_path, "rb") as f:
+        with contextlib.closing(prefetch_fragments(f, max_fragment_size, total_fragments)) as fragments:
+            for current_fragment, fragment_data, leaf, header in fragments:
+                file_digest.update(leaf)
+                send_datagram(set_msg_id(header, generate_send_id()) + fragment_data, scheduler.PRIORITY_BULK)
+                pacer.wait(HEADER_SIZE + len(fragment_data))
+                sent_bytes += HEADER_SIZE + len(fragment_data)
+                while not blast_report_queue.empty():  # Repair early gaps while still blasting
+                    kind, value = blast_report_queue.get_nowait()
+                    if kind == "nack":
+                        resent += resend_blast_ranges(f, value, max_fragment_size, total_fragments, pacer)
+                    elif kind == "drops" and value > receiver_drops:
+                        receiver_drops = value
+                        slow_down_blast(pacer, sent_bytes / max(runtime.time_now() - starting_point, 1e-3), value)
+
+        # The trailer asks the receiver for its final gap list, repeated until it confirms the whole file
+        root = file_digest.digest()
+        trailer = create_header(EXT_MSG_TYPE, EXT_FILE_DIGEST, len(root), total_fragments, total_fragments, root)
+        unanswered = 0
+        verified = None
+        while verified is None and unanswered < BLAST_MAX_TRAILERS:
+            # A fresh ID each time, or the receiver drops the resend as a duplicate and never answers it
+            send_datagram(set_msg_id(trailer, generate_send_id()) + root, scheduler.PRIORITY_BULK)
+            try:
+                kind, value = blast_report_queue.get(timeout=BLAST_TRAILER_TIMEOUT)
+            except queue.Empty:
+                unanswered += 1
                 continue
-        ending_point = time.time()
-        time_spend = ending_point - starting_point
-    print(f"[Sender] Time spend on sending file {time_spend}")
+            unanswered = 0
+            if kind == "done":
+                verified = value
+            elif kind == "nack":
+                resent += resend_blast_ranges(f, value, max_fragment_size, total_fragments, pacer)
+            elif value > receiver_drops:
+                receiver_drops = value
+                slow_down_blast(pacer, sent_bytes / max(runtime.time_now() - starting_point, 1e-3), value)
+
+    time_spend = runtime.time_now() - starting_point
+    if verified is None:
+        print(f"[Sender] Receiver stopped answering, blast of {file_name} not confirmed")
+    elif not verified:
+        print(f"[Sender] Receiver reported a digest mismatch for {file_name}")
+    else:
+        print(f"[Sender] Time spend on sending file {time_spend} ({size / max(time_spend, 1e-9) / 1e6:.1f} MB/s, "
+              f"{resent} fragments resent, {receiver_drops} dropped by the receiver's kernel)")
 
 
-def save_received_file(file_name, data):
+# Function to lower the blast rate when the receiver (not the path) loses datagrams
+def slow_down_blast(pacer, measured_rate, drops):
+    pacer.decrease(measured_rate)
+    print(f"[Sender] Receiver's socket overflowed ({drops} datagrams), pacing at {pacer.rate * 8 / 1e6:.1f} Mbit/s")
+
+
+def resend_blast_ranges(f, ranges, max_fragment_size, total_fragments, pacer):
+    resent = 0
+    for first, last in ranges:
+        for current_fragment in range(max(first, 1), min(last, total_fragments) + 1):
+            fragment_data = os.pread(f.fileno(), max_fragment_size, (current_fragment - 1) * max_fragment_size)
+            header = create_header(6, 0, len(fragment_data), total_fragments, current_fragment, fragment_data)
+            send_datagram(header + fragment_data, scheduler.PRIORITY_BULK)
+            pacer.wait(HEADER_SIZE + len(fragment_data))
+            resent += 1
+    return resent
+
+
+def send_parallel_ports(transfer_id, ports):
+    body = struct.pack("!I", transfer_id) + b''.join(struct.pack("!H", port) for port in ports)
+    header = create_header(EXT_MSG_TYPE, EXT_PARALLEL_PORTS, len(body), 1, 1, body)
+    send_datagram(header + body)
+
+
+# Function to receive a sharded file: one process per shard writes its fragments into the file by offset
+def receive_file_parallel(transfer_id, file_name, file_size, fragment_size, workers):
+    transfer = parallel_transfers[transfer_id]
+    total_fragments = (file_size + fragment_size - 1) // fragment_size
+    save_path = os.path.join(default_directory, file_name)
+    part_path = save_path + ".part"
+    os.makedirs(default_directory, exist_ok=True)
+    with open(part_path, "wb") as f:
+        f.truncate(file_size)
+
+    processes = []
+    ports = []
+    for first, last in shard_ranges(total_fragments, workers):
+        shard_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        shard_socket.bind((LOCAL_IP, 0))
+        ports.append(shard_socket.getsockname()[1])
+        processes.append(fork_worker(parallel_receive_worker, shard_socket, part_path, first, last, fragment_size,
+                                     session_cipher and session_cipher.new_stream()))
+        shard_socket.close()  # The worker owns the socket now
+
+    transfer["ports"] = ports
+    send_parallel_ports(transfer_id, ports)
+    print(f"[Listener] Receiving {file_name} in {len(ports)} shards on ports {ports}")
+
+    shard_leaves = [collect_worker(pid, read_fd) for pid, read_fd in processes]
+
+    if None in shard_leaves or not transfer["done"].wait(PARALLEL_IDLE_LIMIT):
+        print(f"[Listener] Sharded transfer of {file_name} incomplete, file discarded")
+        os.remove(part_path)
+    elif file_root_digest(shard_leaves) != transfer["root"]:
+        print(f"[Listener] File digest mismatch for {file_name}, file discarded")
+        os.remove(part_path)
+        send_error_message()
+    else:
+        os.replace(part_path, save_path)
+        print(f"[Listener] File saved as {save_path}")
+    del parallel_transfers[transfer_id]
+
+
+# Worker process: receives fragments first..last on its own socket and writes them at their offset
+def parallel_receive_worker(shard_socket, part_path, first, last, fragment_size, cipher=None):
+    fd = os.open(part_path, os.O_WRONLY)
+    leaves = {}
+    expected = last - first + 1
+    idle = 0
+    shard_socket.settimeout(PARALLEL_LINGER)
+
+    while True:
+        try:
+            data, address = shard_socket.recvfrom(1500)
+        except socket.timeout:
+            idle += PARALLEL_LINGER
+            # Once complete, a quiet period means the sender got our last ACK
+            if len(leaves) == expected or idle >= PARALLEL_IDLE_LIMIT:
+                break
+            continue
+        except ConnectionResetError:
+            continue
+        idle = 0
+
+        data = open_datagram(data, cipher)
+        if data is None:
+            continue
+        header_info = parse_header(data[:10])
+        body = data[10:]
+        current_fragment = header_info["current_fragment"]
+        if len(body) != header_info["length"] or not packet_intact(header_info["msg_type"], body,
+                                                                   header_info["crc"], cipher):
+            reply = 13  # NACK
+        else:
+            reply = 15  # ACK
+            if first <= current_fragment <= last and current_fragment not in leaves:
+                os.pwrite(fd, body, (current_fragment - 1) * fragment_size)
+                leaves[current_fragment] = fragment_leaf(body)
+        header = worker_header(reply, current_fragment, 1, current_fragment, b"", cipher)
+        shard_socket.sendto(seal_datagram(header, cipher), address)
+
+    os.close(fd)
+    shard_socket.close()
+    if len(leaves) != expected:
+        return None
+    return b''.join(leaves[i] for i in range(first, last + 1))
+
+
+# Most data the write-behind thread may have pending before the receive window closes
+WRITE_BEHIND_LIMIT = 16 * 1024 * 1024
+
+
+# Function to start receiving a file announced by a file name frame, data goes to <name>.part
+def open_incoming_file(flags, body):
     global default_directory
+    fragment_size = struct.unpack("!H", body[:2])[0]
+    body = body[2:]
+    delta_block_size = 0
+    if flags & FILE_FLAG_DELTA:
+        delta_block_size = struct.unpack("!I", body[:4])[0]
+        body = body[4:]
+    file_name = os.path.basename(body.decode('utf-8'))
+    print(f"[Listener] Received file name: {file_name}")
+    # "", "." or ".." would name the directory itself or its parent, a pack would be moved over it
+    save_path = pack.safe_path(default_directory, file_name)
+    if save_path is None:
+        print(f"[Error] Refusing file name {file_name!r}")
+        return None
+
     # Ensure the directory exists, create if it doesn't
-    os.makedirs(default_directory, exist_ok=True)
-    # Normalize the path to handle different path formats
-    save_path = os.path.join(default_directory, file_name)
     try:
-        with open(save_path, "wb") as f:
-            f.write(data)
-        print(f"[Listener] File saved as {save_path}")
+        os.makedirs(default_directory, exist_ok=True)
+    except OSError as e:
+        print(f"[Error] Could not save file: {e}")
+        return None
+    part_path = save_path + ".part"
+
+    # Packed files are unpacked into a staging directory, moved into place once the digest matches
+    if flags & FILE_FLAG_PACK:
+        part_path = save_path + ".pack-part"
+        try:
+            writer = pack.Unpacker(part_path, not args.no_fsync)
+        except OSError as e:
+            print(f"[Error] Could not save file: {e}")
+            return None
+        return {"name": file_name, "flags": flags, "delta_block_size": 0,
+                "fragment_size": fragment_size, "save_path": save_path, "part_path": part_path,
+                "fd": None, "writer": writer, "leaves": {}, "last_fragment_time": runtime.time_now()}
+
+    try:
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
     except PermissionError:
         print(f"[Error] Permission denied. Cannot save file to {save_path}")
+        return None
     except IOError as e:
         print(f"[Error] Could not save file: {e}")
+        return None
+
+    writer = writebehind.WriteBehind(fd, args.flush_bytes, args.flush_ms / 1000, not args.no_fsync)
+    return {"name": file_name, "flags": flags, "delta_block_size": delta_block_size,
+            "fragment_size": fragment_size, "save_path": save_path, "part_path": part_path,
+            "fd": fd, "writer": writer, "leaves": {}, "last_fragment_time": runtime.time_now()}
+
+
+# Function to send the blast sender the ranges we are missing, rate limited unless final
+def report_blast_gaps(incoming_file, total_fragments, received_fragment=None, final=False):
+    gaps = incoming_file.get("gaps")
+    if gaps is None:
+        gaps = incoming_file["gaps"] = blast.GapTracker(total_fragments)
+        incoming_file["last_report_time"] = runtime.time_now()
+        incoming_file["kernel_drops"] = incoming_file["reported_drops"] = kernel_drops()
+    if received_fragment is not None:
+        gaps.add(received_fragment)
+
+    now = runtime.time_now()
+    if not final and now - incoming_file["last_report_time"] < BLAST_REPORT_INTERVAL:
+        return
+    incoming_file["last_report_time"] = now
+    up_to = None if final else gaps.highest - BLAST_REORDER_SLACK
+    ranges = gaps.missing_ranges(up_to, limit=incoming_file["fragment_size"] // 4)
+    if ranges:
+        body = b"".join(struct.pack("!H H", first, last) for first, last in ranges)
+        header = create_header(EXT_MSG_TYPE, EXT_BLAST_NACK, len(body), 1, 1, body)
+        send_datagram(header + body)
+
+    # Gaps caused by our own full socket buffer: the sender should slow down, not just resend
+    drops = kernel_drops() - incoming_file["kernel_drops"]
+    if drops > incoming_file["reported_drops"] - incoming_file["kernel_drops"]:
+        incoming_file["reported_drops"] = incoming_file["kernel_drops"] + drops
+        body = struct.pack("!I", drops)
+        header = create_header(EXT_MSG_TYPE, EXT_RECEIVER_DROPS, len(body), 1, 1, body)
+        send_datagram(header + body)
+
+
+def send_blast_done(verified):
+    body = b"\x01" if verified else b"\x00"
+    header = create_header(EXT_MSG_TYPE, EXT_BLAST_DONE, len(body), 1, 1, body)
+    send_datagram(header + body)
+
+
+def is_blast_trailer(incoming_file, root):
+    if incoming_file is not None:
+        return bool(incoming_file["flags"] & FILE_FLAG_BLAST)
+    return last_blast_result is not None and last_blast_result[0] == root  # Our "done" got lost
+
+
+# Function to answer a blast trailer: gap list while fragments are missing, otherwise verify and confirm once
+def finish_blast_file(incoming_file, root, total_fragments):
+    global last_blast_result
+    if incoming_file is None:
+        send_blast_done(last_blast_result[1])
+        return None
+
+    report_blast_gaps(incoming_file, total_fragments, final=True)
+    if not incoming_file["gaps"].complete:
+        return incoming_file
+
+    leaves = incoming_file["leaves"]
+    verified = file_root_digest(leaves[i] for i in range(1, total_fragments + 1)) == root
+    last_blast_result = (root, verified)
+    send_blast_done(verified)
+    if verified:
+        runtime.Thread(target=finalize_incoming_file, args=(incoming_file,), daemon=True).start()
+    else:
+        print(f"[Listener] File digest mismatch for {incoming_file['name']}, file discarded")
+        abort_incoming_file(incoming_file)
+    return None
+
+
+# Function to compute the window we advertise: it shrinks while the disk writes are behind
+# and closes while our kernel drops datagrams (the sender pauses instead of resending into a full buffer)
+def receive_window(incoming_file):
+    if incoming_file is None:
+        return RECEIVE_WINDOW
+    if receiver_overloaded():
+        return 0
+    free = WRITE_BEHIND_LIMIT - incoming_file["writer"].backlog
+    return max(0, min(RECEIVE_WINDOW, free // max(1, incoming_file["fragment_size"])))
+
+
+def abort_incoming_file(incoming_file):
+    incoming_file["writer"].abort()
+    if incoming_file["fd"] is None:
+        return  # Pack: the unpacker removed its staging directory
+    os.close(incoming_file["fd"])
+    if os.path.exists(incoming_file["part_path"]):
+        os.remove(incoming_file["part_path"])
+
+
+# Function to flush the remaining writes, make the file durable and move it into place
+def finalize_incoming_file(incoming_file):
+    save_path = incoming_file["save_path"]
+    part_path = incoming_file["part_path"]
+    if incoming_file["flags"] & FILE_FLAG_PACK:
+        finalize_pack(incoming_file)
+        return
+    try:
+        incoming_file["writer"].finish()
+    except IOError as e:
+        print(f"[Error] Could not save file: {e}")
+        os.close(incoming_file["fd"])
+        os.remove(part_path)
+        return
+    os.close(incoming_file["fd"])
+    durable_ms = (runtime.time_now() - incoming_file["last_fragment_time"]) * 1000
+
+    if incoming_file["flags"] & FILE_FLAG_DELTA:
+        save_delta_file(incoming_file["name"], part_path, incoming_file["delta_block_size"])
+        os.remove(part_path)
+    else:
+        os.replace(part_path, save_path)
+        print(f"[Listener] File saved as {save_path}")
+        print("[Listener] Received complete file, digest verified and saved.")
+    print(f"[Listener] File durable {durable_ms:.1f} ms after its last fragment")
+
+
+# Function to finish unpacking (one sync for all files) and move the unpacked files into the target directory
+def finalize_pack(incoming_file):
+    writer = incoming_file["writer"]
+    try:
+        writer.finish()
+        pack.install(incoming_file["part_path"], incoming_file["save_path"])
+    except (IOError, OSError) as e:
+        print(f"[Error] Could not save packed files: {e}")
+        writer.abort()
+        return
+    durable_ms = (runtime.time_now() - incoming_file["last_fragment_time"]) * 1000
+    print(f"[Listener] Unpacked {writer.files} files into {incoming_file['save_path']}")
+    print(f"[Listener] Files durable {durable_ms:.1f} ms after the last fragment")
+
+
+def save_delta_file(file_name, delta_path, block_size):
+    save_path = os.path.join(default_directory, file_name)
+    temp_path = save_path + ".delta-tmp"
+    try:
+        with open(delta_path, "rb") as f:
+            delta_data = f.read()
+        if delta.apply_delta(save_path, delta_data, block_size, temp_path):
+            os.replace(temp_path, save_path)
+            print(f"[Listener] File rebuilt from delta as {save_path}")
+            return
+        print(f"[Listener] Rebuilt file {file_name} does not match, keeping the old copy")
+        send_error_message()
+    except (IOError, ValueError, struct.error) as e:
+        print(f"[Error] Could not apply delta: {e}")
+        send_error_message()
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
 
 
 def send_message(message, max_fragment_size):
-    global errored
-    header_size = 10
-    max_payload_size = max_fragment_size
-
-    # fragments = [message[i:i + max_payload_size] for i in range(0, len(message), max_payload_size)]
-    # total_fragments = len(fragments)
-    #
-    # for current_fragment, fragment_data in enumerate(fragments, start=1):
-    #     # Only send every other fragment (odd-numbered fragments)
-    #     if current_fragment % 2 == 0:
-    #         print(f"[Sender] Skipping fragment {current_fragment}")
-    #         continue
-    #
-    #     while True:
-    #         udp_socket.settimeout(0.2)  # Timeout for ACK
-    #
-    #         msg_type = 11  # Message type for text message
-    #         flags = 0b0000
-    #         length = len(fragment_data)
-    #         header = create_header(msg_type, flags, length, total_fragments, current_fragment,
-    #                                fragment_data.encode("utf-8"))
-    #
-    #         udp_socket.sendto(header + fragment_data.encode("utf-8"), (REMOTE_IP, REMOTE_PORT))
-    #         print(f"[Sender] Sent fragment {current_fragment}\tsize: {len(fragment_data)}B")
-    #
-    #         # Wait for ACK or NACK
-    #         try:
-    #             ack_data, _ = udp_socket.recvfrom(1500)
-    #             ack_header = parse_header(ack_data[:10])
-    #
-    #             if ack_header["msg_type"] == 15:  # ACK2
-    #                 break  # Move to the next fragment
-    #             elif ack_header["msg_type"] == 13:  # NACK
-    #                 print(f"[Sender] NACK received for fragment {current_fragment}")
-    #                 errored = False
-    #                 continue  # Resend this fragment
-    #         except socket.timeout:
-    #             continue  # Resend on timeout
-
-
-    fragments = [message[i:i + max_payload_size] for i in range(0, len(message), max_payload_size)]
-    total_fragments = len(fragments)
-
-    for current_fragment, fragment_data in enumerate(fragments, start=1):
-        while True:
-            udp_socket.settimeout(0.2)  # Timeout for ACK
+    # Fragmentujeme zakódované bajty, nie znaky - diakritika zaberá viac bajtov
+    encoded = memoryview(message.encode("utf-8"))
+    if not encoded:
+        return
 
-            msg_type = 11  # Message type for text message
-            flags = 0b0000
-            length = len(fragment_data)
-            header = create_header(msg_type, flags, length, total_fragments, current_fragment,
-                                   fragment_data.encode("utf-8"))
+    starting_point = runtime.time_now()
+    message_id = generate_text_message_id()
+    prefix = struct.pack(TEXT_PREFIX_FORMAT, message_id)
+    chunk_size = max(1, max_fragment_size - TEXT_PREFIX_SIZE)
+    total_fragments = (len(encoded) + chunk_size - 1) // chunk_size
+
+    fragments = []
+    for current_fragment in range(1, total_fragments + 1):
+        start = (current_fragment - 1) * chunk_size
+        fragments.append((current_fragment, prefix + encoded[start:start + chunk_size]))
+    text_outbox.put((message_id, total_fragments, fragments, starting_point))
+    # text_sender môže čakať na ACK, bez budíčka by nová správa čakala celý RTT
+    ack_queues[CHANNEL_TEXT].put(TEXT_WAKEUP)
 
-            udp_socket.sendto(header + fragment_data.encode("utf-8"), (REMOTE_IP, REMOTE_PORT))
-            print(f"[Sender] Sent fragment {current_fragment}\tsize: {len(fragment_data)}B")
 
-            # Wait for ACK or NACK
+# Thread sending queued text messages with a sliding window: at most TEXT_WINDOW fragments (also of several
+# messages) wait for their ACK, each ACK names its fragment and lets the next one out, only timed out ones are resent
+def text_sender():
+    global errored
+    ack_queue = ack_queues[CHANNEL_TEXT]
+    window = textwindow.TextWindow(min(TEXT_WINDOW, session["window"]), TEXT_ACK_TIMEOUT)
+    while not end_connection:
+        profiling.checkpoint()
+        # Messages are taken while their fragments fit in the window, the rest waits in text_outbox
+        while window.has_room:
             try:
-                ack_data, _ = udp_socket.recvfrom(1500)
-                ack_header = parse_header(ack_data[:10])
+                window.add(*text_outbox.get(timeout=1) if window.idle else text_outbox.get_nowait())
+            except queue.Empty:
+                break
+        if window.idle:
+            continue
 
-                if ack_header["msg_type"] == 15:  # ACK2
-                    # print(f"[Sender] ACK received for fragment {current_fragment}")
-                    break  # Move to the next fragment
-                elif ack_header["msg_type"] == 13:  # NACK
-                    print(f"[Sender] NACK received for fragment {current_fragment}")
-                    errored = False
-                    continue  # Resend this fragment
-            except socket.timeout:
-                # print(f"[Sender] Timeout waiting for ACK, resending msg")
-                continue  # Resend on timeout
+        sends = window.poll(runtime.time_now())
+        for index, ((message_id, current_fragment), total_fragments, fragment_data, first) in enumerate(sends):
+            header = create_header(11, 0b0000, len(fragment_data), total_fragments, current_fragment, fragment_data)
+            send_datagram(header + fragment_data, scheduler.PRIORITY_TEXT, flush=index == len(sends) - 1)
+            if first:
+                print(f"[Sender] Sent fragment {current_fragment}\tsize: {len(fragment_data)}B")
+
+        try:
+            ack_type, _, key = ack_queue.get(timeout=window.next_timer(runtime.time_now()))
+        except queue.Empty:
+            continue  # Resend what timed out
+        if ack_type is None:
+            continue  # Woken by send_message, take the new message while the window has room
+        if ack_type == 13:  # NACK
+            errored = False
+            window.on_nack(runtime.time_now())
+            continue
+        if len(key) < 4:
+            continue
+        latency = window.on_ack(struct.unpack("!H H", key[:4]), runtime.time_now())
+        if latency is not None:
+            text_latencies.append(latency)
+            text_outbox.task_done()
+
+
+# Function to print text message latency percentiles (e.g. while a file transfer runs)
+def print_text_latency():
+    if not text_latencies:
+        print("[Sender] No text messages sent yet")
+        return
+    latencies = sorted(text_latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"[Sender] Text latency over {len(latencies)} messages: p50 {p50 * 1000:.1f} ms, "
+          f"p99 {p99 * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+
+CONTROL_NAMES = {1: "SYN", 2: "SYN-ACK", 3: "ACK", 10: "ERROR", 12: "FIN", 14: "FIN-ACK"}
+
+
+# Function to print the heartbeat age and the latest control messages from the bounded ring
+def print_connection_status():
+    age = peer_liveness.age(PEER_ADDRESS)
+    print(f"[Status] Last heartbeat: {'never' if age is None else f'{age:.1f} s ago'}")
+    kernel_drops()
+    for path in paths.paths:
+        rcvbuf, sndbuf = path.buffers or (0, 0)
+        print(f"[Status] {path.name}: rcvbuf {rcvbuf // 1024} KiB, sndbuf {sndbuf // 1024} KiB, "
+              f"{path.kernel_drops} datagrams dropped by the kernel "
+              f"({'SO_RXQ_OVFL' if path.counts_overflow else '/proc/net/udp'})")
+    now = runtime.monotonic()
+    for event_time, msg_type, address in peer_liveness.recent_events(10):
+        print(f"[Status] {now - event_time:8.1f} s ago  {CONTROL_NAMES.get(msg_type, msg_type)} from "
+              f"{address[0]}:{address[1]}")
+
+
+# Thread running queued file transfers one after another, so the prompt stays free for text
+def transfer_worker():
+    while not end_connection:
+        profiling.checkpoint()
+        try:
+            function, job_args = transfer_jobs.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            function(*job_args)
+        except (IOError, ValueError) as e:
+            print(f"[Sender] Transfer failed: {e}")
+        except Exception:
+            print("[Sender] Transfer failed with an unexpected error:")
+            traceback.print_exc()  # The worker keeps running, queued transfers still drain
+        finally:
+            transfer_jobs.task_done()
+
+
+# Thread taking files from the spool directory into the persistent queue
+def spool_watcher(spool_queue):
+    while not end_connection:
+        try:
+            taken = spool.scan_spool(spool_queue, args.daemon)
+        except OSError as e:
+            print(f"[Spool] Cannot scan {args.daemon}: {e}")
+            taken = 0
+        if taken:
+            print(f"[Spool] Queued {taken} files from {args.daemon}, {len(spool_queue)} waiting")
+        runtime.sleep(spool.SCAN_INTERVAL)
+
+
+# Thread sending queued files back-to-back over the one warm session, a job leaves the queue only once sent
+def spool_feeder(spool_queue):
+    sent = 0
+    sent_bytes = 0
+    starting_point = None
+    while not end_connection:
+        profiling.checkpoint()
+        job = spool_queue.get(timeout=1)
+        if job is None:
+            if starting_point is not None and sent:
+                elapsed = runtime.time_now() - starting_point
+                print(f"[Spool] Queue empty: {sent} files ({sent_bytes / 1e6:.1f} MB) in {elapsed:.2f} s, "
+                      f"{sent / max(elapsed, 1e-9):.1f} files/s")
+                sent = sent_bytes = 0
+                starting_point = None
+            continue
+        if starting_point is None:
+            starting_point = runtime.time_now()
+        try:
+            with open(job["path"], "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                send_stream(job["name"], f, size, max_fragment_size)
+        except (IOError, ValueError) as e:
+            print(f"[Spool] Job {job['id']} ({job['path']}) failed: {e}")
+            spool_queue.fail(job)
+            continue
+        spool_queue.done(job)
+        sent += 1
+        sent_bytes += size
 
 
 role = 0
@@ -670,17 +2114,41 @@ def main():
         # print("som W")
         role = 1
 
-    listener_thread = threading.Thread(target=listener, daemon=True)
-    sender_thread = threading.Thread(target=sender, daemon=True)
-    keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)  # New thread for keep-alive
+    listener_thread = runtime.Thread(target=listener, daemon=True)
+    sender_thread = runtime.Thread(target=sender, daemon=True)
+    keep_alive_thread = runtime.Thread(target=keep_alive, daemon=True)  # New thread for keep-alive
+    runtime.Thread(target=transfer_worker, daemon=True).start()
+    runtime.Thread(target=text_sender, daemon=True).start()
+    outbound.bundle_limit = max_fragment_size  # Bundles are as large as a fragment
+    size_socket_buffers()
+    if len(paths.paths) > 1:
+        runtime.Thread(target=path_monitor, daemon=True).start()
+
+    if args.daemon:
+        # No prompt: files come from the spool directory and the job socket, queued on disk across restarts
+        spool_queue = spool.SpoolQueue(args.daemon)
+        jobs_socket = args.jobs or os.path.join(args.daemon, spool.JOBS_SOCKET_NAME)
+        runtime.Thread(target=spool.serve_jobs, args=(spool_queue, jobs_socket), daemon=True).start()
+        runtime.Thread(target=spool_watcher, args=(spool_queue,), daemon=True).start()
+        sender_thread = runtime.Thread(target=spool_feeder, args=(spool_queue,), daemon=True)
+        print(f"[Spool] Daemon sending from {args.daemon} (job socket {jobs_socket}), {len(spool_queue)} jobs recovered")
 
     listener_thread.start()
     sender_thread.start()
     keep_alive_thread.start()
 
     listener_thread.join()
-    sender_thread.join()
     keep_alive_thread.join()
-
-
-main()
+    sender_thread.join(timeout=1)  # The prompt may sit in input(), it must not keep a closed connection alive
+    if sender_thread.is_alive():
+        # Interpreter shutdown would abort on the stdin lock held by that input(), so leave without it
+        if args.capture:
+            capture_writer.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    configure(parser.parse_args())
+    main()
@@ -0,0 +1,138 @@
+import selectors
+import socket
+import struct
+
+import kernelstats
+import runtime
+
+# Viac ciest (lokálna adresa -> vzdialená adresa) pre jednu reláciu. Fragmenty sa rozkladajú podľa váhy
+# cesty (RTT a strata z echo sond), mŕtva cesta dostane váhu 0 a prenos pokračuje po ostatných.
+
+PROBE_FORMAT = "!I d"  # číslo sondy, čas odoslania (time.monotonic odosielateľa)
+PROBE_SIZE = struct.calcsize(PROBE_FORMAT)
+PROBE_INTERVAL = 0.5
+PATH_DEAD_AFTER = 3.0  # Sekundy bez echa, po ktorých cestu prestaneme používať
+INITIAL_RTT = 0.01
+RTT_GAIN = 0.125  # EWMA ako pri TCP SRTT
+LOSS_GAIN = 0.1
+
+
+class Path:
+    def __init__(self, sock, remote, name):
+        self.socket = sock
+        self.remote = remote
+        self.name = name
+        self.srtt = INITIAL_RTT
+        self.loss = 0.0
+        self.last_echo = runtime.monotonic()
+        self.probe_sequence = 0
+        self.unanswered = {}  # probe sequence -> sent time
+        self.current = 0.0  # Smooth weighted round robin state
+        self.sent = 0
+        self.counts_overflow = False  # The socket reports kernel drops with every datagram (SO_RXQ_OVFL)
+        self.kernel_drops = 0
+        self.buffers = None  # (rcvbuf, sndbuf) after sizing for the session window
+
+    @property
+    def alive(self):
+        return runtime.monotonic() - self.last_echo < PATH_DEAD_AFTER
+
+    @property
+    def weight(self):
+        return (1.0 - self.loss) / max(self.srtt, 0.0001) if self.alive else 0.0
+
+    def next_probe(self, now):
+        self.probe_sequence += 1
+        # Probes older than the dead interval count as lost
+        for sequence, sent_at in list(self.unanswered.items()):
+            if now - sent_at >= PATH_DEAD_AFTER:
+                del self.unanswered[sequence]
+                self.loss += LOSS_GAIN * (1.0 - self.loss)
+        self.unanswered[self.probe_sequence] = now
+        return struct.pack(PROBE_FORMAT, self.probe_sequence, now)
+
+    def echo_received(self, body, now):
+        if len(body) < PROBE_SIZE:
+            return
+        sequence, sent_at = struct.unpack(PROBE_FORMAT, body[:PROBE_SIZE])
+        if self.unanswered.pop(sequence, None) is None:
+            return  # Duplicate or already counted as lost
+        self.srtt += RTT_GAIN * ((now - sent_at) - self.srtt)
+        self.loss -= LOSS_GAIN * self.loss
+        self.last_echo = now
+
+
+class PathSet:
+    def __init__(self, primary):
+        self.paths = [primary]
+        self.primary = primary
+        self.selector = None  # Only needed with a second path, one socket is read directly
+
+    def add(self, path):
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.primary.socket.fileno(), selectors.EVENT_READ, self.primary)
+        self.paths.append(path)
+        self.selector.register(path.socket.fileno(), selectors.EVENT_READ, path)
+
+    # Function to pick the path for the next datagram, smooth weighted round robin over living paths
+    def pick(self):
+        if len(self.paths) == 1:
+            return self.primary
+        total = 0.0
+        best = None
+        for path in self.paths:
+            weight = path.weight
+            if weight <= 0:
+                continue
+            path.current += weight
+            total += weight
+            if best is None or path.current > best.current:
+                best = path
+        if best is None:
+            return self.primary  # Every path looks dead, keep trying the primary one
+        best.current -= total
+        return best
+
+    # Function to send on a given Path, on the path towards an address, or on a picked path (route None)
+    def sendto(self, packet, route):
+        if isinstance(route, Path):
+            path = route
+        elif route is None:
+            path = self.pick()
+        else:
+            path = next((p for p in self.paths if p.remote == route), self.primary)
+            return path.socket.sendto(packet, route)
+        path.sent += 1
+        return path.socket.sendto(packet, path.remote)
+
+    # Function to receive from whichever path has data, raises socket.timeout like a socket would
+    def recvfrom(self, size, timeout):
+        if self.selector is None:
+            self.primary.socket.settimeout(timeout)
+            try:
+                return self._receive(self.primary, size)
+            except (BlockingIOError, ConnectionError):
+                raise socket.timeout("timed out")
+        for key, _ in self.selector.select(timeout):
+            try:
+                return self._receive(key.data, size)
+            except (BlockingIOError, socket.timeout, ConnectionError):
+                continue  # ICMP errors of one path must not stop the others
+        raise socket.timeout("timed out")
+
+    def _receive(self, path, size):
+        if path.counts_overflow:
+            data, ancdata, _, address = path.socket.recvmsg(size, kernelstats.OVERFLOW_CMSG_SPACE)
+            drops = kernelstats.overflow_count(ancdata)
+            if drops is not None:
+                path.kernel_drops = drops
+        else:
+            data, address = path.socket.recvfrom(size)
+        return data, address, path
+
+
+# Function to parse "LOCAL_IP REMOTE_IP[:PORT]" from --path
+def parse_path(local, remote, default_port):
+    host, _, port = remote.partition(":")
+    return local, (socket.gethostbyname(host), int(port) if port else default_port)
@@ -0,0 +1,909 @@
+import argparse
+import collections
+import contextlib
+import heapq
+import importlib.util
+import io
+import itertools
+import os
+import queue
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import delta
+import liveness
+import runtime
+import spool
+import teardown
+from protocol import (BLAST_MAX_TRAILERS, BLAST_TRAILER_TIMEOUT, DEFAULT_FRAGMENT_SIZE, EXT_BLAST_DONE, EXT_MSG_TYPE,
+                      HEARTBEAT_CHECKS, HEARTBEAT_INTERVAL, HEARTBEAT_MISSES)
+
+# Deterministický simulátor siete s virtuálnymi hodinami. Dve kópie main.py (A a B) bežia s vlastnými vláknami
+# (listener, sender, keep_alive, text_sender, transfer_worker, ...) nad simulovanými linkami (oneskorenie, jitter,
+# strata, preusporiadanie, šírka pásma s obmedzeným frontom). Čas, fronty a udalosti im cez runtime.install() dáva
+# VirtualRuntime: naraz beží len jedno vlákno a keď všetky čakajú, hodiny skočia na ďalšiu udalosť. Hodiny prenosu
+# cez 100 ms RTT sa tak odsimulujú za sekundy CPU a rovnaký --seed dá vždy rovnaké čísla.
+
+FRAGMENT_SIZE = DEFAULT_FRAGMENT_SIZE
+QUEUE_LIMIT = 256 * 1024  # Bajty čakajúce pred úzkym hrdlom linky, ďalšie sa zahodia
+ENGINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+ADDRESS_A = ("10.0.0.1", 5001)  # Port A je nižší: A je v keep_alive odpovedajúca strana, B iniciátor
+ADDRESS_B = ("10.0.0.2", 5002)
+CLOSE_RUNS = 200
+POLL_INTERVAL = 0.01  # Ako často scenár pozerá na stav kópií main.py (virtuálne sekundy)
+CLOCK_RESOLUTION = 1e-6  # Najmenší krok hodín: čakanie na zaokrúhlený zvyšok času vždy skončí
+STOP_GRACE = 5.0  # Skutočné sekundy na dobehnutie zaparkovaných vlákien po konci scenára
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+
+class Waiter:
+    # One blocking call of one thread: woken = an event or its timeout made it ready, running = it has the turn
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.woken = False
+        self.running = False
+
+
+class VirtualRuntime:
+    # runtime for main.py on simulated time: real threads, but only the one holding the turn runs. A blocking call
+    # (queue, event, condition, sleep, join, recvfrom) hands the turn to the next ready thread; when none is ready,
+    # the clock jumps to the next event (a datagram arriving, a timeout). stop() ends every thread of the scenario.
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()  # Equal times run in scheduling order
+        self.processed = 0
+        self.lock = threading.Lock()  # Guards the whole simulated world, held only inside its calls
+        self.ready = collections.deque()
+        self.parked = set()
+        self.threads = []
+        self.stopped = False
+
+    def call_at(self, when, callback, *args):
+        heapq.heappush(self.events, (when, next(self.sequence), callback, args))
+
+    def call_later(self, delay, callback, *args):
+        self.call_at(self.now + delay, callback, *args)
+
+    def time_now(self):
+        return self.now
+
+    monotonic = perf_counter = time_now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self._block(None, seconds)
+
+    def Queue(self, maxsize=0):
+        return VirtualQueue(self, maxsize)
+
+    def Event(self):
+        return VirtualEvent(self)
+
+    def Condition(self):
+        return VirtualCondition(self)
+
+    def Thread(self, target, args=(), daemon=None, name=None):
+        return VirtualThread(self, target, args, name)
+
+    # Function to end the scenario: every parked thread wakes up into SystemExit and unwinds
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            for waiter in self.parked:
+                waiter.running = True
+                waiter.condition.notify()
+        deadline = time.monotonic() + STOP_GRACE
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    # The calls below run with self.lock held
+    def _block(self, waiters, timeout):
+        if self.stopped:
+            raise SystemExit
+        waiter = Waiter(self.lock)
+        if waiters is not None:
+            waiters.append(waiter)
+        if timeout is not None:
+            self.call_later(max(CLOCK_RESOLUTION, timeout), self._wake, waiter)
+        self.parked.add(waiter)
+        self._pass_turn()
+        while not waiter.running:
+            waiter.condition.wait()
+        self.parked.discard(waiter)
+        if self.stopped:
+            raise SystemExit
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+
+    # Function to block until predicate() holds, False when timeout (None = forever) ran out first
+    def _wait_for(self, predicate, waiters, timeout=None):
+        deadline = None if timeout is None else self.now + timeout
+        while not predicate():
+            if deadline is not None and self.now >= deadline:
+                return False
+            self._block(waiters, None if deadline is None else deadline - self.now)
+        return True
+
+    def _pass_turn(self):
+        while not self.ready and self.events and not self.stopped:
+            when, _, callback, args = heapq.heappop(self.events)
+            self.now = max(self.now, when)
+            callback(*args)
+            self.processed += 1
+        if self.ready and not self.stopped:
+            waiter = self.ready.popleft()
+            waiter.running = True
+            waiter.condition.notify()
+
+    def _wake(self, waiter):
+        if not waiter.woken:
+            waiter.woken = True
+            self.ready.append(waiter)
+
+    # Function to wake count (None = all) of the threads waiting in waiters, skipping those already woken
+    def _notify(self, waiters, count=None):
+        while waiters and count != 0:
+            waiter = waiters.pop(0)
+            if not waiter.woken:
+                self._wake(waiter)
+                count = None if count is None else count - 1
+
+
+class VirtualThread:
+    def __init__(self, runtime, target, args, name):
+        self.runtime = runtime
+        self.target = target
+        self.args = args
+        self.name = name
+        self.daemon = True  # Never outlives its scenario, see VirtualRuntime.stop
+        self.finished = False
+        self.joiners = []
+
+    def start(self):
+        runtime = self.runtime
+        with runtime.lock:
+            waiter = Waiter(runtime.lock)
+            runtime.parked.add(waiter)
+            runtime._wake(waiter)  # Runs once the starting thread blocks
+        thread = threading.Thread(target=self._run, args=(waiter,), name=self.name, daemon=True)
+        runtime.threads.append(thread)
+        thread.start()
+
+    def _run(self, waiter):
+        runtime = self.runtime
+        with runtime.lock:
+            while not waiter.running:
+                waiter.condition.wait()
+            runtime.parked.discard(waiter)
+            if runtime.stopped:
+                return
+        try:
+            self.target(*self.args)
+        finally:
+            with runtime.lock:
+                self.finished = True
+                runtime._notify(self.joiners)
+                runtime._pass_turn()
+
+    def join(self, timeout=None):
+        with self.runtime.lock:
+            self.runtime._wait_for(lambda: self.finished, self.joiners, timeout)
+
+    def is_alive(self):
+        return not self.finished
+
+
+class VirtualQueue:
+    def __init__(self, runtime, maxsize=0):
+        self.runtime = runtime
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.getters = []
+        self.putters = []
+        self.unfinished_tasks = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.runtime.lock:
+            if not self.runtime._wait_for(self._has_room, self.putters, timeout if block else 0):
+                raise queue.Full
+            self.items.append(item)
+            self.unfinished_tasks += 1
+            self.runtime._notify(self.getters)
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        with self.runtime.lock:
+            if not self.runtime._wait_for(lambda: self.items, self.getters, timeout if block else 0):
+                raise queue.Empty
+            self.runtime._notify(self.putters)
+            return self.items.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        with self.runtime.lock:
+            self.unfinished_tasks -= 1
+
+    def _has_room(self):
+        return self.maxsize <= 0 or len(self.items) < self.maxsize
+
+    def empty(self):
+        return not self.items
+
+    def qsize(self):
+        return len(self.items)
+
+
+class VirtualEvent:
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.flag = False
+        self.waiters = []
+
+    def set(self):
+        with self.runtime.lock:
+            self.flag = True
+            self.runtime._notify(self.waiters)
+
+    def clear(self):
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def wait(self, timeout=None):
+        with self.runtime.lock:
+            return self.runtime._wait_for(lambda: self.flag, self.waiters, timeout)
+
+
+class VirtualCondition:
+    # Condition with its own (not reentrant) lock, as scheduler.py and writebehind.py use it
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.held = False
+        self.lockers = []
+        self.waiters = []
+
+    def acquire(self):
+        with self.runtime.lock:
+            self.runtime._wait_for(lambda: not self.held, self.lockers)
+            self.held = True
+
+    def release(self):
+        with self.runtime.lock:
+            self.held = False
+            self.runtime._notify(self.lockers, 1)
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def wait(self, timeout=None):
+        with self.runtime.lock:
+            self.held = False
+            self.runtime._notify(self.lockers, 1)
+            self.runtime._block(self.waiters, timeout)
+        self.acquire()
+        return True
+
+    def notify(self, count=1):
+        with self.runtime.lock:
+            self.runtime._notify(self.waiters, count)
+
+    def notify_all(self):
+        with self.runtime.lock:
+            self.runtime._notify(self.waiters)
+
+
+class Link:
+    # One direction of a path: serialization at bandwidth with a bounded queue, then delay, jitter, loss, reorder
+    def __init__(self, clock, rng, delay, bandwidth=0.0, loss=0.0, jitter=0.0, reorder=0.0, queue_limit=QUEUE_LIMIT):
+        self.clock = clock
+        self.rng = rng
+        self.delay = delay
+        self.bandwidth = bandwidth  # B/s, 0 = unlimited
+        self.loss = loss
+        self.jitter = jitter
+        self.reorder = reorder
+        self.queue_limit = queue_limit
+        self.busy_until = 0.0
+        self.up = True
+        self.sent = 0
+        self.lost = 0
+        self.queue_drops = 0
+
+    def send(self, size, deliver, packet):
+        self.sent += 1
+        now = self.clock.now
+        departure = now
+        if self.bandwidth:
+            start = self.busy_until if self.busy_until > now else now
+            if (start - now) * self.bandwidth > self.queue_limit:
+                self.queue_drops += 1
+                return
+            departure = self.busy_until = start + size / self.bandwidth
+        if not self.up or self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        arrival = departure + self.delay
+        if self.jitter:
+            arrival += self.rng.random() * self.jitter
+        if self.reorder and self.rng.random() < self.reorder:
+            arrival += self.delay  # Held back for one more one-way delay, overtaken by later datagrams
+        self.clock.call_at(arrival, deliver, packet)
+
+
+class Network:
+    # Two endpoints joined by a forward (A -> B) and a backward link with the same properties
+    def __init__(self, seed=1, rtt=0.0, bandwidth=0.0, loss=0.0, jitter=0.0, reorder=0.0, queue_limit=QUEUE_LIMIT):
+        self.clock = VirtualRuntime()
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.forward = Link(self.clock, self.rng, rtt / 2, bandwidth, loss, jitter, reorder, queue_limit)
+        self.backward = Link(self.clock, self.rng, rtt / 2, bandwidth, loss, jitter, reorder, queue_limit)
+
+
+class VirtualSocket:
+    # UDP socket of one endpoint: sendto hands the datagram to the outgoing link, the peer's recvfrom gets it on
+    # arrival. drop(datagram) -> True discards a datagram on purpose (a loss the scenario chose)
+    def __init__(self, runtime, address, link):
+        self.runtime = runtime
+        self.address = address
+        self.link = link
+        self.peer = None
+        self.received = collections.deque()
+        self.waiters = []
+        self.timeout = None
+        self.drop = None
+        self.options = {}
+
+    def sendto(self, data, address):
+        with self.runtime.lock:
+            if self.drop is None or not self.drop(data):
+                self.link.send(len(data), self.peer._deliver, (bytes(data), self.address))
+        return len(data)
+
+    def _deliver(self, datagram):
+        self.received.append(datagram)
+        self.runtime._notify(self.waiters)
+
+    def recvfrom(self, size):
+        with self.runtime.lock:
+            if not self.runtime._wait_for(lambda: self.received, self.waiters, self.timeout):
+                if self.timeout == 0:
+                    raise BlockingIOError
+                raise socket.timeout("timed out")
+            data, address = self.received.popleft()
+        return data[:size], address
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def getsockname(self):
+        return self.address
+
+    def getsockopt(self, level, option):
+        return self.options.get((level, option), SOCKET_BUFFER)
+
+    def setsockopt(self, level, option, value):
+        self.options[(level, option)] = value
+
+    def fileno(self):
+        return -1  # No kernel socket, kernelstats finds no drop counter
+
+    def close(self):
+        pass
+
+
+# Function to make main.py's sender() read the simulated user's commands; EOF once the connection ended,
+# as when stdin closes
+def command_reader(engine, commands):
+    def read_command(prompt):
+        while not engine.end_connection:
+            try:
+                return commands.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        raise EOFError
+    return read_command
+
+
+class Simulation:
+    # Two copies of main.py joined by network: A sends on network.forward, B on network.backward. Used as a context
+    # manager, the runtime is installed and the output of both copies collected only inside the with block
+    def __init__(self, network):
+        self.network = network
+        self.runtime = network.clock
+        self.output = io.StringIO()
+        self.directory = tempfile.mkdtemp(prefix="netsim")
+        self.commands = {}
+        self.engines = {}
+        self.sockets = {"A": VirtualSocket(self.runtime, ADDRESS_A, network.forward),
+                        "B": VirtualSocket(self.runtime, ADDRESS_B, network.backward)}
+        self.sockets["A"].peer = self.sockets["B"]
+        self.sockets["B"].peer = self.sockets["A"]
+        self.previous_runtime = None
+        self.redirect = contextlib.redirect_stdout(self.output)
+
+    def __enter__(self):
+        self.previous_runtime = runtime.install(self.runtime)
+        self.redirect.__enter__()
+        for name, local, remote in (("A", ADDRESS_A, ADDRESS_B), ("B", ADDRESS_B, ADDRESS_A)):
+            self.engines[name] = self._load(name, local, remote)
+        for engine in self.engines.values():
+            self.runtime.Thread(target=engine.main).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.runtime.stop()
+        self.redirect.__exit__(*exc_info)
+        runtime.install(self.previous_runtime)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _load(self, name, local, remote):
+        spec = importlib.util.spec_from_file_location(f"netsim_{name.lower()}", ENGINE_PATH)
+        engine = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(engine)
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory)
+        engine.configure(engine.parser.parse_args([
+            "--source", local[0], "--src_port", str(local[1]), "--destination", remote[0],
+            "--dest_port", str(remote[1]), "--no-resume", "--no-fsync"]), self.sockets[name])
+        engine.SESSION_CACHE_DIR = directory  # The handshake caches the session, not in the user's home
+        engine.default_directory = directory + os.sep
+        self.commands[name] = self.runtime.Queue()
+        engine.read_command = command_reader(engine, self.commands[name])
+        return engine
+
+    @property
+    def a(self):
+        return self.engines["A"]
+
+    @property
+    def b(self):
+        return self.engines["B"]
+
+    @property
+    def now(self):
+        return self.runtime.now
+
+    # Function to type a command into a side's prompt
+    def type(self, name, command):
+        self.commands[name].put(command)
+
+    # Function to let the simulation run until condition() holds or timeout simulated seconds passed
+    def wait_until(self, condition, timeout):
+        deadline = self.now + timeout
+        while not condition() and self.now < deadline:
+            self.runtime.sleep(POLL_INTERVAL)
+        return condition()
+
+    def wait_connected(self, timeout=30):
+        return self.wait_until(lambda: self.printed("[Handshake] Connected") == 2, timeout)
+
+    # Function to count a line printed by either copy of main.py
+    def printed(self, text):
+        return self.output.getvalue().count(text)
+
+    # Function to check that a side's prompt and transfer worker have nothing left to do
+    def idle(self, name):
+        engine = self.engines[name]
+        return not self.commands[name].qsize() and not engine.transfer_jobs.unfinished_tasks
+
+
+# Function to build a VirtualSocket drop filter losing the first datagram whose first byte (type and flags) matches
+def drop_first(first_byte, dropped):
+    def drop(datagram):
+        if datagram[0] == first_byte and not dropped:
+            dropped.append(datagram)
+            return True
+        return False
+    return drop
+
+
+# Function to simulate /file (stop-and-wait) or /blast <rate Mbit/s> of size random bytes from A to B.
+# drop(datagram) on B's socket loses chosen datagrams, e.g. the first BLAST_DONE
+def simulate_file(network, size, mode="stopwait", rate=0.0, fragment_size=FRAGMENT_SIZE, drop=None, timeout=3600):
+    data = random.Random(network.seed).randbytes(size)
+    with Simulation(network) as simulation:
+        source = os.path.join(simulation.directory, "source.bin")
+        with open(source, "wb") as f:
+            f.write(data)
+        simulation.sockets["B"].drop = drop
+        simulation.type("A", f"/max {fragment_size}")
+        connected = simulation.wait_connected()
+        started = simulation.now
+        simulation.type("A", f"/blast {rate} {source}" if mode == "blast" else f"/file {source}")
+        received = os.path.join(simulation.b.default_directory, "source.bin")
+        simulation.wait_until(lambda: simulation.idle("A") and os.path.exists(received), timeout)
+        elapsed = simulation.now - started
+        intact = os.path.exists(received)
+        if intact:
+            with open(received, "rb") as f:
+                intact = f.read() == data
+        return {"connected": connected, "time": elapsed, "intact": intact,
+                "confirmed": simulation.printed("[Sender] Time spend on sending file") == 1,
+                "duplicates": simulation.printed("[ID] Duplicate message ID detected"),
+                "nacks": simulation.printed("CRC mismatch")}
+
+
+# Function to simulate count text messages of message_size bytes typed into A's prompt, one every interval seconds
+def simulate_text(network, count, message_size, interval, timeout=3600):
+    with Simulation(network) as simulation:
+        simulation.wait_connected()
+        started = simulation.now
+        for _ in range(count):
+            simulation.type("A", "x" * message_size)
+            simulation.runtime.sleep(interval)
+        simulation.wait_until(lambda: simulation.idle("A") and not simulation.a.text_outbox.unfinished_tasks, timeout)
+        latencies = sorted(simulation.a.text_latencies)
+        return {"time": simulation.now - started, "delivered": simulation.printed("[Listener] Received message: "),
+                "p50": latencies[len(latencies) // 2], "max": latencies[-1],
+                "p99": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]}
+
+
+# Function to simulate one close: A types "/end fr" (closing_handshake), B answers from its listener
+def simulate_close(network):
+    with Simulation(network) as simulation:
+        simulation.wait_connected()
+        simulation.type("A", "/end fr")
+        engines = simulation.engines
+        simulation.wait_until(lambda: all(engine.close_state.closed for engine in engines.values()),
+                              2 * teardown.CLOSE_DEADLINE)
+        return {name: (engine.close_state.closed_at - engine.close_state.started_at, engine.close_state.clean)
+                for name, engine in engines.items() if engine.close_state.closed}
+
+
+# Function to simulate keep_alive on both roles, the killed side goes silent at kill_at (both links go down).
+# Returns {role: simulated time} for each side that declared the connection lost, the dead side not counted
+def simulate_keepalive(network, duration, kill_at=None, killed="responder"):
+    roles = {"responder": "A", "initiator": "B"}  # keep_alive role follows the higher port
+    with Simulation(network) as simulation:
+        simulation.wait_connected()
+        ended = lambda role: simulation.engines[roles[role]].end_connection
+        lost = lambda: {role: simulation.now for role in roles if ended(role)}
+        simulation.wait_until(lambda: any(map(ended, roles)), (duration if kill_at is None else kill_at) - simulation.now)
+        if kill_at is None or lost():
+            return lost()  # Ran out or a false alarm before the kill
+        network.forward.up = network.backward.up = False
+        survivor = "initiator" if killed == "responder" else "responder"
+        simulation.wait_until(lambda: ended(survivor), duration - simulation.now)
+        return {role: when for role, when in lost().items() if role == survivor}
+
+
+# Function to soak a LivenessTracker: heartbeats and control messages from more peers than it keeps, each update a
+# simulated millisecond apart. Returns the traced memory after a tenth of the updates and at the end, which must match
+def soak_liveness(updates, peers=1000, seed=1):
+    rng = random.Random(seed)
+    tracker = liveness.LivenessTracker()
+    tracemalloc.start()
+    try:
+        for update in range(updates):
+            if update == updates // 10:
+                warm = tracemalloc.get_traced_memory()[0]
+            now = update * 0.001
+            address = (f"10.0.{rng.randrange(peers) % 256}.{rng.randrange(256)}", 50000 + rng.randrange(peers))
+            tracker.heartbeat(address, now)
+            tracker.event(5, address, now)
+            if update % 100 == 0:
+                tracker.age(address, now)
+                tracker.recent_events(16)
+        end = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {"warm": warm, "end": end, "peers": len(tracker.last_seen), "events": len(tracker.events)}
+
+
+# Function to soak the daemon's spool: jobs files are dropped into a spool directory in batches and taken by
+# scan_spool, each taken job is "sent" (read) and marked done. Halfway the queue is abandoned with a job taken but
+# not sent and a torn journal line, as after a crash, and a new SpoolQueue recovers it. Every file must be sent at
+# least once, no recovered job may point to a removed file, and the journal and .queued must be empty at the end
+def soak_spool(jobs, batch=100):
+    sent = collections.Counter()
+    with tempfile.TemporaryDirectory() as directory:
+        spool_queue = spool.SpoolQueue(directory)
+        created = restarts = vanished = 0
+        started = time.perf_counter()
+        while created < jobs or len(spool_queue):
+            for number in range(created, min(created + batch, jobs)):
+                with open(os.path.join(directory, f"job{number:06d}"), "wb") as f:
+                    f.write(number.to_bytes(4, "big"))
+            created = min(created + batch, jobs)
+            spool.scan_spool(spool_queue, directory)
+            for _ in range(batch):
+                job = spool_queue.get(0)
+                if job is None:
+                    break
+                if not restarts and sum(sent.values()) == jobs // 2 + batch // 2:  # Mid-batch, done entries unsynced
+                    # Crash before the job is sent: the unflushed journal buffer is lost, a line is torn
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, spool_queue.journal.fileno())
+                    os.close(devnull)
+                    spool_queue.journal.close()
+                    with open(spool_queue.journal_path, "a") as journal:
+                        journal.write('{"id": ')
+                    spool_queue = spool.SpoolQueue(directory)
+                    restarts += 1
+                    break
+                try:
+                    with open(job["path"], "rb") as f:
+                        f.read()
+                except FileNotFoundError:  # spool_feeder fails such a job
+                    vanished += 1
+                    spool_queue.fail(job)
+                    continue
+                sent[job["name"]] += 1
+                spool_queue.done(job)
+        elapsed = time.perf_counter() - started
+        spool_queue.journal.close()
+        journal_size = os.path.getsize(os.path.join(directory, spool.JOURNAL_NAME))
+        left = len(os.listdir(os.path.join(directory, spool.QUEUED_DIR)))
+    lost = sum(1 for number in range(jobs) if not sent[f"job{number:06d}"])
+    return {"jobs": jobs, "sent": sum(sent.values()), "lost": lost, "vanished": vanished, "journal_size": journal_size,
+            "left": left, "restarts": restarts, "rate": jobs / elapsed}
+
+
+# Function to benchmark /delta: a file of size bytes with changed_percent of its blocks modified in place is
+# diffed against the old copy and rebuilt, the result must match the new file byte for byte
+def benchmark_delta(size, changed_percent, seed=1):
+    rng = random.Random(seed)
+    block_size = delta.block_size_for(size)
+    old = rng.randbytes(size)
+    new = bytearray(old)
+    blocks = size // block_size
+    changed = round(blocks * changed_percent / 100)
+    for block in rng.sample(range(blocks), changed):
+        offset = block * block_size + rng.randrange(block_size - 16)
+        new[offset:offset + 16] = rng.randbytes(16)
+
+    with tempfile.TemporaryDirectory() as directory:
+        old_path, new_path, rebuilt_path = (os.path.join(directory, name) for name in ("old", "new", "rebuilt"))
+        for path, data in ((old_path, old), (new_path, new)):
+            with open(path, "wb") as f:
+                f.write(data)
+        timings = {}
+        started = time.perf_counter()
+        signatures = delta.file_signatures(old_path, block_size)
+        timings["signatures"] = time.perf_counter() - started
+        with open(new_path, "rb") as f, tempfile.TemporaryFile() as stream:
+            started = time.perf_counter()
+            literal_bytes, matched_blocks = delta.compute_delta(f, signatures, block_size, stream)
+            timings["delta"] = time.perf_counter() - started
+            stream.seek(0)
+            delta_stream = stream.read()
+        started = time.perf_counter()
+        digest_ok = delta.apply_delta(old_path, delta_stream, block_size, rebuilt_path)
+        timings["apply"] = time.perf_counter() - started
+        with open(rebuilt_path, "rb") as f:
+            identical = f.read() == new
+    return {"block_size": block_size, "blocks": blocks, "changed": changed, "matched": matched_blocks,
+            "literal": literal_bytes, "delta_size": len(delta_stream), "signature_size": len(signatures),
+            "round_trip": digest_ok and identical, **timings}
+
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("B")
+    return int(float(text[:-1]) * units[text[-1]]) if text and text[-1] in units else int(text)
+
+
+def network_from(args, seed=None):
+    return Network(seed=args.seed if seed is None else seed, rtt=args.rtt / 1000, bandwidth=args.bandwidth * 1e6 / 8,
+                   loss=args.loss / 100, jitter=args.jitter / 1000, reorder=args.reorder / 100)
+
+
+def print_links(network):
+    for name, link in (("forward", network.forward), ("backward", network.backward)):
+        print(f"  {name:<9}{link.sent:>10} datagrams, {link.lost} lost, {link.queue_drops} queue drops")
+
+
+
+def file_command(args):
+    network = network_from(args)
+    size = parse_size(args.size)
+    if size > 65535 * args.fragment:
+        raise SystemExit(f"at most {65535 * args.fragment} B fit in one transfer with {args.fragment} B fragments")
+    cpu = time.process_time()
+    result = simulate_file(network, size, args.mode, args.rate, args.fragment)
+    cpu = time.process_time() - cpu
+    print(f"{args.mode} {size} B: {result['time']:.3f} s simulated, {size * 8 / max(result['time'], 1e-9) / 1e6:.3f} Mbit/s, "
+          f"received intact: {result['intact']}, sender confirmed: {result['confirmed']}")
+    print(f"  {result['duplicates']} packets dropped as duplicate message IDs, {result['nacks']} CRC mismatches")
+    print_links(network)
+    print(f"  {network.clock.processed} events in {cpu:.2f} s CPU")
+
+
+def text_command(args):
+    network = network_from(args)
+    result = simulate_text(network, args.messages, args.size, args.interval / 1000)
+    print(f"{args.messages} messages of {args.size} B: {result['time']:.3f} s simulated, {result['delivered']} delivered")
+    print(f"  latency p50 {result['p50'] * 1000:.1f} ms, p99 {result['p99'] * 1000:.1f} ms, max {result['max'] * 1000:.1f} ms")
+    print_links(network)
+
+
+def close_command(args):
+    results = {"A": [], "B": []}
+    for run in range(args.runs):
+        for name, outcome in simulate_close(network_from(args, args.seed + run)).items():
+            results[name].append(outcome)
+    for name, role in (("A", "initiator"), ("B", "responder")):
+        latencies = sorted(latency for latency, _ in results[name])
+        clean = sum(1 for _, ok in results[name] if ok)
+        print(f"{role:<10} close p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"p99 {latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000:.1f} ms, "
+              f"max {latencies[-1] * 1000:.1f} ms, confirmed {clean}/{args.runs}")
+
+
+def keepalive_command(args):
+    network = network_from(args)
+    lost = simulate_keepalive(network, args.duration, args.kill_at, args.killed)
+    for name in ("initiator", "responder"):
+        if name in lost:
+            since = f", {lost[name] - args.kill_at:.1f} s after the kill" if args.kill_at is not None else ""
+            print(f"{name:<10} declared the connection lost at {lost[name]:.1f} s{since}")
+        elif name != args.killed or args.kill_at is None:
+            print(f"{name:<10} kept the connection for {args.duration:.0f} s")
+
+
+def liveness_command(args):
+    result = soak_liveness(args.updates)
+    print(f"{args.updates} heartbeats: {result['warm']} B traced after {args.updates // 10}, {result['end']} B at the end "
+          f"({result['end'] - result['warm']:+d} B), {result['peers']} peers and {result['events']} events kept")
+
+
+def spool_command(args):
+    result = soak_spool(args.jobs)
+    print(f"{result['jobs']} jobs, {result['restarts']} restart: {result['sent']} sends, {result['lost']} lost, "
+          f"{result['vanished']} recovered without their file, "
+          f"journal {result['journal_size']} B, {result['left']} files left in {spool.QUEUED_DIR}, "
+          f"{result['rate']:.0f} files/s")
+
+
+def delta_command(args):
+    size = parse_size(args.size)
+    for percent in args.changed:
+        result = benchmark_delta(size, percent, args.seed)
+        sent = result["delta_size"] + result["signature_size"]
+        print(f"{percent:g} % of {result['blocks']} blocks ({result['block_size']} B) changed: "
+              f"{result['delta_size']} B delta + {result['signature_size']} B signatures = {sent * 100 / size:.1f} % "
+              f"of {size} B, {result['matched']} blocks reused, round trip {'ok' if result['round_trip'] else 'FAILED'}")
+        print(f"  signatures {result['signatures'] * 1000:.0f} ms, delta {result['delta'] * 1000:.0f} ms "
+              f"({size / max(result['delta'], 1e-9) / 1e6:.1f} MB/s), rebuild {result['apply'] * 1000:.0f} ms")
+
+
+# Function to run fixed scenarios and exit non-zero on a regression, the same --seed always gives the same verdict
+def check_command(args):
+    failures = []
+    link = 100e6 / 8
+
+    def verify(name, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {detail}")
+        if not ok:
+            failures.append(name)
+
+    for rtt, loss in ((0.3, 0.0), (0.1, 0.02)):
+        result = simulate_file(Network(args.seed, rtt, link, loss), 1 << 20)
+        verify(f"stopwait 1 MB, RTT {rtt * 1000:.0f} ms, loss {loss * 100:.0f} %", result["intact"] and result["confirmed"],
+               f"received intact {result['intact']}, sender confirmed {result['confirmed']}, {result['time']:.1f} s")
+
+    result = simulate_file(Network(args.seed, 0.1, link, 0.01), 20 << 20, "blast", 100)
+    verify("blast 20 MB, loss 1 %", result["intact"] and result["confirmed"],
+           f"received intact {result['intact']}, sender confirmed {result['confirmed']}, {result['time']:.1f} s")
+
+    # The receiver's BLAST_DONE is lost: the resent trailer needs a new msg_id, or it is dropped as a duplicate
+    dropped = []
+    result = simulate_file(Network(args.seed, 0.1, link), 1 << 20, "blast", 100,
+                           drop=drop_first(EXT_MSG_TYPE << 4 | EXT_BLAST_DONE, dropped),
+                           timeout=(BLAST_MAX_TRAILERS + 1) * BLAST_TRAILER_TIMEOUT + 60)
+    verify("blast 1 MB, first BLAST_DONE lost", bool(dropped) and result["intact"] and result["confirmed"],
+           f"sender confirmed {result['confirmed']}, {result['duplicates']} packets dropped as duplicate message IDs")
+
+    for loss, limit in ((0.0, 1.0), (0.01, 1.5)):
+        result = simulate_text(Network(args.seed, 0.1, link, loss), 1000, 20, 0.001)
+        verify(f"text 1000 messages, loss {loss * 100:.0f} %", result["delivered"] == 1000 and result["p99"] <= limit,
+               f"{result['delivered']} delivered, p99 {result['p99'] * 1000:.1f} ms, limit {limit * 1000:.0f} ms")
+
+    outcomes = [simulate_close(Network(args.seed + run, 0.1, link, 0.1)).get("A", (float("inf"), False))
+                for run in range(CLOSE_RUNS)]
+    slowest = max(latency for latency, _ in outcomes)
+    verify(f"close {CLOSE_RUNS} times, loss 10 %", slowest <= teardown.CLOSE_DEADLINE,
+           f"slowest {slowest * 1000:.1f} ms, confirmed {sum(clean for _, clean in outcomes)}/{CLOSE_RUNS}")
+
+    lost = simulate_keepalive(Network(args.seed, 0.1, link, 0.01), 3600)
+    verify("keepalive 1 h, loss 1 %", not lost, f"lost {lost}" if lost else "no false alarm")
+    limit = (HEARTBEAT_MISSES + 1) * (HEARTBEAT_INTERVAL + HEARTBEAT_CHECKS)
+    for killed, detector in (("responder", "initiator"), ("initiator", "responder")):
+        lost = simulate_keepalive(Network(args.seed, 0.1, link), 300, 100, killed)
+        detected = lost.get(detector, float("inf")) - 100
+        verify(f"keepalive, dead {killed}", detected <= limit, f"detected after {detected:.1f} s, limit {limit} s")
+
+    result = soak_liveness(200000, seed=args.seed)
+    verify("liveness 200000 heartbeats", result["end"] - result["warm"] <= 1024,
+           f"{result['warm']} B -> {result['end']} B traced, {result['peers']} peers kept")
+
+    result = soak_spool(2000)
+    verify("spool 2000 jobs, restart halfway",
+           not result["lost"] and not result["vanished"] and not result["journal_size"] and not result["left"],
+           f"{result['lost']} lost, {result['vanished']} recovered without their file, {result['sent'] - result['jobs']} "
+           f"sent twice, journal {result['journal_size']} B, {result['rate']:.0f} files/s")
+
+    for percent in (1, 10, 50):
+        result = benchmark_delta(1 << 20, percent, args.seed)
+        verify(f"delta 1 MB, {percent} % of blocks changed",
+               result["round_trip"] and result["matched"] == result["blocks"] - result["changed"],
+               f"round trip {'ok' if result['round_trip'] else 'FAILED'}, {result['matched']}/"
+               f"{result['blocks'] - result['changed']} unchanged blocks reused, {result['delta_size']} B delta")
+
+    if failures:
+        raise SystemExit(f"{len(failures)} checks failed")
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the protocol over a virtual network (deterministic per --seed)")
+    parser.add_argument("--rtt", type=float, default=100.0, help="Round trip time in ms")
+    parser.add_argument("--bandwidth", type=float, default=100.0, help="Link rate in Mbit/s, 0 = unlimited")
+    parser.add_argument("--loss", type=float, default=0.0, help="Datagram loss in %% per direction")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random one-way delay up to this many ms")
+    parser.add_argument("--reorder", type=float, default=0.0, help="%% of datagrams held back by one more one-way delay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fragment", type=int, default=FRAGMENT_SIZE, help="Fragment size in bytes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    file_parser = commands.add_parser("file", help="File transfer, stop-and-wait (/file) or blast (/blast)")
+    file_parser.add_argument("size", help="Bytes, K/M/G suffixes allowed")
+    file_parser.add_argument("--mode", choices=("stopwait", "blast"), default="stopwait")
+    file_parser.add_argument("--rate", type=float, default=0.0, help="Blast rate in Mbit/s, 0 = link rate")
+    file_parser.set_defaults(handler=file_command)
+
+    text_parser = commands.add_parser("text", help="Pipelined text messages, latency percentiles")
+    text_parser.add_argument("messages", type=int)
+    text_parser.add_argument("--size", type=int, default=20, help="Message size in bytes")
+    text_parser.add_argument("--interval", type=float, default=1.0, help="ms between two messages")
+    text_parser.set_defaults(handler=text_command)
+
+    close_parser = commands.add_parser("close", help="FIN / FIN-ACK / ACK teardown latency")
+    close_parser.add_argument("--runs", type=int, default=1000)
+    close_parser.set_defaults(handler=close_command)
+
+    keepalive_parser = commands.add_parser("keepalive", help="Heartbeats, time to detect a dead peer or false alarms")
+    keepalive_parser.add_argument("--duration", type=float, default=3600.0, help="Simulated seconds")
+    keepalive_parser.add_argument("--kill-at", type=float, help="Simulated second at which one side stops")
+    keepalive_parser.add_argument("--killed", choices=("initiator", "responder"), default="responder")
+    keepalive_parser.set_defaults(handler=keepalive_command)
+
+    liveness_parser = commands.add_parser("liveness", help="LivenessTracker memory under heartbeats from many peers")
+    liveness_parser.add_argument("--updates", type=int, default=1000000)
+    liveness_parser.set_defaults(handler=liveness_command)
+
+    spool_parser = commands.add_parser("spool", help="--daemon spool queue: files/s and recovery after a crash")
+    spool_parser.add_argument("--jobs", type=int, default=2000)
+    spool_parser.set_defaults(handler=spool_command)
+
+    delta_parser = commands.add_parser("delta", help="/delta on a local file pair, no network: size, time, round trip")
+    delta_parser.add_argument("--size", default="16M", help="Bytes, K/M/G suffixes allowed")
+    delta_parser.add_argument("--changed", type=float, nargs="+", default=[1, 10, 50], help="%% of blocks changed")
+    delta_parser.set_defaults(handler=delta_command)
+
+    check_parser = commands.add_parser("check", help="Fixed scenarios with invariants, exits 1 on a regression")
+    check_parser.set_defaults(handler=check_command)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import ctypes
+import os
+import queue
+import shutil
+import struct
+import threading
+
+import profiling
+
+# Balenie veľa malých súborov do jedného prúdu fragmentov: najprv index (počet, potom dĺžka mena, veľkosť, meno),
+# za ním obsahy súborov v poradí indexu. Príjemca prúd rozbaľuje priebežne a súbory vytvára po dávkach
+# v samostatnom vlákne, takže na jeden súbor nepripadá vlastný názov, ACK ani open/write/close v listeneri.
+
+INDEX_COUNT_FORMAT = "!I"
+INDEX_ENTRY_FORMAT = "!H Q"  # dĺžka mena (UTF-8, "/" medzi adresármi), veľkosť súboru
+INDEX_COUNT_SIZE = struct.calcsize(INDEX_COUNT_FORMAT)
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FORMAT)
+BATCH_BYTES = 1024 * 1024  # Dávka pre zapisovacie vlákno: toľko dát ...
+BATCH_FILES = 256  # ... alebo toľko súborov
+
+# syncfs(2) zapíše na disk len súborový systém rozbaľovaného balíka, je len na Linuxe (inde fsync každého súboru)
+try:
+    syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError, TypeError):
+    syncfs = None
+
+
+# Function to list the regular files under directory as (relative name, path, size), in a stable order
+def collect(directory):
+    entries = []
+    for root, directories, files in os.walk(directory):
+        directories.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                relative = os.path.relpath(path, directory).replace(os.sep, "/")
+                entries.append((relative, path, os.path.getsize(path)))
+    return entries
+
+
+def index_size(entries):
+    return INDEX_COUNT_SIZE + sum(INDEX_ENTRY_SIZE + len(name.encode("utf-8")) for name, _, _ in entries)
+
+
+# Function to split entries into packs of at most max_bytes each (index included), a bigger file gets its own pack
+def batches(entries, max_bytes):
+    batch = []
+    size = INDEX_COUNT_SIZE
+    for entry in entries:
+        entry_size = INDEX_ENTRY_SIZE + len(entry[0].encode("utf-8")) + entry[2]
+        if batch and size + entry_size > max_bytes:
+            yield batch
+            batch = []
+            size = INDEX_COUNT_SIZE
+        batch.append(entry)
+        size += entry_size
+    if batch:
+        yield batch
+
+
+class PackReader:
+    # File-like reader over index + contents, opens one source file at a time
+    def __init__(self, entries):
+        self.entries = entries
+        index = [struct.pack(INDEX_COUNT_FORMAT, len(entries))]
+        for name, _, size in entries:
+            encoded = name.encode("utf-8")
+            index.append(struct.pack(INDEX_ENTRY_FORMAT, len(encoded), size) + encoded)
+        self.buffer = b"".join(index)
+        self.size = len(self.buffer) + sum(size for _, _, size in entries)
+        self.position = 0
+        self.next_entry = 0
+        self.current = None
+        self.current_left = 0
+
+    def tell(self):
+        return self.position
+
+    def read(self, size):
+        parts = []
+        wanted = size
+        if self.buffer:
+            parts.append(self.buffer[:wanted])
+            self.buffer = self.buffer[wanted:]
+            wanted -= len(parts[-1])
+        while wanted > 0:
+            if self.current is None:
+                if self.next_entry == len(self.entries):
+                    break
+                _, path, self.current_left = self.entries[self.next_entry]
+                self.next_entry += 1
+                self.current = open(path, "rb")
+            data = self.current.read(min(wanted, self.current_left))
+            if len(data) < min(wanted, self.current_left):
+                raise IOError(f"{self.current.name} changed while it was being sent")
+            parts.append(data)
+            wanted -= len(data)
+            self.current_left -= len(data)
+            if self.current_left == 0:
+                self.current.close()
+                self.current = None
+        data = b"".join(parts)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Function to turn an index name into a safe path below directory, None for absolute names or ".." parts
+def safe_path(directory, name):
+    parts = name.split("/")
+    if not name or name.startswith("/") or any(part in ("", ".", "..") for part in parts):
+        return None
+    return os.path.join(directory, *parts)
+
+
+class Unpacker:
+    # Used like writebehind.WriteBehind (submit / backlog / finish / abort): parses the pack as it arrives and
+    # hands files to a writer thread in batches. Fragments may come out of order, they wait until contiguous.
+    def __init__(self, directory, fsync_on_complete=True):
+        self.directory = directory
+        self.fsync_on_complete = fsync_on_complete
+        self.expected_offset = 0
+        self.waiting = {}  # offset -> data received ahead of the contiguous part
+        self.header = bytearray()  # Index bytes not parsed yet
+        self.count = None
+        self.index = []
+        self.entries = None  # [(path or None, size)] once the index is complete
+        self.entry = 0
+        self.entry_offset = 0
+        self.batch = []
+        self.batch_bytes = 0
+        self.backlog = 0  # Bytes received but not yet written
+        self.files = 0
+        self.lock = threading.Lock()
+        self.error = None
+        self.batches = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, offset, data):
+        if self.error is not None:
+            raise self.error
+        if offset < self.expected_offset or offset in self.waiting:
+            return  # Duplicate fragment
+        with self.lock:
+            self.backlog += len(data)
+        if offset > self.expected_offset:
+            self.waiting[offset] = data
+            return
+        self._consume(data)
+        while self.expected_offset in self.waiting:
+            self._consume(self.waiting.pop(self.expected_offset))
+
+    def _consume(self, data):
+        self.expected_offset += len(data)
+        data = memoryview(data)
+        if self.entries is None:
+            data = self._read_index(data)
+            if self.entries is None:
+                return  # Index still incomplete
+        while len(data) and self.entry < len(self.entries):
+            path, size = self.entries[self.entry]
+            piece = data[:size - self.entry_offset]
+            data = data[len(piece):]
+            self._add(path, self.entry_offset, bytes(piece), self.entry_offset + len(piece) == size)
+            self.entry_offset += len(piece)
+            if self.entry_offset == size:
+                self.entry += 1
+                self.entry_offset = 0
+                self._skip_empty()
+        with self.lock:
+            self.backlog -= len(data)  # Bytes past the last file
+
+    # Function to parse as much of the index as has arrived, returns the data that follows a complete index
+    def _read_index(self, data):
+        self.header += data
+        with self.lock:
+            self.backlog -= len(data)
+        position = 0
+        if self.count is None:
+            if len(self.header) < INDEX_COUNT_SIZE:
+                return memoryview(b"")
+            self.count = struct.unpack_from(INDEX_COUNT_FORMAT, self.header)[0]
+            position = INDEX_COUNT_SIZE
+        while len(self.index) < self.count:
+            if len(self.header) < position + INDEX_ENTRY_SIZE:
+                break
+            name_length, size = struct.unpack_from(INDEX_ENTRY_FORMAT, self.header, position)
+            if len(self.header) < position + INDEX_ENTRY_SIZE + name_length:
+                break
+            position += INDEX_ENTRY_SIZE
+            name = self.header[position:position + name_length].decode("utf-8", "replace")
+            position += name_length
+            self.index.append((safe_path(self.directory, name), size))
+        del self.header[:position]  # Parsed entries are dropped, the rest waits for the next fragment
+        if len(self.index) < self.count:
+            return memoryview(b"")
+
+        self.entries = self.index
+        rest = memoryview(bytes(self.header))
+        self.header = bytearray()
+        with self.lock:
+            self.backlog += len(rest)
+        self._skip_empty()
+        return rest
+
+    # Function to create empty files right away, they never get a byte of data
+    def _skip_empty(self):
+        while self.entry < len(self.entries) and self.entries[self.entry][1] == 0:
+            self._add(self.entries[self.entry][0], 0, b"", True)
+            self.entry += 1
+
+    def _add(self, path, offset, data, last):
+        if path is None:
+            with self.lock:
+                self.backlog -= len(data)  # Unsafe name, the data is skipped
+            return
+        self.batch.append((path, offset, data, last))
+        self.batch_bytes += len(data)
+        if last:
+            self.files += 1
+        if self.batch_bytes >= BATCH_BYTES or len(self.batch) >= BATCH_FILES:
+            self._flush()
+
+    def _flush(self):
+        if self.batch:
+            self.batches.put(self.batch)
+            self.batch = []
+            self.batch_bytes = 0
+
+    # Writer thread: creates the files of a batch one after another, directories are created once.
+    # After the first error nothing more is written, later batches are only counted off the backlog.
+    def _run(self):
+        created_directories = set()
+        open_file = None
+        while True:
+            profiling.checkpoint()
+            batch = self.batches.get()
+            if batch is None:
+                break
+            if self.error is None:
+                try:
+                    for path, offset, data, last in batch:
+                        if offset == 0:
+                            directory = os.path.dirname(path)
+                            if directory not in created_directories:
+                                os.makedirs(directory, exist_ok=True)
+                                created_directories.add(directory)
+                            open_file = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                        if data:
+                            os.write(open_file, data)
+                        if last:
+                            if self.fsync_on_complete and syncfs is None:
+                                os.fsync(open_file)  # No syncfs for the whole pack in finish()
+                            os.close(open_file)
+                            open_file = None
+                except OSError as e:
+                    self.error = e
+                    open_file = close_quietly(open_file)
+            with self.lock:
+                self.backlog -= sum(len(data) for _, _, data, _ in batch)
+        close_quietly(open_file)
+
+    @property
+    def complete(self):
+        return self.entries is not None and self.entry == len(self.entries)
+
+    def finish(self):
+        self._flush()
+        self.batches.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if not self.complete:
+            raise IOError("Pack ended before all files arrived")
+        if self.fsync_on_complete:
+            self._sync()
+
+    # Function to make the unpacked files durable: one syncfs of the staging filesystem instead of an fsync per
+    # small file. Without syncfs the writer fsynced every file, the new names are made durable with their directories.
+    def _sync(self):
+        if syncfs is None:
+            if os.name == "posix":
+                for directory, _, _ in os.walk(self.directory):
+                    fsync_path(directory)
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            if syncfs(fd) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+        finally:
+            os.close(fd)
+
+    def abort(self):
+        self.batch = []
+        self.batches.put(None)
+        self.thread.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Function to close a descriptor of a failed write, the first error is the one reported; returns None
+def close_quietly(fd):
+    if fd is not None:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    return None
+
+
+# Function to move an unpacked directory into place, merging file by file when the target already exists
+def install(staging, target):
+    if not os.path.exists(target):
+        os.replace(staging, target)
+        return
+    for root, _, files in os.walk(staging):
+        destination = os.path.join(target, os.path.relpath(root, staging))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(root, name), os.path.join(destination, name))
+    shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,166 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import collections
+
+# Profilovanie za behu: /profile start zapne cProfile v každom vlákne pri jeho najbližšom checkpoint(),
+# /profile stop uloží pstats (snakeviz) a časovú os spanov pre speedscope.
+# Keď je vypnuté, checkpoint() a span_begin()/span_end() stoja len jedno porovnanie.
+
+STOP_GRACE = 1.0  # Ako dlho čakáme, kým vlákna samy vypnú svoj profiler
+HISTOGRAM_BUCKETS = 48  # log2 ns, posledný bucket pokrýva ~39 h
+MAX_SPAN_EVENTS = 200000  # Pamäť pre časovú os spanov je ohraničená
+
+active = False
+generation = 0
+thread_profiles = {}  # thread ident -> (generation, thread name, Profile)
+finished_profiles = []
+profiles_lock = threading.Lock()
+
+histograms = {}  # span name -> [count, total ns, buckets]
+span_events = collections.deque(maxlen=MAX_SPAN_EVENTS)  # (thread name, span name, start ns, end ns)
+started_at = 0
+
+
+# Function called from hot loops, (un)installs the profiler of the calling thread when the state changed
+def checkpoint():
+    if active or thread_profiles:
+        _sync_thread()
+
+
+def _sync_thread():
+    ident = threading.get_ident()
+    with profiles_lock:
+        entry = thread_profiles.get(ident)
+        if entry is not None and (not active or entry[0] != generation):
+            entry[2].disable()
+            del thread_profiles[ident]
+            if entry[0] == generation:
+                finished_profiles.append(entry[2])
+            entry = None
+        if active and entry is None:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                return  # Python 3.12+: one profiler already covers all threads
+            thread_profiles[ident] = (generation, threading.current_thread().name, profile)
+
+
+def start():
+    global active, generation, started_at
+    with profiles_lock:
+        generation += 1
+        finished_profiles.clear()
+    histograms.clear()
+    span_events.clear()
+    started_at = time.perf_counter_ns()
+    active = True
+    checkpoint()
+
+
+# Function to stop profiling and write <path> (pstats) and <path>.speedscope.json, returns span summary lines
+def stop(path):
+    global active
+    active = False
+    checkpoint()
+    deadline = time.monotonic() + STOP_GRACE
+    while time.monotonic() < deadline and any(entry[0] == generation for entry in thread_profiles.values()):
+        time.sleep(0.05)  # Threads blocked in recv/input reach their checkpoint later
+
+    with profiles_lock:
+        profiles = finished_profiles[:] + [entry[2] for entry in thread_profiles.values() if entry[0] == generation]
+        finished_profiles.clear()
+
+    stats = None
+    for profile in profiles:
+        profile.snapshot_stats()  # Does not disable, safe for profilers still running in a blocked thread
+        part = pstats.Stats()
+        part.stats = dict(profile.stats)
+        part.get_top_level_stats()
+        if stats is None:
+            stats = part
+        else:
+            stats.add(part)
+    if stats is not None:
+        stats.dump_stats(path)
+    write_speedscope(path + ".speedscope.json")
+    return summary()
+
+
+# Function to start a timing span, returns 0 (nothing to measure) when profiling is off
+def span_begin():
+    return time.perf_counter_ns() if active else 0
+
+
+def span_end(name, begin):
+    if not begin:
+        return
+    end = time.perf_counter_ns()
+    duration = end - begin
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms.setdefault(name, [0, 0, [0] * HISTOGRAM_BUCKETS])
+    histogram[0] += 1
+    histogram[1] += duration
+    histogram[2][min(duration.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+    span_events.append((threading.current_thread().name, name, begin, end))
+
+
+def _percentile(buckets, count, fraction):
+    target = count * fraction
+    seen = 0
+    for bucket, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= target:
+            return 1 << bucket  # Upper bound of the bucket in ns
+    return 1 << (len(buckets) - 1)
+
+
+def summary():
+    lines = []
+    for name, (count, total, buckets) in sorted(histograms.items()):
+        lines.append(f"{name:<12}{count:>9} x  mean {total / count / 1000:9.1f} us  "
+                     f"p50 <{_percentile(buckets, count, 0.5) / 1000:9.1f} us  "
+                     f"p99 <{_percentile(buckets, count, 0.99) / 1000:9.1f} us")
+    return lines
+
+
+# Function to export the recorded spans as a speedscope evented profile, one profile per thread
+def write_speedscope(path):
+    frames = []
+    frame_index = {}
+    per_thread = {}
+    for thread_name, name, begin, end in span_events:
+        if name not in frame_index:
+            frame_index[name] = len(frames)
+            frames.append({"name": name})
+        per_thread.setdefault(thread_name, []).append((begin - started_at, end - started_at, frame_index[name]))
+
+    profiles = []
+    for thread_name, spans in per_thread.items():
+        spans.sort(key=lambda span: (span[0], -span[1]))
+        events = []
+        stack = []
+        for begin, end, frame in spans:
+            while stack and stack[-1][0] <= begin:
+                closed_end, closed_frame = stack.pop()
+                events.append({"type": "C", "frame": closed_frame, "at": closed_end})
+            if stack:
+                end = min(end, stack[-1][0])  # Keep events properly nested
+            events.append({"type": "O", "frame": frame, "at": begin})
+            stack.append((end, frame))
+        while stack:
+            closed_end, closed_frame = stack.pop()
+            events.append({"type": "C", "frame": closed_frame, "at": closed_end})
+        profiles.append({"type": "evented", "name": thread_name, "unit": "nanoseconds",
+                         "startValue": spans[0][0], "endValue": events[-1]["at"], "events": events})
+
+    document = {"$schema": "https://www.speedscope.app/file-format-schema.json",
+                "shared": {"frames": frames}, "profiles": profiles,
+                "name": os.path.basename(path), "exporter": "main.py /profile"}
+    with open(path, "w") as f:
+        json.dump(document, f)
@@ -0,0 +1,145 @@
+import binascii
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Hlavička každého paketu: typ+flags, dĺžka dát, ID správy, počet fragmentov, číslo fragmentu, CRC
+HEADER_FORMAT = "!B H B H H H"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_PACKET_SIZE = 1500
+DEFAULT_FRAGMENT_SIZE = 1490
+
+# Časovače a okná protokolu, main.py aj netsim.py ich berú odtiaľto, aby simulátor meral to isté
+ACK_TIMEOUT = 0.2  # send_with_ack pošle paket znova, keď ACK nepríde
+TEXT_WINDOW = 64  # Najviac textových fragmentov na ceste naraz (nad dohodnuté okno session nejdeme)
+TEXT_ACK_TIMEOUT = 0.2
+BLAST_REPORT_INTERVAL = 0.25  # Príjemca hlási medzery najviac 4x za sekundu
+BLAST_REORDER_SLACK = 64  # Fragmenty tesne pod najvyšším prijatým ešte môžu byť na ceste
+BLAST_TRAILER_TIMEOUT = 0.5
+BLAST_MAX_TRAILERS = 20  # Toľko trailerov bez odpovede a prenos sa vzdá
+HEARTBEAT_INTERVAL = 2  # Iniciátor čaká po heartbeate, kým začne kontrolovať odpoveď
+HEARTBEAT_CHECKS = 3  # ... potom tri kontroly po sekunde
+HEARTBEAT_MISSES = 3  # Po troch zmeškaných heartbeatoch za sebou je spojenie stratené
+RESPONDER_WINDOW = 5  # Odpovedajúca strana počíta zmeškaný heartbeat po 5 s ticha
+
+# Každý textový fragment začína 2-bajtovým ID správy, aby sa správy mohli prekrývať
+TEXT_PREFIX_FORMAT = "!H"
+TEXT_PREFIX_SIZE = struct.calcsize(TEXT_PREFIX_FORMAT)
+
+# Paket, na ktorý sa odpovedá (prvý bajt hlavičky a číslo fragmentu), v tele ACK za oknom a v odmietnutí typu 10
+PACKET_KEY_FORMAT = "!B H"
+PACKET_KEY_SIZE = struct.calcsize(PACKET_KEY_FORMAT)
+
+# Typ 9 je rozšírenie protokolu, konkrétny podtyp nesú flags
+EXT_MSG_TYPE = 9
+EXT_FILE_DIGEST = 1  # Trailer s BLAKE2b odtlačkom celého súboru
+EXT_DELTA_REQUEST = 2  # Žiadosť o podpisy blokov existujúceho súboru u príjemcu
+EXT_DELTA_SIGNATURE = 3  # Fragment zoznamu podpisov blokov
+EXT_PARALLEL_OFFER = 4  # Ponuka paralelného prenosu súboru cez viac socketov
+EXT_PARALLEL_PORTS = 5  # Porty, na ktorých príjemca čaká jednotlivé shardy
+EXT_PARALLEL_DONE = 6  # Koniec paralelného prenosu s odtlačkom súboru
+EXT_BLAST_NACK = 7  # Rozsahy fragmentov, ktoré príjemcovi blast prenosu chýbajú ("!H H" prvý, posledný)
+EXT_BLAST_DONE = 8  # Jediné potvrdenie celého blast prenosu, "!B" 1 = odtlačok sedí
+EXT_BUNDLE = 9  # Viac malých paketov v jednom datagrame, každý s "!H" dĺžkou pred sebou
+EXT_RECEIVER_DROPS = 10  # "!I" datagramy, ktoré jadro príjemcu zahodilo počas blast prenosu (preťaženie, nie strata)
+
+# Rovnaké rozloženie ako HEADER_FORMAT, pre hlavičky celej dávky fragmentov v jednom poli
+HEADER_DTYPE = numpy.dtype([("first_byte", "u1"), ("length", ">u2"), ("msg_id", "u1"), ("total_fragments", ">u2"),
+                            ("current_fragment", ">u2"), ("crc", ">u2")]) if numpy is not None else None
+
+
+def crc16(data: bytes, poly: int = 0x1021, init_value: int = 0xFFFF) -> int:
+    if poly == 0x1021:
+        return binascii.crc_hqx(data, init_value)  # Same CRC-16/CCITT, computed in C
+
+    crc = init_value
+    for byte in data:
+        crc ^= (byte << 8)  # Align the byte with the high byte of CRC
+        for _ in range(8):  # Process each bit
+            if crc & 0x8000:  # If the highest bit is set
+                crc = (crc << 1) ^ poly  # XOR with the polynomial
+            else:
+                crc = crc << 1  # Just shift left
+            crc &= 0xFFFF  # Ensure CRC remains a 16-bit value
+    return crc
+
+
+# Function to parse a message header
+def parse_header(header: bytes):
+    unpacked = struct.unpack(HEADER_FORMAT, header)
+
+    # Extract message type and flags from the first byte
+    first_byte = unpacked[0]
+    msg_type = (first_byte >> 4) & 0xF
+    flags = first_byte & 0xF
+
+    # Return header fields as a dictionary
+    return {
+        "msg_type": msg_type,
+        "flags": flags,
+        "length": unpacked[1],
+        "msg_id": unpacked[2],
+        "total_fragments": unpacked[3],
+        "current_fragment": unpacked[4],
+        "crc": unpacked[5]
+    }
+
+
+# Function to build the headers of all fragments of a contiguous block at once, returns HEADER_SIZE bytes per fragment.
+# msg_id is left 0, the sender stamps it (set_msg_id) right before each transmission.
+def build_headers(msg_type: int, flags: int, block, fragment_size: int, total_fragments: int, first_fragment: int,
+                  with_crc: bool = True) -> bytes:
+    count = (len(block) + fragment_size - 1) // fragment_size
+    if msg_type < 0 or msg_type > 15 or flags < 0 or flags > 15:
+        raise ValueError(f"msg_type/flags out of range: {msg_type}/{flags}")
+    if total_fragments > 65535 or first_fragment < 0 or first_fragment + count - 1 > 65535:
+        raise ValueError(f"Fragments {first_fragment}..{first_fragment + count - 1} out of range")
+    if HEADER_SIZE + fragment_size > MAX_PACKET_SIZE:
+        raise ValueError(f"Packet size exceeds the allowable limit: {HEADER_SIZE + fragment_size} bytes")
+
+    if with_crc:
+        crcs = [binascii.crc_hqx(block[start:start + fragment_size], 0xFFFF)
+                for start in range(0, len(block), fragment_size)]
+    else:
+        crcs = [0] * count
+    last_length = len(block) - (count - 1) * fragment_size
+
+    if numpy is not None:
+        headers = numpy.zeros(count, dtype=HEADER_DTYPE)
+        headers["first_byte"] = (msg_type << 4) | flags
+        headers["length"] = fragment_size
+        headers["length"][-1:] = last_length
+        headers["total_fragments"] = total_fragments
+        headers["current_fragment"] = numpy.arange(first_fragment, first_fragment + count)
+        headers["crc"] = crcs
+        return headers.tobytes()
+
+    headers = bytearray(count * HEADER_SIZE)
+    first_byte = (msg_type << 4) | flags
+    for i, crc in enumerate(crcs):
+        length = fragment_size if i < count - 1 else last_length
+        struct.pack_into(HEADER_FORMAT, headers, i * HEADER_SIZE, first_byte, length, 0, total_fragments,
+                         first_fragment + i, crc)
+    return bytes(headers)
+
+
+# Function to name a packet in its ACK or refusal, a late answer to an earlier packet then does not match
+def packet_key(first_byte: int, current_fragment: int) -> bytes:
+    return struct.pack(PACKET_KEY_FORMAT, first_byte, current_fragment)
+
+
+def set_msg_id(header: bytes, msg_id: int) -> bytes:
+    return header[:3] + bytes((msg_id,)) + header[4:]
+
+
+def split_bundle(body):
+    packets = []
+    pos = 0
+    while pos + 2 <= len(body):
+        length = struct.unpack_from("!H", body, pos)[0]
+        packets.append(body[pos + 2:pos + 2 + length])
+        pos += 2 + length
+    return packets
@@ -0,0 +1,61 @@
+import queue
+import threading
+import time
+
+# Čas, čakanie a vlákna, cez ktoré beží main.py (a scheduler, writebehind, liveness, multipath, blast).
+# V programe sú to priamo time, threading a queue; netsim.py cez install() podstrčí virtuálne hodiny,
+# takže rovnaký kód protokolu beží nad simulovanou sieťou bez skutočného čakania.
+
+
+class RealRuntime:
+    time_now = staticmethod(time.time)
+    monotonic = staticmethod(time.monotonic)
+    perf_counter = staticmethod(time.perf_counter)
+    sleep = staticmethod(time.sleep)
+    Queue = queue.Queue
+    Event = threading.Event
+    Condition = threading.Condition
+    Thread = threading.Thread
+
+
+current = RealRuntime()
+
+
+# Function to replace the runtime, objects created before keep the one they were created with
+def install(replacement):
+    global current
+    previous = current
+    current = replacement
+    return previous
+
+
+def time_now():
+    return current.time_now()
+
+
+def monotonic():
+    return current.monotonic()
+
+
+def perf_counter():
+    return current.perf_counter()
+
+
+def sleep(seconds):
+    current.sleep(seconds)
+
+
+def Queue(maxsize=0):
+    return current.Queue(maxsize)
+
+
+def Event():
+    return current.Event()
+
+
+def Condition():
+    return current.Condition()
+
+
+def Thread(target, args=(), daemon=None, name=None):
+    return current.Thread(target=target, args=args, daemon=daemon, name=name)
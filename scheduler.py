@@ -0,0 +1,100 @@
+import collections
+
+import profiling
+import runtime
+
+# Odchádzajúce pakety idú cez jedno vlákno s prioritnými triedami:
+# riadiace pakety (ACK, heartbeat, FIN, ...) vždy prvé, text a bulk (súbory) sa striedajú podľa váh.
+# Malé pakety (coalesce) pre tú istú adresu sa môžu spojiť do jedného datagramu cez funkciu bundle.
+
+PRIORITY_CONTROL = 0
+PRIORITY_TEXT = 1
+PRIORITY_BULK = 2
+
+TEXT_WEIGHT = 4  # Koľko textových paketov môže ísť pred jedným bulk paketom, keď čakajú oba
+BULK_LIMIT = 64  # Najviac čakajúcich bulk paketov, odosielateľ súboru sa potom zablokuje
+FLUSH_DELAY = 0.002  # Nagle: najdlhšie čakanie na ďalšie malé pakety, ak odosielateľ nepožiadal o flush
+BUNDLE_OVERHEAD = 2  # Dĺžka pred každým vnoreným paketom
+
+
+class OutboundScheduler:
+    def __init__(self, send, text_weight=TEXT_WEIGHT, bulk_limit=BULK_LIMIT, bundle=None, bundle_limit=0,
+                 flush_delay=FLUSH_DELAY):
+        self.send = send
+        self.text_weight = text_weight
+        self.bulk_limit = bulk_limit
+        self.bundle = bundle  # bundle(packets) -> one datagram carrying all of them
+        self.bundle_limit = bundle_limit  # Largest bundle body, 0 disables coalescing
+        self.flush_delay = flush_delay
+        self.queues = (collections.deque(), collections.deque(), collections.deque())
+        self.text_credit = text_weight
+        self.condition = runtime.Condition()
+        self.thread = runtime.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # coalesce: the packet may share a datagram; flush=False: more small packets follow, wait briefly for them
+    def submit(self, packet, address, priority, coalesce=False, flush=True):
+        with self.condition:
+            if priority == PRIORITY_BULK:
+                while len(self.queues[PRIORITY_BULK]) >= self.bulk_limit:
+                    self.condition.wait()
+            self.queues[priority].append((packet, address, coalesce, flush))
+            self.condition.notify_all()
+
+    # Weighted round robin between text and bulk, control is strict priority
+    def _next(self):
+        control, text, bulk = self.queues
+        if control:
+            return control.popleft()
+        if text and (self.text_credit > 0 or not bulk):
+            self.text_credit -= 1
+            return text.popleft()
+        self.text_credit = self.text_weight
+        return bulk.popleft()
+
+    # Function to move coalescible packets for the same address from the heads of the control and text queues
+    def _gather(self, batch, address, size):
+        flush = False
+        for queue in self.queues[:PRIORITY_BULK]:
+            while queue:
+                packet, packet_address, coalesce, packet_flush = queue[0]
+                if not coalesce or packet_address != address or size + BUNDLE_OVERHEAD + len(packet) > self.bundle_limit:
+                    return size, True  # Keep the order, whatever is next goes out on its own
+                queue.popleft()
+                batch.append(packet)
+                size += BUNDLE_OVERHEAD + len(packet)
+                flush = flush or packet_flush
+        return size, flush
+
+    def _run(self):
+        while True:
+            profiling.checkpoint()
+            with self.condition:
+                while not any(self.queues):
+                    self.condition.wait(1)
+                    profiling.checkpoint()
+                packet, address, coalesce, flush = self._next()
+                batch = [packet]
+                if coalesce and self.bundle is not None and BUNDLE_OVERHEAD + len(packet) <= self.bundle_limit:
+                    size = BUNDLE_OVERHEAD + len(packet)
+                    deadline = runtime.monotonic() + self.flush_delay
+                    while True:
+                        size, gathered_flush = self._gather(batch, address, size)
+                        flush = flush or gathered_flush
+                        remaining = deadline - runtime.monotonic()
+                        if flush or self.queues[PRIORITY_BULK] or remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                self.condition.notify_all()  # Wake a bulk sender waiting for room
+            if len(batch) > 1:
+                packet = self.bundle(batch)
+            span = profiling.span_begin()
+            try:
+                self.send(packet, address)
+            except OSError:
+                pass  # UDP: a failed send is handled like a lost datagram
+            profiling.span_end("send", span)
+
+    def pending(self):
+        with self.condition:
+            return sum(len(queue) for queue in self.queues)
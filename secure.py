@@ -0,0 +1,122 @@
+import hashlib
+import struct
+
+# Voliteľné šifrovanie relácie: X25519 výmena kľúčov v SYN / SYN-ACK, potom AEAD pre každý datagram.
+# Nonce = 4 B číslo streamu + 8 B počítadlo, takže pakety môžu prísť v ľubovoľnom poradí
+# a každý proces (shard worker) posiela pod vlastným streamom bez rizika opakovania nonce.
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.exceptions import InvalidTag
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+SEALED_MSG_TYPE = 4  # Zašifrovaný datagram, vo vnútri je bežný paket s hlavičkou
+SEALED_FORMAT = "!B I Q"  # typ << 4, stream, počítadlo (spolu tvoria nonce, sú aj associated data)
+SEALED_PREFIX_SIZE = struct.calcsize(SEALED_FORMAT)
+TAG_SIZE = 16
+SEAL_OVERHEAD = SEALED_PREFIX_SIZE + TAG_SIZE
+
+PUBLIC_KEY_SIZE = 32
+KEY_EXCHANGE_FORMAT = "!32s B"  # X25519 verejný kľúč, id šifry
+KEY_EXCHANGE_SIZE = struct.calcsize(KEY_EXCHANGE_FORMAT)
+
+REPLAY_WINDOW = 1024  # Koľko posledných počítadiel si pamätáme na odhalenie zopakovaných paketov
+
+# Pluggable ciphers, any class with encrypt(nonce, data, aad) / decrypt(nonce, data, aad) fits
+CIPHERS = {}
+if AVAILABLE:
+    CIPHERS = {1: ("chacha20-poly1305", ChaCha20Poly1305), 2: ("aes-256-gcm", AESGCM)}
+
+
+def cipher_id(name):
+    for number, (cipher_name, _) in CIPHERS.items():
+        if cipher_name == name:
+            return number
+    raise ValueError(f"Unknown cipher {name}, choose from {[n for n, _ in CIPHERS.values()]}")
+
+
+class KeyExchange:
+    # Ephemeral X25519 key pair of this process
+    def __init__(self, cipher_name):
+        self.private_key = X25519PrivateKey.generate()
+        self.public_key = self.private_key.public_key().public_bytes_raw()
+        self.cipher = cipher_id(cipher_name)
+
+    def offer(self):
+        return struct.pack(KEY_EXCHANGE_FORMAT, self.public_key, self.cipher)
+
+    # Function to derive the session cipher from the peer's offer, both sides get mirrored keys
+    def session_cipher(self, peer_offer, salt):
+        peer_public_key, peer_cipher = struct.unpack(KEY_EXCHANGE_FORMAT, peer_offer[:KEY_EXCHANGE_SIZE])
+        number = min(self.cipher, peer_cipher)
+        if number not in CIPHERS:
+            raise ValueError(f"Peer offered unknown cipher {peer_cipher}")
+        shared = self.private_key.exchange(X25519PublicKey.from_public_bytes(peer_public_key))
+        keys = hashlib.blake2b(shared + b"".join(sorted((self.public_key, peer_public_key))), digest_size=64,
+                               salt=salt[:16], person=b"pks-session").digest()
+        if self.public_key < peer_public_key:
+            send_key, receive_key = keys[:32], keys[32:]
+        else:
+            send_key, receive_key = keys[32:], keys[:32]
+        name, aead = CIPHERS[number]
+        return SessionCipher(name, aead(send_key), aead(receive_key))
+
+
+class SessionCipher:
+    def __init__(self, name, send_aead, receive_aead, stream=0):
+        self.name = name
+        self.send_aead = send_aead
+        self.receive_aead = receive_aead
+        self.stream = stream
+        self.counter = 0
+        self.next_stream = stream + 1
+        self.replay = {}  # stream -> (highest counter, bitmap of the counters below it)
+
+    # Function to get a cipher with its own nonce stream, e.g. for a forked shard worker
+    def new_stream(self):
+        stream = self.next_stream
+        self.next_stream += 1
+        return SessionCipher(self.name, self.send_aead, self.receive_aead, stream)
+
+    def seal(self, packet):
+        prefix = struct.pack(SEALED_FORMAT, SEALED_MSG_TYPE << 4, self.stream, self.counter)
+        self.counter += 1
+        return prefix + self.send_aead.encrypt(prefix[1:], packet, prefix)
+
+    # Function to authenticate and decrypt a sealed datagram, returns None for forged or replayed ones
+    def open(self, datagram):
+        if len(datagram) < SEAL_OVERHEAD:
+            return None
+        prefix = datagram[:SEALED_PREFIX_SIZE]
+        _, stream, counter = struct.unpack(SEALED_FORMAT, prefix)
+        if not self._fresh(stream, counter):
+            return None
+        try:
+            packet = self.receive_aead.decrypt(prefix[1:], datagram[SEALED_PREFIX_SIZE:], prefix)
+        except InvalidTag:
+            return None
+        self._remember(stream, counter)
+        return packet
+
+    def _fresh(self, stream, counter):
+        highest, seen = self.replay.get(stream, (-1, 0))
+        if counter > highest:
+            return True
+        offset = highest - counter
+        return offset < REPLAY_WINDOW and not seen >> offset & 1
+
+    def _remember(self, stream, counter):
+        highest, seen = self.replay.get(stream, (-1, 0))
+        if counter > highest:
+            seen = (seen << (counter - highest) | 1) & ((1 << REPLAY_WINDOW) - 1)
+            highest = counter
+        else:
+            seen |= 1 << (highest - counter)
+        self.replay[stream] = (highest, seen)
+
+
+def is_sealed(datagram):
+    return len(datagram) > 0 and datagram[0] >> 4 == SEALED_MSG_TYPE
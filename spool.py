@@ -0,0 +1,215 @@
+import argparse
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# Perzistentný front odchádzajúcich súborov pre režim démona. Front je žurnál (JSON riadky "add" / "done")
+# v spool adresári, po reštarte sa z neho obnovia všetky neodoslané úlohy (súbor v prenose sa pošle znova).
+# Úlohy prichádzajú dvomi cestami: súbory vložené do spool adresára a cesty poslané cez lokálny Unix socket.
+
+JOURNAL_NAME = ".queue.log"
+QUEUED_DIR = ".queued"  # Súbory prevzaté zo spool adresára, patria frontu a po odoslaní sa zmažú
+FAILED_DIR = ".failed"
+JOBS_SOCKET_NAME = ".jobs.sock"
+TEMPORARY_SUFFIXES = (".tmp", ".part")  # Súbor sa ešte zapisuje, prevezmeme ho až po premenovaní
+SCAN_INTERVAL = 0.5
+SYNC_INTERVAL = 0.05  # Najviac takto dlho sa zozbierané zápisy do žurnálu nefsyncnú
+
+
+class SpoolQueue:
+    def __init__(self, directory):
+        self.directory = directory
+        self.queued_directory = os.path.join(directory, QUEUED_DIR)
+        self.journal_path = os.path.join(directory, JOURNAL_NAME)
+        os.makedirs(self.queued_directory, exist_ok=True)
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()  # job id -> job, in queue order
+        self.in_flight = {}
+        self.next_id = 1
+        self.last_sync = time.monotonic()
+        self._recover()
+
+    # Function to replay the journal, adopt orphaned spool files and rewrite the journal with pending jobs only
+    def _recover(self):
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Torn last line after a crash
+                    if "done" in entry:
+                        self.pending.pop(entry["done"], None)
+                    else:
+                        self.pending[entry["id"]] = entry
+                        self.next_id = max(self.next_id, entry["id"] + 1)
+        except FileNotFoundError:
+            pass
+
+        for job_id, job in list(self.pending.items()):
+            if job["owned"] and not os.path.exists(job["path"]):
+                del self.pending[job_id]  # Sent and removed, only its lazily synced done entry was lost
+
+        known = {job["path"] for job in self.pending.values()}
+        for name in sorted(os.listdir(self.queued_directory)):
+            path = os.path.join(self.queued_directory, name)
+            if path not in known:  # Moved into the queue, crashed before the journal entry
+                job = {"id": self.next_id, "path": path, "name": name.partition("-")[2] or name, "owned": True}
+                self.pending[job["id"]] = job
+                self.next_id += 1
+
+        temporary_path = self.journal_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            for job in self.pending.values():
+                f.write(json.dumps(job) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.journal_path)
+        self.journal = open(self.journal_path, "a")
+
+    def _append(self, entry):
+        self.journal.write(json.dumps(entry) + "\n")
+
+    # Function to make the journal durable, returns after fsync
+    def sync(self):
+        with self.condition:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.last_sync = time.monotonic()
+
+    # Function to queue a file, owned files belong to the spool and are deleted once sent. Call sync() afterwards.
+    def add(self, path, name, owned=False):
+        with self.condition:
+            job = {"id": self.next_id, "path": path, "name": name, "owned": owned}
+            self.next_id += 1
+            self._append(job)
+            self.pending[job["id"]] = job
+            self.condition.notify_all()
+            return job["id"]
+
+    # Function to take the next job, None after timeout
+    def get(self, timeout):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            for job_id, job in self.pending.items():
+                if job_id not in self.in_flight:
+                    self.in_flight[job_id] = job
+                    return job
+            return None
+
+    def done(self, job):
+        if job["owned"]:
+            try:
+                os.remove(job["path"])
+            except FileNotFoundError:
+                pass
+        self._finish(job)
+
+    def fail(self, job):
+        if job["owned"]:
+            failed_directory = os.path.join(self.directory, FAILED_DIR)
+            os.makedirs(failed_directory, exist_ok=True)
+            try:
+                os.replace(job["path"], os.path.join(failed_directory, os.path.basename(job["path"])))
+            except OSError:
+                pass
+        self._finish(job)
+
+    def _finish(self, job):
+        with self.condition:
+            del self.in_flight[job["id"]]
+            del self.pending[job["id"]]
+            if not self.pending:
+                self.journal.flush()
+                self.journal.truncate(0)  # Nothing left to recover, the journal does not grow forever
+                self.journal.seek(0)
+            else:
+                self._append({"done": job["id"]})
+            # A repeated send after a crash is harmless, so done entries are synced lazily
+            if time.monotonic() - self.last_sync >= SYNC_INTERVAL:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.last_sync = time.monotonic()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+
+# Function to move finished files from the spool directory into the queue, returns how many were taken
+def scan_spool(spool_queue, directory):
+    taken = 0
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.name.startswith(".") or entry.name.endswith(TEMPORARY_SUFFIXES) or not entry.is_file():
+            continue
+        queued_path = os.path.join(spool_queue.queued_directory, f"{time.time_ns()}-{entry.name}")
+        os.rename(entry.path, queued_path)
+        spool_queue.add(queued_path, entry.name, owned=True)
+        taken += 1
+    if taken:
+        spool_queue.sync()
+    return taken
+
+
+# Function to serve one job socket client: one absolute path per line, answered by "queued <id>" or "error <reason>"
+def serve_jobs_client(spool_queue, connection):
+    with connection:
+        partial = b""
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                return
+            *lines, partial = (partial + data).split(b"\n")
+            replies = []
+            for line in lines:  # Everything received so far is queued with a single fsync
+                path = line.decode("utf-8", "replace").strip()
+                if not path:
+                    continue
+                if not os.path.isfile(path):
+                    replies.append(f"error {path}: no such file\n")
+                    continue
+                replies.append(f"queued {spool_queue.add(path, os.path.basename(path))}\n")
+            if replies:
+                spool_queue.sync()
+                connection.sendall("".join(replies).encode("utf-8"))
+
+
+# Function to accept job socket clients until the process ends
+def serve_jobs(spool_queue, socket_path):
+    try:
+        os.unlink(socket_path)  # Left over from a previous run
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    while True:
+        connection, _ = server.accept()
+        threading.Thread(target=serve_jobs_client, args=(spool_queue, connection), daemon=True).start()
+
+
+# Function to submit files to a running daemon, prints its replies
+def submit(socket_path, paths):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client, client.makefile("rb") as replies:
+        client.sendall("".join(os.path.abspath(path) + "\n" for path in paths).encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        for reply in replies:
+            print(reply.decode("utf-8").rstrip("\n"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Queue files for a main.py --daemon over its job socket")
+    parser.add_argument("socket", help=f"Job socket of the daemon (<spool dir>/{JOBS_SOCKET_NAME} by default)")
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+    try:
+        submit(args.socket, args.paths)
+    except OSError as e:
+        sys.exit(f"[Spool] Cannot reach the daemon: {e}")
@@ -0,0 +1,98 @@
+# Ukončenie spojenia ako stavový automat (FIN-WAIT / CLOSE-WAIT / TIME-WAIT ako pri TCP) s pevným termínom.
+# Automat nečíta socket ani nemeria čas sám: dostane udalosť a čas, vráti pakety, ktoré treba poslať.
+# Socket číta iba listener, ktorý automatu odovzdá FIN / FIN-ACK / ACK a volá poll() pre časovače.
+
+OPEN = "OPEN"
+FIN_WAIT = "FIN-WAIT"  # Poslali sme FIN, čakáme FIN-ACK
+CLOSE_WAIT = "CLOSE-WAIT"  # Dostali sme FIN, poslali FIN-ACK, čakáme posledné ACK
+TIME_WAIT = "TIME-WAIT"  # Poslali sme posledné ACK, chvíľu ešte odpovedáme na zopakovaný FIN-ACK
+CLOSED = "CLOSED"
+
+SEND_FIN = 12
+SEND_FIN_ACK = 14
+SEND_ACK = 3
+
+RESEND_INTERVAL = 0.2
+LINGER = 1.0  # TIME-WAIT: toľko sekúnd ešte zopakujeme ACK, ak sa stratilo
+CLOSE_DEADLINE = 5.0  # Najdlhší čas od FIN po zatvorenie, aj keď druhá strana zmizla
+
+
+class Teardown:
+    def __init__(self, resend_interval=RESEND_INTERVAL, linger=LINGER, close_deadline=CLOSE_DEADLINE):
+        self.resend_interval = resend_interval
+        self.linger = linger
+        self.close_deadline = close_deadline
+        self.state = OPEN
+        self.started_at = None
+        self.deadline = None
+        self.next_resend = None
+        self.clean = False  # The peer confirmed the close (False = deadline reached)
+        self.closed_at = None  # Time the local side saw the close confirmed or gave up
+
+    def _start(self, state, now):
+        self.state = state
+        self.started_at = now
+        self.deadline = now + self.close_deadline
+        self.next_resend = now + self.resend_interval
+
+    def _finish(self, now, clean):
+        if self.closed_at is None:
+            self.closed_at = now
+            self.clean = clean
+
+    # Function to start a local close, the caller drains its own data first
+    def close(self, now):
+        if self.state != OPEN:
+            return []
+        self._start(FIN_WAIT, now)
+        return [SEND_FIN]
+
+    def on_fin(self, now):
+        if self.state == OPEN:
+            self._start(CLOSE_WAIT, now)
+        elif self.state == CLOSED:
+            return []
+        return [SEND_FIN_ACK]  # Also for a resent FIN or a simultaneous close
+
+    def on_fin_ack(self, now):
+        if self.state == FIN_WAIT:
+            self.state = TIME_WAIT
+            self.deadline = now + self.linger
+            self._finish(now, True)
+        if self.state == TIME_WAIT:
+            return [SEND_ACK]  # Resent FIN-ACK means our ACK got lost
+        return []
+
+    def on_ack(self, now):
+        if self.state == CLOSE_WAIT:
+            self.state = CLOSED
+            self._finish(now, True)
+
+    # Function to run the timers: resend FIN / FIN-ACK, give up at the deadline, end TIME-WAIT
+    def poll(self, now):
+        if self.state in (OPEN, CLOSED):
+            return []
+        if now >= self.deadline:
+            self._finish(now, self.state == TIME_WAIT)
+            self.state = CLOSED
+            return []
+        if self.state != TIME_WAIT and now >= self.next_resend:
+            self.next_resend = now + self.resend_interval
+            return [SEND_FIN if self.state == FIN_WAIT else SEND_FIN_ACK]
+        return []
+
+    # Function to get seconds until poll() has something to do, None when no timer runs
+    def next_timer(self, now):
+        if self.state in (OPEN, CLOSED):
+            return None
+        due = self.deadline if self.state == TIME_WAIT else min(self.deadline, self.next_resend)
+        return max(0.0, due - now)
+
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    # The local side may stop waiting: close confirmed (TIME-WAIT lingers in the background) or deadline
+    @property
+    def settled(self):
+        return self.closed_at is not None
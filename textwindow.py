@@ -0,0 +1,71 @@
+import collections
+
+# Posuvné okno textových správ: najviac window fragmentov (aj z viacerých správ) čaká naraz na ACK, ďalší
+# fragment ide von, až keď niektorý ACK príde, a znova sa posiela len fragment, ktorému vypršal čas.
+# Automat nečíta socket ani nemeria čas sám: text_sender v main.py mu dáva správy, ACK a čas.
+
+
+class TextWindow:
+    def __init__(self, window, timeout):
+        self.window = window
+        self.timeout = timeout
+        self.waiting = collections.deque()  # (key, total_fragments, data) not sent yet, in message order
+        self.in_flight = collections.OrderedDict()  # key -> [total_fragments, data, sent_at], oldest send first
+        self.remaining = {}  # message_id -> [unacknowledged fragments, start time]
+
+    # Function to queue a message, fragments are (fragment number, data); keys are (message_id, fragment number)
+    def add(self, message_id, total_fragments, fragments, started_at):
+        self.remaining[message_id] = [len(fragments), started_at]
+        for current_fragment, data in fragments:
+            self.waiting.append(((message_id, current_fragment), total_fragments, data))
+
+    # Function to pick what goes out now: fragments whose ACK timed out, then new ones while the window has room.
+    # Returns [(key, total_fragments, data, first transmission)]
+    def poll(self, now):
+        due = []
+        for key, entry in self.in_flight.items():
+            if entry[2] + self.timeout > now:
+                break  # The rest was sent later
+            due.append(key)
+        sends = []
+        for key in due:
+            entry = self.in_flight.pop(key)
+            entry[2] = now
+            self.in_flight[key] = entry  # Now the most recent send
+            sends.append((key, entry[0], entry[1], False))
+        while self.waiting and len(self.in_flight) < self.window:
+            key, total_fragments, data = self.waiting.popleft()
+            self.in_flight[key] = [total_fragments, data, now]
+            sends.append((key, total_fragments, data, True))
+        return sends
+
+    # Function to take an ACK, returns the message latency when it was the message's last fragment, else None
+    def on_ack(self, key, now):
+        if self.in_flight.pop(key, None) is None:
+            return None  # Duplicate ACK of a resent fragment
+        remaining = self.remaining[key[0]]
+        remaining[0] -= 1
+        if remaining[0]:
+            return None
+        del self.remaining[key[0]]
+        return now - remaining[1]
+
+    # A NACK does not name the fragment (its header failed the CRC), the oldest one is resent at the next poll
+    def on_nack(self, now):
+        for entry in self.in_flight.values():
+            entry[2] = now - self.timeout
+            break
+
+    # Function to get seconds until poll() has a resend to do, None when nothing is in flight
+    def next_timer(self, now):
+        for entry in self.in_flight.values():
+            return max(0.0, entry[2] + self.timeout - now)
+        return None
+
+    @property
+    def has_room(self):
+        return len(self.in_flight) + len(self.waiting) < self.window
+
+    @property
+    def idle(self):
+        return not self.in_flight and not self.waiting
@@ -0,0 +1,130 @@
+import os
+
+import profiling
+import runtime
+
+# Zápis prijatých fragmentov na disk v samostatnom vlákne: susedné fragmenty sa spoja do jedného pwritev,
+# zápis sa spúšťa podľa objemu alebo času a po dokončení sa súbor voliteľne fsync-ne.
+
+DEFAULT_FLUSH_BYTES = 4 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.05
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in getattr(os, "sysconf_names", {}) else 1024
+
+
+class WriteBehind:
+    def __init__(self, fd, flush_bytes=DEFAULT_FLUSH_BYTES, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 fsync_on_complete=True):
+        self.fd = fd
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_on_complete = fsync_on_complete
+        self.pending = {}  # offset -> data
+        self.oldest_pending = None
+        self.backlog = 0  # Bytes submitted but not yet written
+        self.closing = False
+        self.error = None
+        self.condition = runtime.Condition()
+        self.thread = runtime.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, offset, data):
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+            if offset in self.pending:
+                return
+            self.pending[offset] = data
+            self.backlog += len(data)
+            if self.oldest_pending is None:
+                self.oldest_pending = runtime.monotonic()
+                self.condition.notify()  # The writer sleeps without a timeout while nothing is pending
+            elif self.backlog >= self.flush_bytes:
+                self.condition.notify()
+
+    def _flush_due(self):
+        if self.closing or self.backlog >= self.flush_bytes:
+            return True
+        return self.oldest_pending is not None and runtime.monotonic() - self.oldest_pending >= self.flush_interval
+
+    def _run(self):
+        while True:
+            profiling.checkpoint()
+            with self.condition:
+                while not self._flush_due():
+                    timeout = None
+                    if self.oldest_pending is not None:
+                        timeout = max(0.0, self.flush_interval - (runtime.monotonic() - self.oldest_pending))
+                    self.condition.wait(timeout)
+                batch = self.pending
+                self.pending = {}
+                self.oldest_pending = None
+                closing = self.closing
+
+            span = profiling.span_begin()
+            try:
+                written = self._write(batch)
+            except OSError as e:
+                with self.condition:
+                    self.error = e
+                return
+
+            profiling.span_end("disk_write", span)
+
+            with self.condition:
+                self.backlog -= written
+                if closing and not self.pending:
+                    return
+
+    # Function to write a batch as runs of contiguous fragments, one pwritev per run
+    def _write(self, batch):
+        written = 0
+        run_offset = None
+        run = []
+        run_end = None
+        for offset in sorted(batch):
+            data = batch[offset]
+            if run and (offset != run_end or len(run) >= IOV_MAX):
+                written += self._write_run(run_offset, run)
+                run = []
+            if not run:
+                run_offset = offset
+                run_end = offset
+            run.append(data)
+            run_end += len(data)
+        if run:
+            written += self._write_run(run_offset, run)
+        return written
+
+    def _write_run(self, offset, buffers):
+        total = sum(len(buffer) for buffer in buffers)
+        if hasattr(os, "pwritev"):
+            done = os.pwritev(self.fd, buffers, offset)
+            if done == total:
+                return total
+        else:
+            done = 0
+        # Short write or no pwritev: write the rest in one piece
+        remaining = memoryview(b"".join(buffers))[done:]
+        while remaining:
+            count = os.pwrite(self.fd, remaining, offset + done)
+            remaining = remaining[count:]
+            done += count
+        return total
+
+    # Function to write out everything that is left and make it durable
+    def finish(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.fsync_on_complete:
+            os.fsync(self.fd)
+
+    def abort(self):
+        with self.condition:
+            self.closing = True
+            self.pending = {}
+            self.condition.notify()
+        self.thread.join()